@@ -0,0 +1,201 @@
+"""Goal-directed backward chaining for kb_ask, alongside forward chaining.
+
+Select it per predicate with KnowledgeBase([], [], backward=["ancestor"]).
+Asserted rules whose RHS has a backward predicate are kept out of the
+inference engine, so their consequences are never materialized. Instead,
+kb_ask proves queries on those predicates on demand, SLD-style: a goal is
+resolved against the stored facts and against the RHS of every rule that can
+derive it, and the rule's LHS is then solved left to right as subgoals.
+
+Each distinct subgoal (up to variable names) gets a table of answers. A
+subgoal met again reads its table instead of being resolved again, so
+recursive rules such as
+    ((ancestor ?x ?y) (parent ?y ?z)) -> (ancestor ?x ?z)
+terminate. The tables are re-evaluated until none of them grows, and are
+dropped after the query. Forward rules whose LHS uses a backward predicate
+cannot see its facts, so their RHS predicates are answered through the same
+tables.
+"""
+from logical_classes import *
+from rete import canonical, substitute
+from util import match
+
+class Prover(object):
+    """Tabled backward chaining over the asserted rules of a KB
+
+    Attributes:
+        kb (KnowledgeBase): KB whose facts and rules are used
+        heads (dictof list|None): maps each predicate to the asserted rules
+            with it on the RHS, None until the next query rebuilds it
+        goals (setof str|None): predicates answered by backward chaining: the
+            KB's backward predicates and, transitively, the RHS predicates of
+            the rules using them
+    """
+    def __init__(self, kb):
+        """Constructor for Prover
+
+        Args:
+            kb (KnowledgeBase): KB to prove goals in
+        """
+        super(Prover, self).__init__()
+        self.kb = kb
+        self.heads = None
+        self.goals = None
+
+    def invalidate(self):
+        """Forget the rule index, after rules were added to the KB
+        """
+        self.heads = None
+        self.goals = None
+
+    def proves(self, statement):
+        """Check whether queries on a statement's predicate are answered by
+            backward chaining rather than from the stored facts alone
+
+        Args:
+            statement (Statement): query
+
+        Returns:
+            bool
+        """
+        if self.goals is None:
+            self._index()
+        return statement.predicate in self.goals
+
+    def solve(self, goal):
+        """Prove a goal from the KB's facts and rules
+
+        Args:
+            goal (Statement): statement to prove, may contain variables
+
+        Returns:
+            listof Statement: the instances of the goal that hold, each once
+        """
+        if self.goals is None:
+            self._index()
+        tables = {}
+        calls = []
+        answers = self._table(goal, tables, calls)
+        grew = True
+        while grew:
+            grew = False
+            # subgoals tabled during the pass are evaluated in it too
+            i = 0
+            while i < len(calls):
+                call = calls[i]
+                table = tables[canonical(call)[0]]
+                for answer in list(self._evaluate(call, tables, calls)):
+                    if answer.key not in table:
+                        table[answer.key] = answer
+                        grew = True
+                i += 1
+        return list(answers.values())
+
+    def _index(self):
+        """Index the asserted rules by RHS predicate and find the goal predicates
+        """
+        heads = {}
+        for store in (self.kb.rules, self.kb.backward_rules):
+            for rule in store:
+                if rule.asserted:
+                    heads.setdefault(rule.rhs.predicate, []).append(rule)
+        goals = set(self.kb.backward)
+        grew = True
+        while grew:
+            grew = False
+            for predicate, rules in heads.items():
+                if predicate not in goals and any(s.predicate in goals
+                                                  for rule in rules for s in rule.lhs):
+                    goals.add(predicate)
+                    grew = True
+        self.heads = heads
+        self.goals = goals
+
+    def _table(self, call, tables, calls):
+        """Get the answer table of a subgoal, creating it if it is new
+
+        Args:
+            call (Statement): subgoal
+            tables (dictof dict): maps canonical subgoal keys to their answers,
+                keyed by statement key
+            calls (listof Statement): subgoals in the order they were tabled
+
+        Returns:
+            dictof Statement: the subgoal's answers so far
+        """
+        key = canonical(call)[0]
+        table = tables.get(key)
+        if table is None:
+            table = tables[key] = {}
+            calls.append(call)
+        return table
+
+    def _evaluate(self, call, tables, calls):
+        """Resolve a subgoal once against the stored facts and the rules,
+            reading the current tables for its own subgoals
+
+        Returns:
+            iterator of Statement: answers, possibly already tabled
+        """
+        for fact in self.kb.facts.candidates(call):
+            if match(call, fact.statement):
+                yield fact.statement
+        for rule in self.heads.get(call.predicate, ()):
+            bindings = _unify_head(rule.rhs, call)
+            if bindings is None:
+                continue
+            for bound in self._body(rule.lhs, 0, bindings, tables, calls):
+                answer = substitute(rule.rhs, bound)
+                if match(call, answer):
+                    yield answer
+
+    def _body(self, lhs, i, bindings, tables, calls):
+        """Solve lhs[i:] left to right under the given bindings
+
+        Args:
+            lhs (listof Statement): rule LHS
+            i (int): next statement to solve
+            bindings (dictof str): values of the rule's variables so far
+
+        Returns:
+            iterator of dict: bindings of each solution
+        """
+        if i == len(lhs):
+            yield bindings
+            return
+        pattern = substitute(lhs[i], bindings)
+        if pattern.predicate in self.goals:
+            found = list(self._table(pattern, tables, calls).values())
+        else:
+            found = [fact.statement for fact in self.kb.facts.candidates(pattern)]
+        for statement in found:
+            matched = match(pattern, statement)
+            if matched:
+                merged = dict(bindings)
+                merged.update(matched.bindings_dict)
+                for solution in self._body(lhs, i + 1, merged, tables, calls):
+                    yield solution
+
+def _unify_head(rhs, call):
+    """Bind the variables of a rule's RHS to the constants of a goal
+
+    Args:
+        rhs (Statement): rule RHS
+        call (Statement): goal
+
+    Returns:
+        dictof str|None: bindings, None if the RHS cannot derive the goal
+    """
+    if len(rhs.terms) != len(call.terms):
+        return None
+    bindings = {}
+    for r, c in zip(rhs.terms, call.terms):
+        if c.var:
+            continue
+        if r.var:
+            old = bindings.setdefault(r.term.element, c.term.element)
+            if old != c.term.element:
+                return None
+        elif r is not c:
+            return None
+    return bindings
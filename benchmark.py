@@ -0,0 +1,927 @@
+"""Benchmarks for the KnowledgeBase. Run e.g.
+
+    python benchmark.py ask --facts 1000000
+
+The suite runs a fixed set of generated workloads and writes its results as
+JSON, to compare later runs with:
+
+    python benchmark.py suite --output before.json
+    python benchmark.py suite --baseline before.json
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import read
+import student_code
+from logical_classes import *
+from cache import QueryCache
+from columnar import ColumnarFactStore
+from compiler import RuleCompiler, _slow
+from metrics import Metrics
+from datalog import SemiNaiveEngine
+from parallel import ParallelEngine
+from rete import ReteEngine
+from shared import SharedKnowledgeBase
+from student_code import KnowledgeBase, InferenceEngine
+from util import match, match_recursive
+
+ENGINES = {"curry": InferenceEngine, "rete": ReteEngine, "seminaive": SemiNaiveEngine}
+
+def synthetic_facts(n, types=1000, colors=10):
+    """Generate n ground facts over a box-world, in the style of statements_kb.txt
+
+    Args:
+        n (int): number of facts to generate
+        types (int): number of distinct types objects are instances of
+        colors (int): number of distinct colors
+
+    Returns:
+        listof Fact: (inst objI typeJ) and (color objI colorK) facts
+    """
+    facts = []
+    for i in range(n // 2):
+        obj = "obj" + str(i)
+        facts.append(Fact(["inst", obj, "type" + str(i % types)]))
+        facts.append(Fact(["color", obj, "color" + str(i % colors)]))
+    return facts
+
+def synthetic_rules(n):
+    """Generate n two-statement join rules over distinct predicates
+
+    Args:
+        n (int): number of rules to generate
+
+    Returns:
+        listof Rule: ((linkJ ?x ?y) (kindJ ?y ?z)) -> (reachJ ?x ?z) rules
+    """
+    return [Rule([[["link" + str(j), "?x", "?y"], ["kind" + str(j), "?y", "?z"]],
+                  ["reach" + str(j), "?x", "?z"]]) for j in range(n)]
+
+def synthetic_joins(n, rules):
+    """Generate n facts feeding the rules of synthetic_rules(rules)
+
+    Returns:
+        listof Fact: (linkJ aI bI) and (kindJ bI kI) facts
+    """
+    facts = []
+    for i in range(n // 2):
+        j = str(i % rules)
+        facts.append(Fact(["link" + j, "a" + str(i), "b" + str(i)]))
+        facts.append(Fact(["kind" + j, "b" + str(i), "k" + str(i % 7)]))
+    return facts
+
+def scaled_kb(file, copies):
+    """Replicate the facts of a statements file, renaming their constants in
+        each copy, and keep a single copy of its rules
+
+    Args:
+        file (str): statements file, e.g. 'statements_kb.txt'
+        copies (int): number of copies of the facts
+
+    Returns:
+        listof Fact|Rule: the rules followed by the renamed facts
+    """
+    items = read.read_tokenize(file)
+    rules = [item for item in items if isinstance(item, Rule)]
+    facts = [item for item in items if isinstance(item, Fact)]
+    for c in range(copies):
+        suffix = "_" + str(c)
+        for fact in facts:
+            key = fact.statement.key
+            rules.append(Fact([key[0]] + [e if e[0] == "?" else e + suffix for e in key[1:]]))
+    return rules
+
+def fresh(items):
+    """Copy facts and rules without their provenance, so that each KB built
+        from them starts clean: kb_assert records support in the objects
+        asserted
+
+    Args:
+        items (listof Fact|Rule): facts and rules to copy
+
+    Returns:
+        listof Fact|Rule
+    """
+    return [Fact(i.statement) if isinstance(i, Fact) else Rule([i.lhs, i.rhs]) for i in items]
+
+def deep_isa(depth, objects=10):
+    """Generate a chain of isa links with instances at its bottom, and the
+        rules propagating instances and isa up the chain
+
+    Args:
+        depth (int): length of the isa chain
+        objects (int): instances of the bottom class
+
+    Returns:
+        listof Fact|Rule: about depth**2 / 2 isa and depth * objects inst facts
+            once inferred
+    """
+    items = [Rule([[["isa", "?x", "?y"], ["isa", "?y", "?z"]], ["isa", "?x", "?z"]]),
+             Rule([[["inst", "?x", "?y"], ["isa", "?y", "?z"]], ["inst", "?x", "?z"]])]
+    items += [Fact(["isa", "class" + str(i), "class" + str(i + 1)]) for i in range(depth)]
+    items += [Fact(["inst", "obj" + str(i), "class0"]) for i in range(objects)]
+    return items
+
+def wide_inst(n, types=100, parents=3):
+    """Generate n instances spread over types, each type under several
+        parent types, and the rule propagating instances to parents
+
+    Args:
+        n (int): number of inst facts asserted
+        types (int): number of types instances belong to
+        parents (int): parent types of each type
+
+    Returns:
+        listof Fact|Rule: about n * (1 + parents) inst facts once inferred
+    """
+    items = [Rule([[["inst", "?x", "?y"], ["isa", "?y", "?z"]], ["inst", "?x", "?z"]])]
+    items += [Fact(["isa", "type" + str(t), "parent" + str((t + p) % types)])
+              for t in range(types) for p in range(parents)]
+    items += [Fact(["inst", "obj" + str(i), "type" + str(i % types)]) for i in range(n)]
+    return items
+
+def retraction_storm(n, hubs=100):
+    """Generate hub facts each supporting n / hubs derived facts through a
+        join rule, for retracting the hubs one after another
+
+    Args:
+        n (int): number of derived facts
+        hubs (int): number of hubs
+
+    Returns:
+        (listof Fact|Rule, listof Fact): items to assert and the hubs
+    """
+    _, items, retracts = retract_workloads(n, hubs)[0]
+    return items, retracts
+
+def timed(function, repeat=1):
+    """Time a call, returning (seconds per call, result of the last call)
+    """
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = function()
+    return (time.perf_counter() - start) / repeat, result
+
+def bench_ask(n, repeat=20, columnar=False):
+    """Compare kb_ask against a linear scan on a KB of n synthetic facts
+    """
+    if columnar:
+        kb = KnowledgeBase([], [], store=ColumnarFactStore())
+        seconds, _ = timed(lambda: kb.facts.load(f.statement.key for f in synthetic_facts(n)))
+    else:
+        kb = KnowledgeBase([], [])
+        seconds, _ = timed(lambda: [kb.kb_assert(f) for f in synthetic_facts(n)])
+    print("asserted {} facts in {:.2f}s".format(len(kb.facts), seconds))
+
+    queries = [["inst", "?x", "type7"], ["inst", "obj42", "?y"],
+               ["color", "?x", "color3"], ["inst", "?x", "?y"]]
+    for query in queries:
+        fact = Fact(query)
+        per_ask, answer = timed(lambda: kb.kb_ask(fact), repeat)
+        per_first, _ = timed(lambda: next(kb.kb_ask_iter(fact), None), repeat)
+        per_ten, _ = timed(lambda: list(kb.kb_ask_iter(fact, limit=10)), repeat)
+        line = "{:<24} {:>8} answers  kb_ask {:>10.3f}ms  first {:>7.3f}ms  10 {:>7.3f}ms".format(
+            str(fact.statement), len(answer), per_ask * 1000, per_first * 1000, per_ten * 1000)
+        if len(answer) < n // 10:
+            per_scan, _ = timed(lambda: [match(fact.statement, f.statement)
+                                         for f in kb.facts], 1)
+            line += "  scan {:>10.3f}ms".format(per_scan * 1000)
+        print(line)
+
+    # peak memory of collecting every answer of the broadest query, against
+    # streaming through them
+    fact = Fact(queries[-1])
+    for label, ask in (("kb_ask", lambda: kb.kb_ask(fact)),
+                       ("kb_ask_iter", lambda: sum(1 for _ in kb.kb_ask_iter(fact)))):
+        tracemalloc.start()
+        ask()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print("{:<24} {:<12} peak {:.1f}MB".format(str(fact.statement), label, peak / 1e6))
+
+def bench_cache(n, repeat=20):
+    """Compare repeated kb_ask calls over n synthetic facts with and without a
+        QueryCache, with a fact asserted between rounds that invalidates one
+        of the queries
+    """
+    queries = [Fact(["inst", "?x", "type7"]), Fact(["color", "?x", "color3"]),
+               Fact(["inst", "obj42", "?y"]), Fact(["inst", "?x", "?y"])]
+    for cache in (None, QueryCache()):
+        kb = KnowledgeBase([], [], cache=cache)
+        kb.kb_assert_many(synthetic_facts(n))
+        new = iter(range(repeat))
+
+        def round():
+            for query in queries:
+                kb.kb_ask(query)
+            kb.kb_assert(Fact(["color", "new" + str(next(new)), "color3"]))
+        per_round, _ = timed(round, repeat)
+        line = "{:<10} {:>10.3f}ms/round".format("cached" if cache else "uncached",
+                                                per_round * 1000)
+        if cache:
+            line += "  " + ", ".join("{} {}".format(k, v) for k, v in sorted(cache.stats().items()))
+        print(line)
+
+def bench_explain(depth, objects=10):
+    """Time kb_explain on the deep isa chain of deep_isa(depth) with each
+        engine: the deepest inst fact cold and from remembered proofs, by
+        first derivations and shortest, then every inst fact, against
+        walking the first support pairs by hand
+    """
+    for name in sorted(ENGINES):
+        kb = KnowledgeBase([], [], ENGINES[name]())
+        kb.kb_assert_many(deep_isa(depth, objects))
+        deepest = Fact(["inst", "obj0", "class" + str(depth)])
+
+        def walk(node):
+            stack, steps = [node], 0
+            while stack:
+                node = stack.pop()
+                steps += 1
+                if not node.asserted:
+                    stack.extend(next(iter(node.supported_by)))
+            return steps
+
+        walked, steps = timed(lambda: walk(kb._get_fact(deepest)))
+        cold, proofs = timed(lambda: kb.kb_explain(deepest, max_proofs=10))
+        warm, _ = timed(lambda: kb.kb_explain(deepest, max_proofs=10))
+        least, shortest = timed(lambda: kb.kb_explain(deepest, max_proofs=10, shortest=True))
+        again, _ = timed(lambda: kb.kb_explain(deepest, max_proofs=10, shortest=True))
+        insts = [f for f in kb.facts if f.statement.predicate == "inst"]
+        kb.explainer.invalidate()
+        every, _ = timed(lambda: [kb.kb_explain(f) for f in insts])
+        print("{:<10} first pairs {:.2f}ms ({} nodes); explain {:.2f}ms cold, {:.3f}ms warm, "
+              "height {}; shortest {:.1f}ms cold, {:.3f}ms warm, height {}; "
+              "all {} inst facts {:.1f}ms".format(
+                  name, walked * 1000, steps, cold * 1000, warm * 1000, proofs[0].height,
+                  least * 1000, again * 1000, shortest[0].height, len(insts), every * 1000))
+
+def bench_metrics(n, rules, retracts=1000):
+    """Compare a bulk load of n synthetic facts and a run of retractions with
+        metrics disabled and enabled, and show the costliest rules
+    """
+    for metrics in (None, Metrics()):
+        kb = KnowledgeBase([], [], metrics=metrics)
+        facts = synthetic_joins(n, rules)
+        loaded, _ = timed(lambda: kb.kb_assert_many(synthetic_rules(rules) + facts))
+        retracted, _ = timed(lambda: [kb.kb_retract(f) for f in facts[:retracts]])
+        print("{:<8} loaded {} facts in {:.2f}s, retracted {} in {:.2f}s".format(
+            "enabled" if metrics else "disabled", len(kb.facts), loaded, retracts, retracted))
+    snapshot = metrics.snapshot()
+    print("fc_infer", snapshot["fc_infer"])
+    print("kb_retract", snapshot["kb_retract"])
+    for rule, counters in list(snapshot["rules"].items())[:3]:
+        print("  {:<48} {}".format(rule, counters))
+
+def bench_parallel(n, rules, workers=(1, 2, 4, 8)):
+    """Compare bulk loads of n synthetic facts through the rules of
+        synthetic_rules(rules) with the serial semi-naive engine and with
+        ParallelEngine pools of each size
+    """
+    items = synthetic_rules(rules) + synthetic_joins(n, rules)
+    kb = KnowledgeBase([], [], SemiNaiveEngine())
+    serial, _ = timed(lambda: kb.kb_assert_many(items))
+    closure = set(f.statement.key for f in kb.facts)
+    print("serial     {} facts in {:.2f}s".format(len(closure), serial))
+    for count in workers:
+        engine = ParallelEngine(workers=count)
+        kb = KnowledgeBase([], [], engine)
+        items = synthetic_rules(rules) + synthetic_joins(n, rules)
+        seconds, _ = timed(lambda: kb.kb_assert_many(items))
+        engine.close()
+        same = closure == set(f.statement.key for f in kb.facts)
+        print("{} workers  {} facts in {:.2f}s, speedup {:.2f}, same closure: {}".format(
+            count, len(kb.facts), seconds, serial / seconds, same))
+
+def bench_query(n, repeat=5, columnar=False):
+    """Compare conjunctive queries over n synthetic facts answered by kb_query
+        with the same joins written as chained kb_ask calls, in query order
+    """
+    if columnar:
+        kb = KnowledgeBase([], [], store=ColumnarFactStore())
+        kb.facts.load(f.statement.key for f in synthetic_facts(n))
+    else:
+        kb = KnowledgeBase([], [])
+        kb.kb_assert_many(synthetic_facts(n))
+
+    def chained(statements, bindings=None, k=0):
+        if k == len(statements):
+            return 1
+        found = 0
+        pattern = statements[k] if bindings is None else student_code.instantiate(
+            statements[k], bindings)
+        for binding in kb.kb_ask(Fact(pattern)) or []:
+            merged = Bindings()
+            merged.bindings_dict.update(bindings.bindings_dict if bindings else {})
+            merged.bindings_dict.update(binding.bindings_dict)
+            found += chained(statements, merged, k + 1)
+        return found
+
+    queries = [[["color", "?x", "color7"], ["inst", "?x", "type7"]],
+               [["inst", "?x", "?t"], ["color", "?x", "color3"]],
+               [["inst", "?x", "?t"], ["color", "?x", "?c"]]]
+    for query in queries:
+        statements = [Statement(s) for s in query]
+        per_query, answers = timed(lambda: len(kb.kb_query(statements)), repeat)
+        per_chain, _ = timed(lambda: chained(statements), 1)
+        print("{:<42} {:>7} answers  kb_query {:>9.2f}ms  chained kb_ask {:>9.2f}ms".format(
+            " ".join(str(s) for s in statements), answers, per_query * 1000, per_chain * 1000))
+
+def bench_assert(n, rules):
+    """Time asserting n facts into a KB holding the given number of join rules
+    """
+    kb = KnowledgeBase([], [])
+    for rule in synthetic_rules(rules):
+        kb.kb_assert(rule)
+    facts = synthetic_joins(n, rules)
+    seconds, _ = timed(lambda: [kb.kb_assert(f) for f in facts])
+    print("asserted {} facts against {} rules in {:.2f}s ({:.1f}us/assert), "
+          "{} facts and {} rules in KB".format(n, rules, seconds, seconds / n * 1e6,
+                                               len(kb.facts), len(kb.rules)))
+
+def bench_engines(copies, bulk=False, retracts=1000):
+    """Compare the inference engines on statements_kb.txt scaled up copies times,
+        asserting one item at a time or with kb_assert_many
+    """
+    scaled = scaled_kb("statements_kb.txt", copies)
+    for name in sorted(ENGINES):
+        items = fresh(scaled)
+        facts = [item for item in items if isinstance(item, Fact)]
+        kb = KnowledgeBase([], [], ENGINES[name]())
+        if bulk:
+            seconds, _ = timed(lambda: kb.kb_assert_many(items))
+        else:
+            seconds, _ = timed(lambda: [kb.kb_assert(item) for item in items])
+        retracted, _ = timed(lambda: [kb.kb_retract(f) for f in facts[:retracts]])
+        print("{:<9} asserted {} items in {:.2f}s, {} facts and {} rules in KB, "
+              "retracted {} facts in {:.2f}s".format(name, len(items), seconds,
+              len(kb.facts), len(kb.rules), retracts, retracted))
+
+def retract_workloads(n, hubs=10):
+    """Generate KBs whose retraction removes about n derived facts
+
+    Args:
+        n (int): number of derived facts
+        hubs (int): number of hub facts retracted
+
+    Returns:
+        listof (str, listof Fact|Rule, listof Fact): name, items to assert
+            and facts to retract, for each shape:
+            - hub: each hub supports n / hubs facts through a join rule
+            - fanin: every one of n / hubs facts is supported by every hub
+            - chain: one fact starts an n long chain of inferences
+            - cycle: as hub, but the derived facts support each other in
+              pairs through a symmetric rule
+    """
+    shapes = []
+    rule = [[["hub", "?h"], ["link", "?h", "?x"]], ["reached", "?x"]]
+    retracts = [Fact(["hub", "h" + str(h)]) for h in range(hubs)]
+    items = [Rule(rule)] + [Fact(["link", "h" + str(i % hubs), "x" + str(i)]) for i in range(n)]
+    shapes.append(("hub", items + retracts, retracts))
+    items = [Rule(rule)] + [Fact(["link", "h" + str(h), "x" + str(i)])
+                            for i in range(n // hubs) for h in range(hubs)]
+    shapes.append(("fanin", items + retracts, retracts))
+    items = [Rule([[["on", "?a"], ["next", "?a", "?b"]], ["on", "?b"]])]
+    items += [Fact(["next", "n" + str(i), "n" + str(i + 1)]) for i in range(n)]
+    shapes.append(("chain", items + [Fact(["on", "n0"])], [Fact(["on", "n0"])]))
+    items = [Rule([[["hub", "?h"], ["link", "?h", "?x"]], ["near", "?h", "?x"]]),
+             Rule([[["near", "?x", "?y"]], ["near", "?y", "?x"]])]
+    items += [Fact(["link", "h" + str(i % hubs), "x" + str(i)]) for i in range(n // 2)]
+    shapes.append(("cycle", items + retracts, retracts))
+    return shapes
+
+def bench_retract(n, hubs=10):
+    """Time retractions removing about n derived facts with each engine, see
+        retract_workloads for the shapes of KB
+    """
+    for shape, items, retracts in retract_workloads(n, hubs):
+        for name in sorted(ENGINES):
+            kb = KnowledgeBase([], [], ENGINES[name]())
+            built, _ = timed(lambda: kb.kb_assert_many(fresh(items)))
+            before = len(kb.facts)
+            seconds, _ = timed(lambda: [kb.kb_retract(f) for f in retracts])
+            print("{:<6} {:<9} built {} facts in {:.2f}s, retracted {} in {:.3f}s, "
+                  "{} facts left".format(shape, name, before, built, len(retracts),
+                                         seconds, len(kb.facts)))
+
+def bench_shared(n, hubs=10, readers=4):
+    """Time kb_ask from reader threads while a writer retracts hubs supporting
+        n derived facts, with every access behind one lock and with a
+        SharedKnowledgeBase, then time single asserts into shared KBs of n / 10
+        and n facts
+    """
+    _, items, retracts = retract_workloads(n, hubs)[0]
+    for mode in ("locked", "shared"):
+        kb = KnowledgeBase([], [])
+        kb.kb_assert_many(fresh(items))
+        lock = threading.Lock()
+        if mode == "shared":
+            shared = SharedKnowledgeBase(kb)
+            ask, retract = shared.kb_ask, shared.kb_retract
+        else:
+            def ask(fact):
+                with lock:
+                    return kb.kb_ask(fact)
+
+            def retract(fact):
+                with lock:
+                    kb.kb_retract(fact)
+        done = threading.Event()
+        latencies = []
+
+        def read():
+            fact = Fact(["reached", "x1"])
+            while not done.is_set():
+                start = time.perf_counter()
+                ask(fact)
+                latencies.append(time.perf_counter() - start)
+                # a steady stream of queries rather than a busy loop
+                time.sleep(0.001)
+
+        threads = [threading.Thread(target=read) for _ in range(readers)]
+        for thread in threads:
+            thread.start()
+        seconds, _ = timed(lambda: [retract(Fact(f.statement)) for f in retracts])
+        done.set()
+        for thread in threads:
+            thread.join()
+        latencies.sort()
+        print("{:<7} retracted {} hubs in {:.2f}s, {} reads, latency p50 {:.2f}ms "
+              "p99 {:.2f}ms max {:.2f}ms".format(
+                  mode, len(retracts), seconds, len(latencies),
+                  latencies[len(latencies) // 2] * 1000,
+                  latencies[len(latencies) * 99 // 100] * 1000, latencies[-1] * 1000))
+    # one assert publishes a generation: its cost should not grow with the KB
+    for size in (n // 10, n):
+        kb = KnowledgeBase([], [])
+        kb.kb_assert_many([Fact(["inst", "box{}".format(i), "box"]) for i in range(size)])
+        shared = SharedKnowledgeBase(kb)
+        asserts = [Fact(["inst", "new{}".format(i), "box"]) for i in range(200)]
+        seconds, _ = timed(lambda: [shared.kb_assert(fact) for fact in asserts])
+        print("shared  {} facts: {:.3f}ms per kb_assert".format(
+            size, seconds * 1000 / len(asserts)))
+
+def recursive_match(state1, state2, bindings=None):
+    """util.match as it was before the single-pass loop, for comparison
+    """
+    if len(state1.terms) != len(state2.terms) or state1.predicate != state2.predicate:
+        return False
+    return match_recursive(state1.terms, state2.terms, bindings or Bindings())
+
+class GenericCompiler(object):
+    """Stand-in for compiler.RuleCompiler that matches and instantiates every
+        rule generically, as fc_infer did before rules were compiled
+    """
+    def get(self, rule):
+        return lambda statement: _slow(rule, statement)
+
+def bench_match(n, rules, repeat=200000):
+    """Measure the cost per util.match call, with the recursive matcher and the
+        single-pass one, on its own and as called by kb_ask, and the cost per
+        fc_infer step with generic and compiled rules
+    """
+    query, fact = Statement(["link", "?x", "?y", "k1"]), Statement(["link", "a", "b", "k1"])
+    def single():
+        for _ in range(repeat):
+            student_code.match(query, fact)
+    workloads = [("match", single, repeat)]
+
+    kb = KnowledgeBase([], [])
+    kb.kb_assert_many(synthetic_facts(n))
+    queries = [Fact(["inst", "?x", "type" + str(i)]) for i in range(100)]
+    workloads.append(("kb_ask", lambda: [kb.kb_ask(q) for q in queries], None))
+
+    for name, workload, calls in workloads:
+        if calls is None:
+            # count the calls made through student_code
+            counter = [0]
+            def counted(state1, state2, bindings=None):
+                counter[0] += 1
+                return match(state1, state2, bindings)
+            student_code.match = counted
+            workload()
+            calls = counter[0]
+        line = "{:<9} {:>8} matches".format(name, calls)
+        for label, function in (("recursive", recursive_match), ("loop", match)):
+            student_code.match = function
+            seconds, _ = timed(workload)
+            line += "  {} {:>7.0f}ns/match".format(label, seconds / calls * 1e9)
+        student_code.match = match
+        print(line)
+
+    # every (fact, rule) pair fc_infer tries during a bulk load, replayed
+    # through each compiler
+    items = synthetic_rules(rules) + synthetic_joins(n, rules)
+    pairs = []
+    engine = InferenceEngine()
+    infer = engine.fc_infer
+    engine.fc_infer = lambda fact, rule, kb: (pairs.append((fact.statement, rule)),
+                                              infer(fact, rule, kb))
+    KnowledgeBase([], [], engine).kb_assert_many(items)
+    line = "{:<9} {:>8} steps  ".format("fc_infer", len(pairs))
+    for label, compiler in (("generic", GenericCompiler()), ("compiled", RuleCompiler())):
+        steps = [(statement, compiler.get(rule)) for statement, rule in pairs]
+        seconds, _ = timed(lambda: [step(statement) for statement, step in steps])
+        line += "  {} {:>7.0f}ns/step".format(label, seconds / len(pairs) * 1e9)
+    print(line)
+
+def bench_parse(n):
+    """Time streaming a file of n facts through read.iter_tokenize and measure
+        the peak memory used while doing so, without keeping the items. The
+        facts reuse 10000 names, as interned names stay in the symbol table.
+    """
+    handle, path = tempfile.mkstemp(suffix=".txt")
+    with os.fdopen(handle, "w") as file:
+        for i in range(n):
+            file.write("fact: (inst obj{} type{})\n".format(i % 10000, i % 1000))
+            if i % 1000 == 0:
+                file.write("rule: ((inst ?x type{})\n    (color ?x red))\n  -> (red{} ?x)\n".format(i, i))
+    try:
+        seconds, count = timed(lambda: sum(1 for _ in read.iter_tokenize(path)))
+        tracemalloc.start()
+        sum(1 for _ in read.iter_tokenize(path))
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print("parsed {} items ({:.1f}MB) in {:.2f}s, {:.0f} items/s, peak {:.0f}KB".format(
+            count, os.path.getsize(path) / 1e6, seconds, count / seconds, peak / 1e3))
+    finally:
+        os.remove(path)
+
+def bench_snapshot(copies, n, rules):
+    """Compare rebuilding a KB with saving it to a snapshot and loading it
+        back, with each engine, for statements_kb.txt scaled up copies times
+        and for n facts joined by the given number of rules
+    """
+    workloads = [("kb x" + str(copies), scaled_kb("statements_kb.txt", copies)),
+                 ("joins", synthetic_rules(rules) + synthetic_joins(n, rules))]
+    handle, path = tempfile.mkstemp(suffix=".snap")
+    os.close(handle)
+    try:
+        for (workload, items), name in ((w, e) for w in workloads for e in sorted(ENGINES)):
+            kb = KnowledgeBase([], [], ENGINES[name]())
+            built, _ = timed(lambda: kb.kb_assert_many(fresh(items)))
+            saved, _ = timed(lambda: kb.save(path))
+            loaded, copy = timed(lambda: KnowledgeBase.load(path, ENGINES[name]()))
+            print("{:<8} {:<9} {} facts {} rules: built in {:.2f}s, saved {:.1f}MB in {:.2f}s, "
+                  "loaded in {:.2f}s".format(workload, name, len(copy.facts), len(copy.rules),
+                                             built, os.path.getsize(path) / 1e6, saved, loaded))
+    finally:
+        os.remove(path)
+
+def bench_journal(n, rules, retracts=1000):
+    """Measure the cost of journaling n kb_assert calls of facts joined by the
+        given number of rules, and retracts of some of them: without a journal,
+        with group commit and with an fsync per operation. Then time replaying
+        the journal into a new KB.
+    """
+    facts = synthetic_joins(n, rules)
+    operations = len(facts) + rules + retracts
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "kb.journal")
+    baseline = None
+    try:
+        for label, batch in (("no journal", None), ("batch 256", 256), ("batch 1", 1)):
+            if batch is None:
+                kb = KnowledgeBase([], [])
+            else:
+                kb = KnowledgeBase.open(path, batch=batch)
+
+            def run():
+                for item in synthetic_rules(rules):
+                    kb.kb_assert(item)
+                for item in facts:
+                    kb.kb_assert(Fact(item.statement))
+                for item in facts[:retracts]:
+                    kb.kb_retract(item)
+                kb.close()
+            seconds, _ = timed(run)
+            line = "{:<10} {} operations in {:.2f}s ({:.1f}us/op)".format(
+                label, operations, seconds, seconds / operations * 1e6)
+            if baseline is None:
+                baseline = seconds
+            else:
+                line += ", journaling {:.1f}us/op ({:+.1%}), {:.1f}MB".format(
+                    (seconds - baseline) / operations * 1e6, seconds / baseline - 1,
+                    os.path.getsize(path) / 1e6)
+                os.remove(path)
+            print(line)
+        kb = KnowledgeBase.open(path, batch=256)
+        kb.kb_assert_many(synthetic_rules(rules) + facts)
+        kb.close()
+        replayed, kb = timed(lambda: KnowledgeBase.open(path))
+        print("replayed {} facts in {:.2f}s".format(len(kb.facts), replayed))
+        kb.close()
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+        os.rmdir(directory)
+
+def bench_backward(n):
+    """Compare materializing the ancestor closure of a chain of n parent facts
+        with proving it on demand, for one query near the end of the chain
+    """
+    rules = [read.parse_input("rule: ((parent ?x ?y)) -> (ancestor ?x ?y)"),
+             read.parse_input("rule: ((ancestor ?x ?y) (parent ?y ?z)) -> (ancestor ?x ?z)")]
+    query = Fact(["ancestor", "p" + str(n - 10), "?x"])
+    for label, backward in (("eager", ()), ("backward", ["ancestor"])):
+        kb = KnowledgeBase([], [], backward=backward)
+        built, _ = timed(lambda: kb.kb_assert_many(
+            [Fact(["parent", "p" + str(i), "p" + str(i + 1)]) for i in range(n)] + rules))
+        asked, answer = timed(lambda: kb.kb_ask(query))
+        print("{:<9} built in {:.2f}s ({} facts), asked in {:.4f}s ({} answers)".format(
+            label, built, len(kb.facts), asked, len(answer)))
+
+class ListFact(object):
+    """Fact as logical_classes built it before __slots__ and interning, for
+        bench_memory: a __dict__ per object, three provenance lists, and per
+        argument a Term wrapping a Variable or Constant
+    """
+    def __init__(self, statement):
+        self.name = "fact"
+        self.statement = ListStatement(statement)
+        self.asserted = True
+        self.supported_by = []
+        self.supports_facts = []
+        self.supports_rules = []
+
+class ListStatement(object):
+    """Statement as logical_classes built it before, see ListFact
+    """
+    def __init__(self, statement_list):
+        self.predicate = statement_list[0]
+        self.terms = [ListTerm(t) for t in statement_list[1:]]
+
+class ListTerm(object):
+    """Term as logical_classes built it before, see ListFact
+    """
+    def __init__(self, term):
+        self.term = ListElement(term)
+
+class ListElement(object):
+    """Variable or Constant as logical_classes built them before, see ListFact
+    """
+    def __init__(self, element):
+        self.element = element
+
+def bench_memory(n, columnar=False):
+    """Measure the memory taken per fact by n synthetic facts, on their own and
+        once stored (and indexed) in a KB, next to the same facts built as
+        logical_classes did before __slots__ and interning (ListFact) and kept
+        in a list, as the KB did then. With columnar, the KB bulk-loads the
+        facts' keys into a ColumnarFactStore and the Fact objects are dropped.
+    """
+    tracemalloc.start()
+    facts = synthetic_facts(n)
+    created, _ = tracemalloc.get_traced_memory()
+    if columnar:
+        rows = [f.statement.key for f in facts]
+        del facts
+        kb = KnowledgeBase([], [], store=ColumnarFactStore())
+        kb.facts.load(rows)
+        del rows
+        stored, _ = tracemalloc.get_traced_memory()
+    else:
+        kb = KnowledgeBase([], [])
+        kb.kb_assert_many(facts)
+        stored, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print("{} facts: {:.0f} bytes/fact as Fact objects, {:.0f} bytes/fact in a KB, "
+          "{} interned symbols".format(n, created / n, stored / n, len(symbols)))
+
+    # the same facts, sharing the strings of the keys
+    keys = [f.statement.key for f in synthetic_facts(n)]
+    tracemalloc.start()
+    facts = [ListFact(list(key)) for key in keys]
+    created, _ = tracemalloc.get_traced_memory()
+    stored = list(facts)
+    listed, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print("{} facts: {:.0f} bytes/fact as ListFact objects, {:.0f} bytes/fact in a "
+          "list, as before".format(n, created / n, listed / n))
+
+def percentiles(samples):
+    """Summarize latencies, in milliseconds
+
+    Args:
+        samples (listof float): latencies in seconds
+
+    Returns:
+        dict: p50, p90, p99 and max, empty if there are no samples
+    """
+    if not samples:
+        return {}
+    samples = sorted(samples)
+    pick = lambda q: samples[min(len(samples) - 1, int(len(samples) * q))] * 1000
+    return {"p50": pick(0.5), "p90": pick(0.9), "p99": pick(0.99), "max": samples[-1] * 1000}
+
+def suite_workloads(scale):
+    """Build the workloads of the suite
+
+    Args:
+        scale (float): multiplies every workload's size
+
+    Returns:
+        listof (str, listof Fact|Rule, listof Fact|None): name, items to
+            assert, and facts to retract, None to retract a sample of the
+            asserted facts
+    """
+    size = lambda n: max(1, int(n * scale))
+    storm, hubs = retraction_storm(size(50000))
+    return [("deep_isa", deep_isa(size(60)), None),
+            ("wide_inst", wide_inst(size(20000)), None),
+            ("joins", scaled_kb("statements_kb5.txt", size(1000)), None),
+            ("storm", storm, hubs)]
+
+def run_workload(items, retracts, engine, asks=200, sample=200, seed=0):
+    """Measure a workload: assert its items, ask about a sample of the facts
+        inferred, then retract
+
+    Args:
+        items (listof Fact|Rule): items to assert
+        retracts (listof Fact|None): facts to retract, None for a sample of
+            the asserted facts
+        engine (type): inference engine class
+        asks (int): number of asks
+        sample (int): number of asserted facts retracted if retracts is None
+        seed (int): seed of the samples
+
+    Returns:
+        dict: assert throughput, ask latency percentiles, retract times and
+            peak memory
+    """
+    rng = random.Random(seed)
+
+    # peak memory in a separate build, tracemalloc slowing it down
+    tracemalloc.start()
+    KnowledgeBase([], [], engine()).kb_assert_many(fresh(items))
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    kb = KnowledgeBase([], [], engine())
+    loaded = fresh(items)
+    seconds, _ = timed(lambda: kb.kb_assert_many(loaded))
+    result = {"items": len(items), "facts": len(kb.facts), "rules": len(kb.rules),
+              "assert_seconds": seconds, "assert_per_second": len(items) / seconds,
+              "peak_mb": peak / 1e6}
+
+    # asks: each a stored fact with one argument, or none, replaced by a variable
+    facts = list(kb.facts)
+    latencies = []
+    for _ in range(asks):
+        key = list(rng.choice(facts).statement.key)
+        if len(key) > 1 and rng.random() < 0.75:
+            key[rng.randrange(1, len(key))] = "?x"
+        fact = Fact(key)
+        start = time.perf_counter()
+        kb.kb_ask(fact)
+        latencies.append(time.perf_counter() - start)
+    result["ask_ms"] = percentiles(latencies)
+
+    if retracts is None:
+        asserted = [f for f in facts if f.asserted]
+        retracts = rng.sample(asserted, min(sample, len(asserted)))
+    before = len(kb.facts)
+    latencies = []
+    for fact in retracts:
+        fact = Fact(fact.statement)
+        start = time.perf_counter()
+        kb.kb_retract(fact)
+        latencies.append(time.perf_counter() - start)
+    result.update({"retracts": len(retracts), "removed": before - len(kb.facts),
+                   "retract_seconds": sum(latencies), "retract_ms": percentiles(latencies)})
+    return result
+
+def regressions(results, baseline, tolerance):
+    """Compare suite results with a baseline
+
+    Args:
+        results (dict): results of bench_suite
+        baseline (dict): earlier results of bench_suite
+        tolerance (float): allowed slowdown, e.g. 0.2 for 20%
+
+    Returns:
+        listof str: one line per figure worse than the baseline by more than
+            the tolerance
+    """
+    found = []
+
+    def check(name, new, old, higher_is_better=False, floor=0.0):
+        # changes smaller than the floor are timer noise, whatever the ratio
+        if not old or abs(new - old) < floor:
+            return
+        change = (old - new) / old if higher_is_better else (new - old) / old
+        if change > tolerance:
+            found.append("{}: {:.4g} -> {:.4g} ({:+.0%})".format(name, old, new, change))
+
+    for workload, old in baseline.get("workloads", {}).items():
+        new = results["workloads"].get(workload)
+        if new is None:
+            continue
+        check(workload + " assert_per_second", new["assert_per_second"],
+              old["assert_per_second"], True)
+        for figure, floor in (("assert_seconds", 0.05), ("retract_seconds", 0.05),
+                              ("peak_mb", 1.0)):
+            check(workload + " " + figure, new[figure], old[figure], floor=floor)
+        for figure in ("ask_ms", "retract_ms"):
+            for q, floor in (("p50", 0.5), ("p99", 2.0)):
+                if q in old[figure] and q in new[figure]:
+                    check("{} {} {}".format(workload, figure, q), new[figure][q],
+                          old[figure][q], floor=floor)
+    return found
+
+def bench_suite(scale=1.0, engine="curry", output="bench_output.txt", baseline=None,
+                tolerance=0.2):
+    """Run every workload of the suite, write the results as JSON and,
+        given a baseline written by an earlier run, report regressions
+
+    Returns:
+        int: exit status, 1 if there are regressions
+    """
+    results = {"engine": engine, "scale": scale, "python": sys.version.split()[0],
+               "workloads": {}}
+    for name, items, retracts in suite_workloads(scale):
+        result = run_workload(items, retracts, ENGINES[engine])
+        results["workloads"][name] = result
+        print("{:<10} {:>8} facts  assert {:>9.0f} items/s  ask p50 {:.3f}ms p99 {:.3f}ms  "
+              "retract {} in {:.3f}s  peak {:.1f}MB".format(
+                  name, result["facts"], result["assert_per_second"],
+                  result["ask_ms"]["p50"], result["ask_ms"]["p99"], result["retracts"],
+                  result["retract_seconds"], result["peak_mb"]))
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print("results written to", output)
+    if baseline is None:
+        return 0
+    with open(baseline) as f:
+        found = regressions(results, json.load(f), tolerance)
+    for line in found:
+        print("regression:", line)
+    if not found:
+        print("no regressions beyond {:.0%}".format(tolerance))
+    return 1 if found else 0
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("benchmark", choices=["ask", "assert", "backward", "cache", "engines",
+                                              "explain", "journal", "match", "memory", "metrics",
+                                              "parallel", "parse", "query", "retract",
+                                              "shared", "snapshot", "suite"])
+    parser.add_argument("--facts", type=int, default=100000)
+    parser.add_argument("--rules", type=int, default=100)
+    parser.add_argument("--copies", type=int, default=1000)
+    parser.add_argument("--bulk", action="store_true", help="use kb_assert_many")
+    parser.add_argument("--hubs", type=int, default=10, help="hub facts to retract")
+    parser.add_argument("--depth", type=int, default=100, help="isa chain to explain")
+    parser.add_argument("--columnar", action="store_true", help="use ColumnarFactStore")
+    parser.add_argument("--scale", type=float, default=1.0, help="suite workload size")
+    parser.add_argument("--engine", choices=sorted(ENGINES), default="curry",
+                        help="suite inference engine")
+    parser.add_argument("--output", default="bench_output.txt", help="suite results file")
+    parser.add_argument("--baseline", help="suite results to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="suite slowdown reported as a regression")
+    args = parser.parse_args()
+    if args.benchmark == "ask":
+        bench_ask(args.facts, columnar=args.columnar)
+    elif args.benchmark == "assert":
+        bench_assert(args.facts, args.rules)
+    elif args.benchmark == "backward":
+        bench_backward(args.facts)
+    elif args.benchmark == "cache":
+        bench_cache(args.facts)
+    elif args.benchmark == "engines":
+        bench_engines(args.copies, args.bulk)
+    elif args.benchmark == "explain":
+        bench_explain(args.depth)
+    elif args.benchmark == "journal":
+        bench_journal(args.facts, args.rules)
+    elif args.benchmark == "match":
+        bench_match(args.facts, args.rules)
+    elif args.benchmark == "memory":
+        bench_memory(args.facts, args.columnar)
+    elif args.benchmark == "metrics":
+        bench_metrics(args.facts, args.rules)
+    elif args.benchmark == "parallel":
+        bench_parallel(args.facts, args.rules)
+    elif args.benchmark == "parse":
+        bench_parse(args.facts)
+    elif args.benchmark == "snapshot":
+        bench_snapshot(args.copies, args.facts, args.rules)
+    elif args.benchmark == "query":
+        bench_query(args.facts, columnar=args.columnar)
+    elif args.benchmark == "retract":
+        bench_retract(args.facts, args.hubs)
+    elif args.benchmark == "shared":
+        bench_shared(args.facts, args.hubs)
+    elif args.benchmark == "suite":
+        sys.exit(bench_suite(args.scale, args.engine, args.output, args.baseline,
+                             args.tolerance))
+
+if __name__ == '__main__':
+    main()
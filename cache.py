@@ -0,0 +1,169 @@
+"""LRU cache of kb_ask answers, kept up to date as facts come and go.
+
+Select it with KnowledgeBase([], [], cache=QueryCache()). kb_ask stores its
+answers under the query's canonical form (see rete.canonical), so queries that
+differ only in variable names, e.g. (inst ?x box) and (inst ?y box), share an
+entry. kb_ask and kb_ask_iter answer from the entry until a fact matching the
+query is added to or removed from the KB, which drops the entry. Entries are
+filed by predicate and arity, so a change only visits the entries that could
+match it.
+
+Queries answered by backward chaining are not cached, since their answers
+depend on facts of other predicates. Facts bulk-loaded straight into a store
+(ColumnarFactStore.load) bypass the KB, so clear() the cache after such loads.
+"""
+import sys
+from collections import OrderedDict
+from logical_classes import *
+from rete import canonical
+from util import match
+
+# estimated bytes per cached answer besides its bindings dict: the Bindings,
+# the answer tuple and the one-fact list
+ANSWER_BYTES = 168
+
+class QueryCache(object):
+    """Bounded LRU cache of query answers
+
+    Attributes:
+        max_entries (int): most queries kept
+        max_bytes (int): most memory kept, as estimated by sys.getsizeof
+        entries (OrderedDict): maps canonical query keys to (statement,
+            names, answers, size), least recently used first: the query that
+            filled the entry, its map from canonical to its own variable
+            names, its answers and their estimated size
+        heads (dictof set): maps (predicate, arity) to the keys of the
+            entries for queries on it
+        size (int): estimated bytes held by the entries
+        hits, misses, evictions, invalidations (int): counters, see stats()
+    """
+    def __init__(self, max_entries=1024, max_bytes=64 * 1024 * 1024):
+        """Constructor for QueryCache
+
+        Args:
+            max_entries (int): most queries kept
+            max_bytes (int): most memory kept, estimated
+        """
+        super(QueryCache, self).__init__()
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.heads = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __repr__(self):
+        """Define internal string representation
+        """
+        return 'QueryCache({!r}, {!r})'.format(self.max_entries, self.max_bytes)
+
+    def __len__(self):
+        """Define behavior of len, the number of cached queries
+        """
+        return len(self.entries)
+
+    def get(self, statement):
+        """Get the cached answers of a query, counting a hit or a miss
+
+        Args:
+            statement (Statement): query
+
+        Returns:
+            listof (Bindings, listof Fact)|None: answers as kb_ask_iter yields
+                them, with the query's variable names, None if not cached.
+                They are shared with the cache, so must not be modified.
+        """
+        key, names = canonical(statement)
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        if names == entry[1]:
+            return entry[2]
+        # same query with other variable names: rename the bindings
+        renamed = dict((entry[1][k], v) for k, v in names.items())
+        answers = []
+        for bindings, facts in entry[2]:
+            copied = Bindings()
+            copied.bindings_dict = dict((renamed.get(var, var), value)
+                                        for var, value in bindings.bindings_dict.items())
+            answers.append((copied, facts))
+        return answers
+
+    def put(self, statement, answers):
+        """Cache the answers of a query, evicting the least recently used
+            entries beyond the bounds
+
+        Args:
+            statement (Statement): query
+            answers (listof (Bindings, listof Fact)): all its answers, which
+                the cache keeps and hands out again as they are
+        """
+        key, names = canonical(statement)
+        size = sys.getsizeof(key) + sys.getsizeof(answers)
+        if answers:
+            # answers to one query all bind the same variables
+            size += len(answers) * (sys.getsizeof(answers[0][0].bindings_dict) + ANSWER_BYTES)
+        if size > self.max_bytes:
+            return
+        self.discard(key)
+        self.entries[key] = (statement, names, answers, size)
+        self.heads.setdefault((key[0], len(key) - 1), set()).add(key)
+        self.size += size
+        while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+            self.discard(next(iter(self.entries)))
+            self.evictions += 1
+
+    def changed(self, fact):
+        """Drop the entries of the queries a fact matches, after it was added
+            to or removed from the KB
+
+        Args:
+            fact (Fact): fact added or removed
+        """
+        key = fact.statement.key
+        head = (key[0], len(key) - 1)
+        if head not in self.heads:
+            return
+        for cached in list(self.heads[head]):
+            if match(self.entries[cached][0], fact.statement):
+                self.discard(cached)
+                self.invalidations += 1
+
+    def discard(self, key):
+        """Drop an entry, if cached
+
+        Args:
+            key (tuple): canonical query key
+        """
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        self.size -= entry[3]
+        head = (key[0], len(key) - 1)
+        self.heads[head].discard(key)
+        if not self.heads[head]:
+            del self.heads[head]
+
+    def clear(self):
+        """Drop every entry
+        """
+        self.entries.clear()
+        self.heads.clear()
+        self.size = 0
+
+    def stats(self):
+        """Get the cache's counters
+
+        Returns:
+            dict: entries, bytes (estimated), hits, misses, evictions and
+                invalidations
+        """
+        return {"entries": len(self.entries), "bytes": self.size, "hits": self.hits,
+                "misses": self.misses, "evictions": self.evictions,
+                "invalidations": self.invalidations}
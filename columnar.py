@@ -0,0 +1,357 @@
+"""Columnar storage for ground facts, an alternative to index.FactStore.
+
+Select it with KnowledgeBase([], [], store=ColumnarFactStore()). Ground facts
+are kept per (predicate, arity) relation as columns of interned symbol ids in
+`array`s, instead of one Fact object with nested Terms each. Facts bulk-loaded
+with ColumnarFactStore.load() exist only as column entries until a query, rule
+or kb_add touches them; the matching rows are then materialized as Fact objects.
+Those are only held weakly: a fact that gains provenance is referenced by the
+facts, rules or engine nodes it is linked to and so stays, while one a query
+returned goes once the caller drops it, and the row is column entries again.
+
+Constant filters run as column scans: vectorized with NumPy when it is
+installed, otherwise through per-column postings built the first time a column
+is filtered on. Facts that contain variables are kept by the FactStore base.
+"""
+import weakref
+from array import array
+from itertools import chain
+from index import FactStore
+from logical_classes import *
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+class Relation(object):
+    """Ground facts sharing a predicate and arity, stored column-wise
+
+    Attributes:
+        predicate (str): predicate of the relation
+        columns (listof array): for each argument position, the symbol id of
+            the argument of each row, -1 in the first column for deleted rows
+        facts (listof Fact|None): Fact of each row added as a Fact object,
+            None for rows loaded as ids
+        materialized (WeakValueDictionary): maps row numbers to the Facts
+            materialized for rows loaded as ids, while they are in use
+        rows (dictof int): maps the tuple of argument ids of each live row to it
+        postings (dictof dict): for each argument position filtered on so far,
+            maps argument ids to the array of rows holding them
+        deleted (int): number of deleted rows
+    """
+    def __init__(self, predicate, arity):
+        """Constructor for Relation
+
+        Args:
+            predicate (str): predicate of the relation
+            arity (int): number of arguments, at least 1
+        """
+        super(Relation, self).__init__()
+        self.predicate = predicate
+        self.columns = [array('q') for _ in range(arity)]
+        self.facts = []
+        self.materialized = weakref.WeakValueDictionary()
+        self.rows = {}
+        self.postings = {}
+        self.deleted = 0
+
+    def __len__(self):
+        """Define behavior of len, the number of live rows
+        """
+        return len(self.rows)
+
+    def append(self, ids, fact=None):
+        """Add a row, a no-op if it is already stored
+
+        Args:
+            ids (tupleof int): symbol ids of the arguments
+            fact (Fact|None): Fact of the row, None to materialize it later
+
+        Returns:
+            bool: whether the row was added
+        """
+        if ids in self.rows:
+            return False
+        row = len(self.facts)
+        self.rows[ids] = row
+        self.facts.append(fact)
+        for pos, id in enumerate(ids):
+            self.columns[pos].append(id)
+            if pos in self.postings:
+                self.postings[pos].setdefault(id, array('q')).append(row)
+        return True
+
+    def delete(self, ids):
+        """Delete the row with the given argument ids, compacting the columns
+            once deleted rows make up most of them
+
+        Args:
+            ids (tupleof int): symbol ids of the arguments
+        """
+        row = self.rows.pop(ids)
+        self.columns[0][row] = -1
+        self.facts[row] = None
+        self.materialized.pop(row, None)
+        self.deleted += 1
+        if self.deleted > len(self.rows):
+            self.compact()
+
+    def compact(self):
+        """Drop deleted rows, renumbering the remaining ones
+        """
+        live = [(ids, self.facts[row], self.materialized.get(row)) for ids, row in
+                sorted(self.rows.items(), key=lambda item: item[1])]
+        self.columns = [array('q') for _ in self.columns]
+        self.facts = []
+        self.materialized = weakref.WeakValueDictionary()
+        self.rows = {}
+        positions = list(self.postings)
+        self.postings = dict((pos, {}) for pos in positions)
+        self.deleted = 0
+        for ids, fact, materialized in live:
+            self.append(ids, fact)
+            if materialized is not None:
+                self.materialized[len(self.facts) - 1] = materialized
+
+    def fact(self, row):
+        """Get the Fact of a row, materializing it if needed. The same Fact is
+            returned for as long as it is in use.
+
+        Args:
+            row (int): row number
+
+        Returns:
+            Fact
+        """
+        fact = self.facts[row]
+        if fact is None:
+            fact = self.materialized.get(row)
+            if fact is None:
+                if not self.materialized:
+                    # dicts never shrink: drop the table a large answer left
+                    self.materialized = weakref.WeakValueDictionary()
+                fact = Fact([self.predicate] + [symbols.name(c[row]) for c in self.columns])
+                self.materialized[row] = fact
+        return fact
+
+    def select(self, constants):
+        """Get the live rows matching constant filters, in insertion order.
+            Without NumPy the rows are found as they are iterated over.
+
+        Args:
+            constants (listof (int, int)): (position, symbol id) filters
+
+        Returns:
+            iterable of int: row numbers
+        """
+        first = self.columns[0]
+        if not constants:
+            return (row for row in range(len(first)) if first[row] >= 0)
+        if numpy is not None:
+            mask = numpy.frombuffer(self.columns[0], dtype=numpy.int64) >= 0
+            for pos, id in constants:
+                mask &= numpy.frombuffer(self.columns[pos], dtype=numpy.int64) == id
+            return numpy.flatnonzero(mask).tolist()
+        postings = [(self.posting(pos, id), pos, id) for pos, id in constants]
+        rows, _, _ = min(postings, key=lambda p: len(p[0]))
+        return (row for row in rows if first[row] >= 0 and
+                all(self.columns[pos][row] == id for _, pos, id in postings))
+
+    def posting(self, pos, id):
+        """Get the rows whose argument at pos has the given id, building the
+            postings of that column on first use
+
+        Args:
+            pos (int): argument position, from 0
+            id (int): symbol id
+
+        Returns:
+            array|tuple of int: row numbers, possibly including deleted rows
+        """
+        if pos not in self.postings:
+            postings = self.postings[pos] = {}
+            for row, value in enumerate(self.columns[pos]):
+                postings.setdefault(value, array('q')).append(row)
+        return self.postings[pos].get(id, ())
+
+    def values(self, pos):
+        """Count the distinct ids in a column, building its postings on first
+            use. Values only deleted rows held are still counted.
+
+        Args:
+            pos (int): argument position, from 0
+
+        Returns:
+            int: number of distinct ids
+        """
+        self.posting(pos, -1)
+        return len(self.postings[pos])
+
+class ColumnarFactStore(FactStore):
+    """FactStore keeping ground facts in column-wise Relations. Unlike the
+        FactStore, it does not iterate in insertion order: facts come grouped
+        by relation, in the order the relations were created, then the facts
+        kept by the FactStore base.
+
+    Attributes:
+        relations (dictof Relation): maps (predicate, arity) to the relation
+            holding its ground facts
+    """
+    def __init__(self, items=[]):
+        """Constructor for ColumnarFactStore
+
+        Args:
+            items (listof Fact): initial contents of the store
+        """
+        self.relations = {}
+        super(ColumnarFactStore, self).__init__(items)
+
+    def _locate(self, statement, create=False):
+        """Relation and argument ids of a statement, or None if the statement
+            is not ground or has no arguments and so is kept by the FactStore,
+            or, unless create, if no fact with its predicate and arity is
+            stored in a relation
+
+        Args:
+            statement (Statement): statement to locate
+            create (bool): whether to create the relation if it does not exist
+        """
+        terms = statement.terms
+        if not terms or any(t.term.element[0] == "?" for t in terms):
+            return None
+        head = (statement.predicate, len(terms))
+        if head not in self.relations:
+            if not create:
+                return None
+            self.relations[head] = Relation(statement.predicate, len(terms))
+        return self.relations[head], tuple(t.id for t in terms)
+
+    def __iter__(self):
+        """Iterate over every stored fact, materializing them all
+        """
+        for relation in list(self.relations.values()):
+            for row in list(relation.select([])):
+                yield relation.fact(row)
+        for fact in list(self.items):
+            yield fact
+
+    def __len__(self):
+        """Define behavior of len, the number of stored facts
+        """
+        return len(self.items) + sum(len(r) for r in self.relations.values())
+
+    def __getitem__(self, index):
+        """Positional access, in iteration order, kept for code written
+            against the old list storage. This materializes every fact.
+        """
+        return list(self)[index]
+
+    def __contains__(self, item):
+        """Define behavior of `in`, without materializing anything
+        """
+        located = self._locate(item.statement)
+        if located is None:
+            return item in self.items
+        relation, ids = located
+        return ids in relation.rows
+
+    def get(self, item):
+        """Get the stored fact equal to the argument, materializing it
+        """
+        located = self._locate(item.statement)
+        if located is None:
+            return self.items.get(item)
+        relation, ids = located
+        row = relation.rows.get(ids)
+        return None if row is None else relation.fact(row)
+
+    def add(self, item):
+        """Add a fact to the store, in a relation if it is ground
+        """
+        located = self._locate(item.statement, True)
+        if located is None:
+            super(ColumnarFactStore, self).add(item)
+        else:
+            relation, ids = located
+            relation.append(ids, item)
+
+    def remove(self, item):
+        """Remove the stored fact equal to the argument
+
+        Raises:
+            KeyError: if no equal fact is stored
+        """
+        located = self._locate(item.statement)
+        if located is None:
+            super(ColumnarFactStore, self).remove(item)
+        else:
+            relation, ids = located
+            relation.delete(ids)
+
+    def load(self, rows):
+        """Bulk-load asserted ground facts without creating Fact objects. No
+            inference is run on them, so load facts before asserting the rules
+            that use them: rules added later are matched against them as usual.
+
+        Args:
+            rows (iterable of listof str): facts as [predicate, arg1, arg2, ...]
+
+        Returns:
+            int: number of new facts
+        """
+        added = 0
+        for row in rows:
+            head = (row[0], len(row) - 1)
+            if head not in self.relations:
+                self.relations[head] = Relation(symbols.name(symbols.intern(row[0])), len(row) - 1)
+            added += self.relations[head].append(tuple(symbols.intern(a) for a in row[1:]))
+        return added
+
+    def count(self, statement):
+        """Estimate how many stored facts match a statement, from the rows of
+            the rarest of its constants
+        """
+        found = len(super(ColumnarFactStore, self).candidates(statement))
+        relation = self.relations.get((statement.predicate, len(statement.terms)))
+        if relation is None:
+            return found
+        rows = len(relation)
+        for pos, t in enumerate(statement.terms):
+            if not t.var:
+                id = symbols.ids.get(t.term.element)
+                if id is None:
+                    return found
+                rows = min(rows, len(relation.posting(pos, id)))
+        return found + rows
+
+    def values(self, predicate, arity, pos):
+        """Count the distinct constants stored facts have at an argument position
+        """
+        distinct = super(ColumnarFactStore, self).values(predicate, arity, pos)
+        relation = self.relations.get((predicate, arity))
+        return distinct if relation is None else distinct + relation.values(pos - 1)
+
+    def candidates(self, statement):
+        """Get the stored facts that could match a statement, filtering ground
+            facts by the statement's constants with a column scan. Selected
+            rows are materialized as they are iterated over.
+
+        Args:
+            statement (Statement): statement to look up, may contain variables
+
+        Returns:
+            iterable of Fact: candidate facts
+        """
+        found = list(super(ColumnarFactStore, self).candidates(statement))
+        relation = self.relations.get((statement.predicate, len(statement.terms)))
+        if relation is None:
+            return found
+        constants = []
+        for pos, t in enumerate(statement.terms):
+            if t.term.element[0] != "?":
+                id = symbols.ids.get(t.term.element)
+                if id is None:
+                    return found
+                constants.append((pos, id))
+        return chain((relation.fact(row) for row in relation.select(constants)), found)
@@ -0,0 +1,183 @@
+"""Rules compiled into Python functions, for InferenceEngine.fc_infer.
+
+fc_infer matches a fact against rule.lhs[0] and instantiates the rest of the
+rule with the bindings. Done generically, that is a loop testing every term
+for a variable, a bindings dict, and a second loop per statement to
+substitute it. A compiled rule is a function generated for the rule's shape,
+with the positions of its variables and constants written into the code:
+
+    ((inst ?x ?y) (isa ?y ?z)) -> (inst ?x ?z)
+
+becomes, roughly,
+
+    def step(s):
+        if s.predicate != K0: return None
+        t = s.terms
+        if len(t) != 2: return None
+        v0 = t[0]
+        if v0.var: return slow(s)
+        v1 = t[1]
+        if v1.var: return slow(s)
+        return [Statement([K1, v1, K2])], Statement([K3, v0, K2])
+
+where the K are the rule's predicates, constants and unbound variables, passed
+in as arguments. Curried rules differ from their parent only in constants, so
+they share its shape: the code of each shape is generated and exec'd once,
+and each rule gets a closure over its own constants. Facts that contain
+variables take the generic path (slow), which gives the same result.
+"""
+from logical_classes import *
+from util import match, instantiate
+
+class RuleCompiler(object):
+    """Compiles rules, caching code per shape and functions per rule
+
+    Attributes:
+        shapes (dictof function): maps rule shapes to the factory exec'd for
+            them, which takes the rule's constants and returns its function
+        rules (dictof function): maps rules to their compiled functions
+        max_rules (int): most functions kept; the cache is cleared beyond
+    """
+    def __init__(self, max_rules=65536):
+        """Constructor for RuleCompiler
+
+        Args:
+            max_rules (int): most compiled functions kept
+        """
+        super(RuleCompiler, self).__init__()
+        self.shapes = {}
+        self.rules = {}
+        self.max_rules = max_rules
+
+    def __repr__(self):
+        """Define internal string representation
+        """
+        return 'RuleCompiler({!r})'.format(self.max_rules)
+
+    def get(self, rule):
+        """Get a rule's compiled function, compiling it if needed
+
+        Args:
+            rule (Rule): rule to compile
+
+        Returns:
+            function: takes a fact's statement and returns None if it does not
+                match rule.lhs[0], else the rest of the LHS and the RHS
+                instantiated with the bindings, as (listof Statement, Statement)
+        """
+        step = self.rules.get(rule)
+        if step is None:
+            if len(self.rules) >= self.max_rules:
+                self.rules.clear()
+            shape, constants = _shape(rule)
+            factory = self.shapes.get(shape)
+            if factory is None:
+                factory = self.shapes[shape] = _generate(shape)
+            step = factory(lambda s: _slow(rule, s), Statement, *constants)
+            self.rules[rule] = step
+        return step
+
+    def discard(self, rule):
+        """Forget a rule's compiled function, if any, once the rule is removed
+            from the KB. The function refers to the rule, so keeping it would
+            keep the rule.
+
+        Args:
+            rule (Rule): rule removed
+        """
+        self.rules.pop(rule, None)
+
+def _shape(rule):
+    """Split a rule into its shape and its constants
+
+    Args:
+        rule (Rule): rule to split
+
+    Returns:
+        (tuple, listof str|Term): the shape: for lhs[0] a tuple per position,
+            ('v', k) for the first occurrence of the k-th variable, ('r', k)
+            for a repeat, ('c', j) for constants[j]; for the other statements
+            and the RHS a tuple per position, ('v', k) for a variable bound by
+            lhs[0], ('c', j) otherwise. Predicates are constants too.
+    """
+    constants = []
+
+    def constant(value):
+        constants.append(value)
+        return ('c', len(constants) - 1)
+
+    names = {}
+    first = [constant(rule.lhs[0].predicate)]
+    for t in rule.lhs[0].terms:
+        if not t.var:
+            first.append(constant(t))
+        elif t.term.element in names:
+            first.append(('r', names[t.term.element]))
+        else:
+            names[t.term.element] = len(names)
+            first.append(('v', names[t.term.element]))
+    rest = []
+    for statement in rule.lhs[1:] + [rule.rhs]:
+        shape = [constant(statement.predicate)]
+        for t in statement.terms:
+            if t.var and t.term.element in names:
+                shape.append(('v', names[t.term.element]))
+            else:
+                shape.append(constant(t))
+        rest.append(tuple(shape))
+    return (tuple(first), tuple(rest)), constants
+
+def _generate(shape):
+    """Generate and exec the factory of a rule shape
+
+    Args:
+        shape (tuple): as returned by _shape
+
+    Returns:
+        function: factory taking (slow, Statement, *constants)
+    """
+    first, rest = shape
+    count = max([c[1] for c in first + sum(rest, ()) if c[0] == 'c']) + 1
+    lines = ["def make(slow, Statement, {}):".format(
+                 ", ".join("K" + str(j) for j in range(count))),
+             "    def step(s):",
+             "        if s.predicate != K{}:".format(first[0][1]),
+             "            return None",
+             "        t = s.terms",
+             "        if len(t) != {}:".format(len(first) - 1),
+             "            return None"]
+    for pos, (kind, k) in enumerate(first[1:]):
+        if kind == 'v':
+            lines += ["        v{} = t[{}]".format(k, pos),
+                      "        if v{}.var:".format(k),
+                      "            return slow(s)"]
+        else:
+            lines += ["        if t[{}] is not {}{}:".format(pos, "v" if kind == 'r' else "K", k),
+                      "            return slow(s) if t[{}].var else None".format(pos)]
+
+    # statements are built without Statement.__init__, whose terms here are
+    # already Terms and its predicate already interned
+    built = []
+    for i, statement in enumerate(rest):
+        lines += ["        s{} = new(Statement)".format(i),
+                  "        s{}.predicate = K{}".format(i, statement[0][1]),
+                  "        s{}.terms = ({})".format(i, "".join(
+                      ("v" if kind == 'v' else "K") + str(k) + ", " for kind, k in statement[1:])),
+                  "        s{0}._key = s{0}._hash = None".format(i)]
+        built.append("s" + str(i))
+    lines += ["        return [{}], {}".format(", ".join(built[:-1]), built[-1]),
+              "    return step"]
+    namespace = {"new": object.__new__}
+    exec(compile("\n".join(lines), "<rule shape>", "exec"), namespace)
+    return namespace["make"]
+
+def _slow(rule, statement):
+    """Match a statement against rule.lhs[0] and instantiate the rest of the
+        rule generically, as fc_infer did before rules were compiled
+
+    Returns: as RuleCompiler.get's functions
+    """
+    bindings = match(statement, rule.lhs[0])
+    if not bindings:
+        return None
+    return [instantiate(s, bindings) for s in rule.lhs[1:]], instantiate(rule.rhs, bindings)
@@ -0,0 +1,164 @@
+"""Semi-naive bottom-up evaluation, an alternative to student_code.InferenceEngine.
+
+Select it with KnowledgeBase([], [], SemiNaiveEngine()). Rules are treated as
+Datalog clauses: instead of joining one LHS statement per step through curried
+rules, every iteration evaluates each rule's whole LHS as a multi-way join over
+the KB's indexed facts, and only joins that use at least one fact new since the
+previous iteration (the delta). Derived facts get the same Token provenance
+rete.ReteEngine builds, so kb_retract works unchanged.
+"""
+from logical_classes import *
+from rete import Token, substitute
+from util import match
+
+class SemiNaiveEngine(object):
+    """Forward chaining by semi-naive iteration to a fixpoint
+
+    Attributes:
+        rules (listof Rule): rules already evaluated against the facts
+        new_rules (listof Rule): rules added since the last iteration
+        positions (dictof list): maps (predicate, arity) to the (rule, i) pairs
+            of the rules in self.rules whose lhs[i] has that predicate and arity
+        delta (listof Fact): facts added since the last iteration
+        tokens (dictof Token): maps (rule, facts) to the token for that partial
+            match, shared by every derivation extending it
+    """
+    def __init__(self):
+        """Constructor for SemiNaiveEngine
+        """
+        self.rules = []
+        self.new_rules = []
+        self.positions = {}
+        self.delta = []
+        self.tokens = {}
+
+    def fact_added(self, fact, kb):
+        """Collect a fact just added to the KB into the next delta
+        """
+        self.delta.append(fact)
+
+    def rule_added(self, rule, kb):
+        """Collect a rule just added to the KB for the next iteration
+        """
+        self.new_rules.append(rule)
+
+    def restored(self, tokens, kb):
+        """Take over the rules and tokens of a KB loaded from a snapshot, as
+            already evaluated
+
+        Args:
+            tokens (listof Token) - the tokens of the snapshot
+            kb (KnowledgeBase) - A KnowledgeBase
+        """
+        for rule in kb.rules:
+            self._register(rule)
+        for token in tokens:
+            self.tokens[(token.rule, token.facts)] = token
+
+    def fact_removed(self, fact, kb):
+        """Hook called after a fact is removed from the KB. Tokens holding the
+            fact are discarded by kb_retract's cascade, so nothing to do here.
+        """
+        pass
+
+    def rule_removed(self, rule, kb):
+        """Hook called after a rule is removed from the KB. Only inferred rules
+            are ever removed, and this engine infers none, so nothing to do.
+        """
+        pass
+
+    def discard(self, token, kb):
+        """Forget a token that lost its support
+        """
+        key = (token.rule, token.facts)
+        if self.tokens.get(key) is token:
+            del self.tokens[key]
+
+    def flush(self, kb):
+        """Run one semi-naive iteration: join the delta with the facts known
+            before it for the old rules, and evaluate new rules in full.
+            Derived facts are added to the KB and make up the next delta.
+
+        Args:
+            kb (KnowledgeBase) - A KnowledgeBase
+        """
+        delta = [f for f in self.delta if kb._get_fact(f) is f]
+        new_rules = self.new_rules
+        self.delta = []
+        self.new_rules = []
+        fresh = set(delta)
+        for fact in delta:
+            key = fact.statement.key
+            for rule, i in self.positions.get((key[0], len(key) - 1), ()):
+                found = match(rule.lhs[i], fact.statement)
+                if found:
+                    # before i only old facts, after i old or new ones, so
+                    # each combination is joined once
+                    chosen = {i: fact}
+                    self._join(rule, i, 0, chosen, found.bindings_dict, fresh, kb)
+        for rule in new_rules:
+            self._register(rule)
+            self._join(rule, None, 0, {}, {}, set(), kb)
+
+    def _register(self, rule):
+        """Index a rule's LHS positions so later deltas are joined with it
+        """
+        self.rules.append(rule)
+        for i, statement in enumerate(rule.lhs):
+            key = statement.key
+            self.positions.setdefault((key[0], len(key) - 1), []).append((rule, i))
+
+    def _join(self, rule, delta_at, j, chosen, bindings, fresh, kb):
+        """Nested-loop index join over rule.lhs[j:], skipping the delta position
+
+        Args:
+            delta_at (int|None): position already bound to a delta fact
+            j (int): next LHS position to bind
+            chosen (dictof Fact): facts bound so far, by LHS position
+            bindings (dictof str): variable bindings so far
+            fresh (setof Fact): the delta, excluded from positions before delta_at
+        """
+        if j == delta_at:
+            j += 1
+        if j == len(rule.lhs):
+            self._derive(rule, [chosen[k] for k in range(j)], bindings, kb)
+            return
+        pattern = substitute(rule.lhs[j], bindings)
+        for fact in list(kb.facts.candidates(pattern)):
+            if fact in kb.pending or (delta_at is not None and j < delta_at and fact in fresh):
+                continue
+            found = match(pattern, fact.statement)
+            if found:
+                merged = dict(bindings)
+                merged.update(found.bindings_dict)
+                chosen[j] = fact
+                self._join(rule, delta_at, j + 1, chosen, merged, fresh, kb)
+                del chosen[j]
+
+    def _derive(self, rule, facts, bindings, kb):
+        """Add the RHS of a complete match to the KB, supported by the chain of
+            tokens for the match's prefixes
+        """
+        parent = rule
+        for k in range(1, len(facts)):
+            key = (rule, tuple(facts[:k]))
+            token = self.tokens.get(key)
+            if token is None:
+                bound = set(e for s in rule.lhs[:k] for e in s.key[1:])
+                prefix = dict((v, bindings[v]) for v in bindings if v in bound)
+                token = Token(rule, key[1], prefix, [(facts[k - 1], parent)])
+                self.tokens[key] = token
+                facts[k - 1].supports_rules.append(token)
+                parent.supports_rules.append(token)
+            parent = token
+        fact = facts[-1]
+        new_fact = Fact(substitute(rule.rhs, bindings), [(fact, parent)])
+        kb_fact = kb._get_fact(new_fact)
+        if kb_fact is None:
+            fact.supports_facts.append(new_fact)
+            parent.supports_facts.append(new_fact)
+            kb.kb_add(new_fact)
+        elif (fact, parent) not in kb_fact.supported_by:
+            kb_fact.supported_by.append((fact, parent))
+            fact.supports_facts.append(kb_fact)
+            parent.supports_facts.append(kb_fact)
@@ -0,0 +1,423 @@
+"""Proofs of stored facts and rules, read off their provenance, see Explainer.
+
+A fact or rule in the KB is either asserted or supported by (fact, rule)
+pairs, each of which it was inferred from. Following the pairs down to
+asserted facts and rules gives a proof tree. Each support pair of the node
+explained ends a proof of its own; the members of the pair are proved in
+one of two ways:
+
+    - by their first derivation: at each step, the first pair recorded that
+      leads to asserted nodes without a cycle. A node's first pair was
+      recorded when it was inferred, from nodes stored before it, so this
+      walks little more than the proof itself.
+    - by a proof of least height. The support graph may be cyclic, e.g.
+      through a symmetric rule, so these are built bottom-up: starting from
+      the asserted leaves, each node's height is the least, over its pairs
+      whose members both have one, of one more than the greater of theirs,
+      as in Dijkstra's algorithm. This takes time proportional to the part
+      of the graph the node is inferred from, all of it, the first time.
+
+Both are remembered until the KB changes, so asking about a fact whose
+proof shares subproofs with one already built only builds the rest, and a
+proof's subproofs are the same Proof objects wherever they occur. A
+remembered proof of a pair member may go through the node explained, as it
+was built for another; that member is then proved again without the node,
+and the proof kept for this node only.
+"""
+import gc
+from logical_classes import *
+from util import factq
+from metrics import _label
+
+class Proof(object):
+    """A proof tree of a fact or rule
+
+    Attributes:
+        item (Fact|Rule|other): fact, rule or engine node (e.g. rete.Token)
+            proved
+        premises (tupleof Proof): proofs of the (fact, rule) pair it was
+            inferred from, empty if it is asserted
+        height (int): number of inference steps from the proof's deepest
+            asserted leaf, 0 if it is asserted
+    """
+    def __init__(self, item, premises=()):
+        """Constructor for Proof
+
+        Args:
+            item (Fact|Rule|other): node proved
+            premises (tupleof Proof): proofs of its support pair, if any
+        """
+        super(Proof, self).__init__()
+        self.item = item
+        self.premises = tuple(premises)
+        self.height = 1 + max(p.height for p in self.premises) if self.premises else 0
+
+    def __repr__(self):
+        """Define internal string representation
+        """
+        return 'Proof({!r}, {!r})'.format(self.item, self.premises)
+
+    def __str__(self):
+        """Define external representation when printed: one line per step,
+            premises indented under what they prove. A subproof met again
+            is written once, then referred to.
+        """
+        lines = []
+        shown = set()
+        stack = [(self, 0)]
+        while stack:
+            proof, depth = stack.pop()
+            line = "    " * depth + proof.item.name + ": " + _describe(proof.item)
+            if proof.premises and id(proof) in shown:
+                lines.append(line + " (as above)")
+                continue
+            shown.add(id(proof))
+            lines.append(line if proof.premises else line + " (asserted)")
+            for premise in reversed(proof.premises):
+                stack.append((premise, depth + 1))
+        return "\n".join(lines)
+
+    def leaves(self):
+        """Get the asserted facts and rules the proof rests on
+
+        Returns:
+            listof Fact|Rule: each once, in the order they are written
+        """
+        found = []
+        seen = set()
+        stack = [self]
+        while stack:
+            proof = stack.pop()
+            if id(proof) in seen:
+                continue
+            seen.add(id(proof))
+            if not proof.premises:
+                found.append(proof.item)
+            stack.extend(reversed(proof.premises))
+        return found
+
+class Explainer(object):
+    """Builds proofs of a KB's facts and rules, remembering them until the
+        KB changes
+
+    Attributes:
+        kb (KnowledgeBase): KB whose provenance is read
+        heights (dictof tuple): maps id(node) to (height, support pair) of
+            its proof of least height, pair None if it is asserted, height
+            None if it has no proof
+        proofs (dictof Proof): maps id(node) to its proof of least height
+        first (dictof Proof): maps id(node) to its proof through the first
+            derivations recorded
+    """
+    def __init__(self, kb):
+        """Constructor for Explainer
+
+        Args:
+            kb (KnowledgeBase): KB to explain
+        """
+        super(Explainer, self).__init__()
+        self.kb = kb
+        self.heights = {}
+        self.proofs = {}
+        self.first = {}
+
+    def invalidate(self):
+        """Forget every proof, after the KB's facts, rules or provenance
+            changed
+        """
+        if self.heights or self.first:
+            self.heights = {}
+            self.proofs = {}
+            self.first = {}
+
+    def explain(self, node, max_depth=None, max_proofs=1, shortest=False):
+        """Get proofs of a stored fact or rule, see KnowledgeBase.kb_explain
+
+        Args:
+            node (Fact|Rule|other): node stored in the KB
+            max_depth (int|None): greatest height of the proofs returned
+            max_proofs (int): most proofs returned
+            shortest (bool): prove the pairs' members in the fewest steps and
+                order the proofs by height, rather than follow the first
+                derivations in the order they were inferred
+
+        Returns:
+            listof Proof
+        """
+        if max_proofs <= 0:
+            return []
+        # the node itself may be proved in several ways, one per pair; below
+        # it, each pair member has a single proof
+        found = []
+        if node.asserted and (max_depth is None or max_depth >= 0):
+            found.append(Proof(node))
+        for pair in node.supported_by:
+            if not shortest and len(found) >= max_proofs:
+                break
+            if pair[0] is node or pair[1] is node:
+                # supports itself, e.g. through ((r ?x)) -> (r ?x)
+                continue
+            if shortest:
+                premises = [self._least(member) for member in pair]
+            else:
+                premises = [self._first(member, node) for member in pair]
+            if None in premises:
+                continue
+            if any(_uses(p, node) for p in premises):
+                # remembered proofs, built for another node, may go through
+                # this one: prove the pair again without it
+                if shortest:
+                    heights, proofs = {id(node): (None, None)}, {}
+                    premises = [self._least(member, heights, proofs) for member in pair]
+                else:
+                    first = _Avoiding(self.first, node)
+                    premises = [self._first(member, node, first) for member in pair]
+                if None in premises:
+                    continue
+            proof = Proof(node, premises)
+            if max_depth is None or proof.height <= max_depth:
+                found.append(proof)
+        if shortest:
+            found.sort(key=lambda proof: proof.height)
+        return found[:max_proofs]
+
+    def _first(self, target, root, first=None):
+        """Get the proof of a node following, at each step, the first support
+            pair recorded that leads to asserted nodes without a cycle. The
+            first pair of a node was recorded when it was inferred, from
+            nodes stored before it, so this is usually the first one tried.
+
+        Args:
+            target (Fact|Rule|other): node to prove
+            root (Fact|Rule|other): node being explained, never used to prove
+                target
+            first (dictof Proof|None): proofs to reuse and to add the ones
+                built to, self.first if None
+
+        Returns:
+            Proof|None: None if target is root or every pair leads back to it
+        """
+        if target is root:
+            return None
+        if first is None:
+            first = self.first
+        if id(target) in first:
+            return first[id(target)]
+        # a frame per node on the path: [node, its pairs left to try, pair
+        # being proved]; a child that fails abandons its parent's pair
+        frames = [[target, None, None]]
+        path = set([id(root), id(target)])
+        while frames:
+            frame = frames[-1]
+            node, pairs, pair = frame
+            proof = None
+            if node.asserted:
+                proof = Proof(node)
+            elif pair is not None:
+                pending = [m for m in pair if id(m) not in first]
+                if not pending:
+                    proof = Proof(node, [first[id(m)] for m in pair])
+                else:
+                    path.add(id(pending[0]))
+                    frames.append([pending[0], None, None])
+                    continue
+            if proof is None:
+                if pairs is None:
+                    pairs = frame[1] = iter(node.supported_by)
+                for pair in pairs:
+                    if id(pair[0]) not in path and id(pair[1]) not in path:
+                        frame[2] = pair
+                        break
+                else:
+                    frames.pop()
+                    path.discard(id(node))
+                    if not frames:
+                        return None
+                    frames[-1][2] = None
+                continue
+            first[id(node)] = proof
+            frames.pop()
+            path.discard(id(node))
+        return first[id(target)]
+
+    def _least(self, node, heights=None, proofs=None):
+        """Get the proof of least height of a node
+
+        Args:
+            node (Fact|Rule|other): node to prove
+            heights, proofs (dict|None): heights and proofs to reuse and to
+                add the ones found to, self.heights and self.proofs if None.
+                Nodes given no height there are not used.
+
+        Returns:
+            Proof|None: None if it has none
+        """
+        if heights is None:
+            heights, proofs = self.heights, self.proofs
+        self._solve(node, heights)
+        if heights[id(node)][0] is None:
+            return None
+        return self._proof(node, heights, proofs)
+
+    def _solve(self, target, heights):
+        """Find the proof of least height of a node and of every node it is
+            inferred from, unless already known
+        """
+        if id(target) in heights:
+            return
+        # the walk only allocates, so pause the cyclic garbage collector
+        # rather than have it rescan the KB, as kb_assert_many does
+        collecting = gc.isenabled()
+        gc.disable()
+        try:
+            self._settle(target, heights)
+        finally:
+            if collecting:
+                gc.enable()
+
+    def _settle(self, target, heights):
+        """INTERNAL USE ONLY
+        Collect the nodes without a known height a node is inferred from,
+        then settle them lowest first. Heights are small, so the queue is a
+        list of levels.
+        """
+        # per pair: [node, pair, members still without a height]; users maps
+        # id(member) to the numbers of the pairs it is in
+        pairs = []
+        users = {id(target): []}
+        collected = [target]
+        levels = [[]]
+        k = 0
+        while k < len(collected):
+            node = collected[k]
+            k += 1
+            if node.asserted:
+                levels[0].append((node, None))
+                continue
+            for pair in node.supported_by:
+                missing = 0
+                for member in pair:
+                    key = id(member)
+                    if key in heights:
+                        continue
+                    missing += 1
+                    used = users.get(key)
+                    if used is None:
+                        used = users[key] = []
+                        collected.append(member)
+                    used.append(len(pairs))
+                if missing:
+                    pairs.append([node, pair, missing])
+                else:
+                    self._offer(levels, heights, node, pair)
+
+        # a pair is ready once both its members are settled, and offers its
+        # node one more than the higher of their heights
+        height = 0
+        while height < len(levels):
+            for node, pair in levels[height]:
+                if id(node) in heights:
+                    continue
+                heights[id(node)] = (height, pair)
+                for number in users.get(id(node), ()):
+                    waiting = pairs[number]
+                    waiting[2] -= 1
+                    if not waiting[2] and id(waiting[0]) not in heights:
+                        self._offer(levels, heights, waiting[0], waiting[1])
+            height += 1
+        for node in collected:
+            # only supported through cycles, which DRed leaves in no KB
+            heights.setdefault(id(node), (None, None))
+
+    def _offer(self, levels, heights, node, pair):
+        """INTERNAL USE ONLY
+        Queue a node at the height a pair with settled members proves it in
+        """
+        fact, rule = heights[id(pair[0])][0], heights[id(pair[1])][0]
+        if fact is None or rule is None:
+            return
+        height = 1 + max(fact, rule)
+        while len(levels) <= height:
+            levels.append([])
+        levels[height].append((node, pair))
+
+    def _proof(self, node, heights, proofs):
+        """Get the proof of least height of a node whose height is known
+        """
+        proof = proofs.get(id(node))
+        if proof is not None:
+            return proof
+        # built bottom-up, as proofs can be deeper than the recursion limit
+        stack = [node]
+        while stack:
+            top = stack[-1]
+            if id(top) in proofs:
+                stack.pop()
+                continue
+            pair = heights[id(top)][1]
+            if pair is None:
+                proofs[id(top)] = Proof(top)
+                stack.pop()
+                continue
+            missing = [m for m in pair if id(m) not in proofs]
+            if missing:
+                stack.extend(missing)
+                continue
+            proofs[id(top)] = Proof(top, [proofs[id(m)] for m in pair])
+            stack.pop()
+        return proofs[id(node)]
+
+class _Avoiding(dict):
+    """Proofs built without a node, for Explainer._first, falling back to
+        the remembered proofs that do not go through it
+
+    Attributes:
+        remembered (dictof Proof): proofs built for any node, by id
+        node (Fact|Rule|other): node the proofs avoid
+        rejected (set): ids of remembered proofs found to go through node
+    """
+    def __init__(self, remembered, node):
+        """Constructor for _Avoiding
+
+        Args: as the attributes
+        """
+        super(_Avoiding, self).__init__()
+        self.remembered = remembered
+        self.node = node
+        self.rejected = set()
+
+    def __contains__(self, key):
+        """Define behavior of `in`, taking over a remembered proof if it
+            avoids the node
+        """
+        if dict.__contains__(self, key):
+            return True
+        proof = self.remembered.get(key)
+        if proof is None or key in self.rejected:
+            return False
+        if _uses(proof, self.node):
+            self.rejected.add(key)
+            return False
+        self[key] = proof
+        return True
+
+def _uses(proof, node):
+    """Check whether a proof goes through a node
+    """
+    seen = set()
+    stack = [proof]
+    while stack:
+        proof = stack.pop()
+        if proof.item is node:
+            return True
+        if id(proof) not in seen:
+            seen.add(id(proof))
+            stack.extend(proof.premises)
+    return False
+
+def _describe(item):
+    """Write a fact or rule as in the statement files
+    """
+    if factq(item):
+        return str(item.statement)
+    return _label(item)
@@ -0,0 +1,319 @@
+def fact_keys(fact):
+    """Get the index keys of a fact, as filed by FactStore
+
+    Args:
+        fact (Fact): fact to file
+
+    Returns:
+        (tuple, listof tuple, bool): its (predicate, arity), every key it is
+            filed under, and whether it is ground
+    """
+    key = fact.statement.key
+    head = (key[0], len(key) - 1)
+    keys = [head]
+    ground = True
+    for pos in range(1, len(key)):
+        if key[pos][0] == "?":
+            ground = False
+        else:
+            keys.append(head + (pos, key[pos]))
+    return head, keys, ground
+
+class OrderedStore(object):
+    """Hash-indexed container for the Facts or Rules of a KnowledgeBase. Items
+        are keyed by their canonical statement key (see Statement.key), so
+        membership tests, lookups and removals are O(1), while iteration keeps
+        insertion order like the list it replaces.
+
+    Attributes:
+        items (dictof Fact|Rule): maps each stored item to itself, so an equal
+            (but distinct) Fact or Rule can be used to find the stored instance
+    """
+    def __init__(self, items=[]):
+        """Constructor for OrderedStore
+
+        Args:
+            items (listof Fact|Rule): initial contents of the store
+        """
+        super(OrderedStore, self).__init__()
+        self.items = {}
+        for item in items:
+            self.add(item)
+
+    def __repr__(self):
+        """Define internal string representation
+        """
+        return 'OrderedStore({!r})'.format(list(self.items))
+
+    def __iter__(self):
+        """Iterate over stored items in insertion order
+        """
+        return iter(self.items)
+
+    def __len__(self):
+        """Define behavior of len, the number of stored items
+        """
+        return len(self.items)
+
+    def __contains__(self, item):
+        """Define behavior of `in`, an O(1) hash lookup
+        """
+        return item in self.items
+
+    def __getitem__(self, index):
+        """Positional access, kept for code written against the old list
+            storage. This is O(n); use get() to find a stored item.
+        """
+        return list(self.items)[index]
+
+    def get(self, item):
+        """Get the stored item equal to the argument
+
+        Args:
+            item (Fact|Rule): item we're searching for
+
+        Returns:
+            Fact|Rule|None: the stored instance, None if not present
+        """
+        return self.items.get(item)
+
+    def add(self, item):
+        """Add an item to the store, a no-op if an equal item is already stored
+
+        Args:
+            item (Fact|Rule): item to add
+        """
+        self.items.setdefault(item, item)
+
+    def append(self, item):
+        """Alias of add, kept for code written against the old list storage
+        """
+        self.add(item)
+
+    def remove(self, item):
+        """Remove the stored item equal to the argument
+
+        Args:
+            item (Fact|Rule): item to remove
+
+        Raises:
+            KeyError: if no equal item is stored
+        """
+        del self.items[item]
+
+class FactStore(OrderedStore):
+    """OrderedStore for Facts that also keeps a discrimination index keyed by
+        predicate, arity and constant argument positions. A query such as
+        (inst ?x box) is only matched against the facts filed under
+        ('inst', 2, 2, 'box') rather than against the whole KB.
+
+    Attributes:
+        buckets (dictof dict|Fact): maps (predicate, arity) and
+            (predicate, arity, position, constant) to the facts filed under
+            that key, in insertion order (positions count from 1). A bucket
+            holding a single fact is the fact itself, which saves a dict for
+            every constant only one fact mentions
+        nonground (dictof dict): maps (predicate, arity) to the stored facts
+            that contain variables, which cannot be filed by constant
+        distinct (dictof int): maps (predicate, arity, position) to the number
+            of distinct constants stored facts have at that position
+    """
+    def __init__(self, items=[]):
+        """Constructor for FactStore
+
+        Args:
+            items (listof Fact): initial contents of the store
+        """
+        self.buckets = {}
+        self.nonground = {}
+        self.distinct = {}
+        super(FactStore, self).__init__(items)
+
+    def _keys(self, fact):
+        """Keys of every bucket the fact is filed under, and whether it is ground
+        """
+        return fact_keys(fact)
+
+    def add(self, item):
+        """Add a fact to the store and file it in the index
+        """
+        if item in self.items:
+            return
+        self.items[item] = item
+        head, keys, ground = self._keys(item)
+        for key in keys:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                self.buckets[key] = item
+                if len(key) > 2:
+                    self.distinct[key[:3]] = self.distinct.get(key[:3], 0) + 1
+            elif type(bucket) is dict:
+                bucket[item] = None
+            else:
+                self.buckets[key] = {bucket: None, item: None}
+        if not ground:
+            self.nonground.setdefault(head, {})[item] = None
+
+    def remove(self, item):
+        """Remove the stored fact equal to the argument and unfile it
+        """
+        del self.items[item]
+        head, keys, ground = self._keys(item)
+        for key in keys:
+            bucket = self.buckets[key]
+            if type(bucket) is dict:
+                del bucket[item]
+                if len(bucket) == 1:
+                    self.buckets[key] = next(iter(bucket))
+            else:
+                del self.buckets[key]
+                if len(key) > 2:
+                    self.distinct[key[:3]] -= 1
+        if not ground:
+            del self.nonground[head][item]
+            if not self.nonground[head]:
+                del self.nonground[head]
+
+    def candidates(self, statement):
+        """Get the stored facts that could match a statement. Every fact that
+            matches is returned, along with (possibly) some that do not, in
+            insertion order.
+
+        Args:
+            statement (Statement): statement to look up, may contain variables
+
+        Returns:
+            iterable of Fact: the smallest bucket covering the statement
+        """
+        key = statement.key
+        head = (key[0], len(key) - 1)
+        best = self.bucket(head)
+        if head in self.nonground:
+            return best
+        for pos in range(1, len(key)):
+            if key[pos][0] != "?":
+                bucket = self.bucket(head + (pos, key[pos]))
+                if len(bucket) < len(best):
+                    best = bucket
+                    if not best:
+                        break
+        return best
+
+    def count(self, statement):
+        """Estimate how many stored facts match a statement, for query planning
+
+        Args:
+            statement (Statement): statement to look up, may contain variables
+
+        Returns:
+            int: the number of candidates, an upper bound
+        """
+        return len(self.candidates(statement))
+
+    def values(self, predicate, arity, pos):
+        """Count the distinct constants stored facts have at an argument
+            position, for query planning
+
+        Args:
+            predicate (str): predicate of the facts
+            arity (int): number of arguments of the facts
+            pos (int): argument position, from 1
+
+        Returns:
+            int: number of distinct constants
+        """
+        return self.distinct.get((predicate, arity, pos), 0)
+
+    def bucket(self, key):
+        """Get the facts filed under a key
+
+        Args:
+            key (tuple): (predicate, arity) or (predicate, arity, position, constant)
+
+        Returns:
+            dict|tuple of Fact: the facts, empty if there are none
+        """
+        bucket = self.buckets.get(key, ())
+        return bucket if isinstance(bucket, (dict, tuple)) else (bucket,)
+
+class RuleStore(OrderedStore):
+    """OrderedStore for Rules that also indexes each rule by the first
+        statement of its LHS, the only one fc_infer matches. A new fact is
+        then only paired with the rules whose lhs[0] could match it.
+
+    Attributes:
+        buckets (dictof dict): maps (predicate, arity) to every rule whose
+            lhs[0] has that predicate and arity, and the trigger key
+            (predicate, arity, position, constant) of lhs[0]'s first constant,
+            or (predicate, arity, None) if it has none, to the rules filed there
+        order (dictof int): insertion number of each stored rule
+    """
+    def __init__(self, items=[]):
+        """Constructor for RuleStore
+
+        Args:
+            items (listof Rule): initial contents of the store
+        """
+        self.buckets = {}
+        self.order = {}
+        self.counter = 0
+        super(RuleStore, self).__init__(items)
+
+    def _keys(self, rule):
+        """The (predicate, arity) key and the trigger key of a rule
+        """
+        key = rule.lhs[0].key
+        head = (key[0], len(key) - 1)
+        for pos in range(1, len(key)):
+            if key[pos][0] != "?":
+                return head, head + (pos, key[pos])
+        return head, head + (None,)
+
+    def add(self, item):
+        """Add a rule to the store and file it under its trigger key
+        """
+        if item in self.items:
+            return
+        self.items[item] = item
+        self.order[item] = self.counter
+        self.counter += 1
+        for key in self._keys(item):
+            self.buckets.setdefault(key, {})[item] = None
+
+    def remove(self, item):
+        """Remove the stored rule equal to the argument and unfile it
+        """
+        del self.items[item]
+        del self.order[item]
+        for key in self._keys(item):
+            bucket = self.buckets[key]
+            del bucket[item]
+            if not bucket:
+                del self.buckets[key]
+
+    def triggers(self, fact):
+        """Get the stored rules whose lhs[0] could match a fact, in insertion order
+
+        Args:
+            fact (Fact): fact to look up, may contain variables
+
+        Returns:
+            listof Rule: candidate rules
+        """
+        key = fact.statement.key
+        head = (key[0], len(key) - 1)
+        if head not in self.buckets:
+            return []
+        found = []
+        for pos in range(1, len(key)):
+            if key[pos][0] == "?":
+                return list(self.buckets[head])
+            bucket = self.buckets.get(head + (pos, key[pos]))
+            if bucket:
+                found.append(bucket)
+        bucket = self.buckets.get(head + (None,))
+        if bucket:
+            found.append(bucket)
+        if len(found) == 1:
+            return list(found[0])
+        return sorted((rule for bucket in found for rule in bucket), key=self.order.get)
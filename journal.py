@@ -0,0 +1,306 @@
+"""Append-only write-ahead journal of kb_assert and kb_retract calls.
+
+Attach one with KnowledgeBase.open(journal_path, snapshot_path): the KB is
+loaded from the snapshot (if any), the journal is replayed on top of it, and
+from then on every kb_assert, kb_assert_many and kb_retract is recorded before
+it is applied. KnowledgeBase.checkpoint folds the journal into a new snapshot,
+or rewrites it down to the facts and rules still asserted.
+
+The file is a header followed by records, each
+    op (1 byte), payload length in bytes (4), payload, CRC-32 of both (4)
+in little-endian, with payloads of native 32-bit ints:
+    SYMBOL              UTF-8 name of the next journal symbol id
+    ASSERT/RETRACT_FACT [predicate, arity, term, ...] as symbol ids
+    ASSERT/RETRACT_RULE [n, statement, ..., statement, rhs statement]
+Records are buffered and written with one fsync per `batch` operations (group
+commit), so a crash loses at most the operations since the last sync. A torn or
+corrupt record at the end, from a crash mid-write, is dropped when the journal
+is opened again.
+"""
+import os
+import struct
+import sys
+import time
+import zlib
+from array import array
+from logical_classes import *
+
+MAGIC = b"KBJRNL01"
+# magic, byte order of the payloads
+HEADER = struct.Struct("<8sB3x")
+RECORD = struct.Struct("<BI")
+CRC = struct.Struct("<I")
+SYMBOL, ASSERT_FACT, ASSERT_RULE, RETRACT_FACT, RETRACT_RULE = range(5)
+
+class Journal(object):
+    """Write-ahead log of the changes made to a KB
+
+    Attributes:
+        path (str): journal file
+        batch (int): operations buffered before they are written and synced
+        interval (float|None): seconds after which the next operation syncs
+            the buffer even if the batch is not full
+        symbols (dictof int): maps symbol names to their journal ids
+        buffer (bytearray): records not yet written
+        unsynced (int): operations in the buffer
+        synced_at (float): time of the last sync
+    """
+    def __init__(self, path, batch=256, interval=None):
+        """Constructor for Journal, opening (or creating) the file and dropping
+            a torn record at its end
+
+        Args:
+            path (str): journal file
+            batch (int): operations per fsync, 1 to sync every operation
+            interval (float|None): maximum seconds between syncs while
+                operations are being recorded
+
+        Raises:
+            ValueError: if the file exists but is not a journal
+        """
+        super(Journal, self).__init__()
+        self.path = path
+        self.batch = batch
+        self.interval = interval
+        self.symbols = {}
+        self.buffer = bytearray()
+        self.unsynced = 0
+        self.synced_at = time.time()
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            self.file = open(path, "wb")
+            self._header()
+        else:
+            with open(path, "rb") as file:
+                data = file.read()
+            end = HEADER.size
+            for op, payload, end in _records(data, path):
+                if op == SYMBOL:
+                    self.symbols[str(payload, "utf-8")] = len(self.symbols)
+            self.file = open(path, "r+b")
+            if end < len(data):
+                self.file.truncate(end)
+                self._fsync()
+            self.file.seek(end)
+
+    def __repr__(self):
+        """Define internal string representation
+        """
+        return 'Journal({!r}, {!r}, {!r})'.format(self.path, self.batch, self.interval)
+
+    def log_assert(self, item):
+        """Record that a fact or rule is being asserted
+
+        Args:
+            item (Fact|Rule): fact or rule asserted
+        """
+        self._log(ASSERT_FACT, item)
+
+    def log_retract(self, item):
+        """Record that a fact or rule is being retracted
+
+        Args:
+            item (Fact|Rule): fact or rule retracted
+        """
+        self._log(RETRACT_FACT, item)
+
+    def sync(self):
+        """Write the buffered records and fsync them
+        """
+        if self.buffer:
+            self.file.write(self.buffer)
+            self._fsync()
+            del self.buffer[:]
+        self.unsynced = 0
+        self.synced_at = time.time()
+
+    def close(self):
+        """Sync and close the journal
+        """
+        if not self.file.closed:
+            self.sync()
+            self.file.close()
+
+    def replay(self, kb):
+        """Apply the recorded operations to a KB, in order. The KB's own journal,
+            if any, is detached meanwhile so nothing is recorded twice.
+
+        Args:
+            kb (KnowledgeBase): KB to apply them to, e.g. one just loaded from
+                the snapshot the journal was started from
+
+        Returns:
+            int: number of operations applied
+        """
+        self.sync()
+        with open(self.path, "rb") as file:
+            data = file.read()
+        names = []
+        applied = 0
+        # runs of asserts are stored before inference, as by kb_assert_many
+        asserts = []
+        journal, kb.journal = kb.journal, None
+        try:
+            for op, payload, _ in _records(data, self.path):
+                if op == SYMBOL:
+                    names.append(str(payload, "utf-8"))
+                    continue
+                words = array('i')
+                words.frombytes(payload)
+                if op in (ASSERT_FACT, RETRACT_FACT):
+                    item = Fact(_decode(words, 0, names)[0])
+                else:
+                    lhs, at = [], 1
+                    for _ in range(words[0]):
+                        statement, at = _decode(words, at, names)
+                        lhs.append(statement)
+                    item = Rule([lhs, _decode(words, at, names)[0]])
+                if op in (ASSERT_FACT, ASSERT_RULE):
+                    asserts.append(item)
+                else:
+                    kb.kb_assert_many(asserts)
+                    asserts = []
+                    kb.kb_retract(item)
+                applied += 1
+            kb.kb_assert_many(asserts)
+        finally:
+            kb.journal = journal
+        return applied
+
+    def reset(self):
+        """Empty the journal, once what it recorded is saved elsewhere
+        """
+        del self.buffer[:]
+        self.symbols = {}
+        self.file.seek(0)
+        self.file.truncate()
+        self._header()
+        self.sync()
+
+    def compact(self, items):
+        """Replace the journal with one asserting just the given facts and
+            rules, written to a temporary file and renamed over the journal
+
+        Args:
+            items (iterable of Fact|Rule): facts and rules to keep
+        """
+        self.sync()
+        self.file.close()
+        temporary = self.path + ".tmp"
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        compacted = Journal(temporary, batch=sys.maxsize)
+        try:
+            for item in items:
+                compacted.log_assert(item)
+            compacted.close()
+            os.replace(temporary, self.path)
+        except BaseException:
+            compacted.close()
+            os.remove(temporary)
+            self._reopen()
+            raise
+        self.symbols = compacted.symbols
+        self._reopen()
+
+    def _log(self, op, item):
+        """Buffer the record of an operation, syncing when the batch is full
+            or the interval has passed
+
+        Args:
+            op (int): ASSERT_FACT or RETRACT_FACT, shifted by one for rules
+            item (Fact|Rule): fact or rule of the operation
+        """
+        words = array('i')
+        if isinstance(item, Rule):
+            op += 1
+            words.append(len(item.lhs))
+            for statement in item.lhs:
+                self._encode(statement, words)
+            self._encode(item.rhs, words)
+        else:
+            self._encode(item.statement, words)
+        self._record(op, words.tobytes())
+        self.unsynced += 1
+        if self.unsynced >= self.batch or (self.interval is not None and
+                                           time.time() - self.synced_at >= self.interval):
+            self.sync()
+
+    def _encode(self, statement, words):
+        """Append a statement's symbol ids to words, recording new symbols
+        """
+        key = statement.key
+        for i, name in enumerate(key):
+            id = self.symbols.get(name)
+            if id is None:
+                id = self.symbols[name] = len(self.symbols)
+                self._record(SYMBOL, name.encode("utf-8"))
+            words.append(id)
+            if i == 0:
+                words.append(len(key) - 1)
+
+    def _record(self, op, payload):
+        """Buffer one record
+        """
+        header = RECORD.pack(op, len(payload))
+        self.buffer += header
+        self.buffer += payload
+        self.buffer += CRC.pack(zlib.crc32(payload, zlib.crc32(header)))
+
+    def _header(self):
+        """Buffer the file header
+        """
+        self.buffer += HEADER.pack(MAGIC, sys.byteorder == "big")
+
+    def _reopen(self):
+        """Open the journal file again for appending
+        """
+        self.file = open(self.path, "r+b")
+        self.file.seek(0, os.SEEK_END)
+
+    def _fsync(self):
+        """Flush the file to disk
+        """
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+def _records(data, path):
+    """Iterate over the intact records of a journal
+
+    Args:
+        data (bytes): contents of the journal
+        path (str): journal file, for error messages
+
+    Returns:
+        iterator of (int, bytes, int): op, payload and end offset of each
+            record, up to the first torn or corrupt one
+
+    Raises:
+        ValueError: if data is not a journal
+    """
+    if len(data) < HEADER.size or HEADER.unpack_from(data)[0] != MAGIC:
+        raise ValueError("{} is not a KB journal".format(path))
+    if HEADER.unpack_from(data)[1] != (sys.byteorder == "big"):
+        raise ValueError("{} was written with the other byte order".format(path))
+    position = HEADER.size
+    while position + RECORD.size <= len(data):
+        op, length = RECORD.unpack_from(data, position)
+        start = position + RECORD.size
+        end = start + length + CRC.size
+        if end > len(data):
+            return
+        payload = data[start:start + length]
+        if CRC.unpack_from(data, start + length)[0] != zlib.crc32(
+                payload, zlib.crc32(data[position:start])):
+            return
+        yield op, payload, end
+        position = end
+
+def _decode(words, at, names):
+    """Decode the statement whose symbol ids start at words[at]
+
+    Returns:
+        (Statement, int): the statement, and the position after it
+    """
+    arity = words[at + 1]
+    terms = [names[i] for i in words[at + 2:at + 2 + arity]]
+    return Statement([names[words[at]]] + terms), at + 2 + arity
@@ -1,5 +1,208 @@
 from util import is_var
 
+class SymbolTable(object):
+    """Interns predicate, constant and variable names to small ints, so each
+        distinct name is stored once however many statements use it
+
+    Attributes:
+        ids (dictof int): maps each interned name to its id
+        names (listof str): interned names, indexed by id
+    """
+    def __init__(self):
+        """Constructor for SymbolTable creating an empty table
+        """
+        super(SymbolTable, self).__init__()
+        self.ids = {}
+        self.names = []
+
+    def __len__(self):
+        """Define behavior of len, the number of interned names
+        """
+        return len(self.names)
+
+    def intern(self, name):
+        """Get the id of a name, interning it if it is new
+
+        Args:
+            name (str): name to intern
+
+        Returns:
+            int: id of the name
+        """
+        id = self.ids.get(name)
+        if id is None:
+            id = self.ids[name] = len(self.names)
+            self.names.append(name)
+        return id
+
+    def name(self, id):
+        """Get the name with the given id, the shared copy of an interned name
+
+        Args:
+            id (int): id of the name
+
+        Returns:
+            str
+        """
+        return self.names[id]
+
+# shared by every Statement and Term
+symbols = SymbolTable()
+
+class SupportSet(object):
+    """Insertion-ordered set of supports (pairs, facts or rules) with the list
+        operations the KB uses on them, all O(1): append, remove, in, len.
+        Compares equal to the list of its items.
+
+    Attributes:
+        items (dict): the supports, as keys mapped to None
+        members (dict|None): for sets of pairs, maps the id of each member to
+            the pairs holding it; built by the first drop() on a large set
+    """
+    __slots__ = ('items', 'members')
+    # drop() scans sets up to this size instead of indexing them
+    scan_limit = 8
+
+    def __init__(self, items=()):
+        """Constructor for SupportSet
+
+        Args:
+            items (iterable): initial supports
+        """
+        super(SupportSet, self).__init__()
+        self.items = dict.fromkeys(items)
+        self.members = None
+
+    def __repr__(self):
+        """Define internal string representation
+        """
+        return repr(list(self.items))
+
+    def __iter__(self):
+        """Define behavior of iteration, in insertion order
+        """
+        return iter(self.items)
+
+    def __len__(self):
+        """Define behavior of len, the support count
+        """
+        return len(self.items)
+
+    def __contains__(self, item):
+        """Define behavior of `in`
+        """
+        return item in self.items
+
+    def __eq__(self, other):
+        """Define behavior of == when applied to this object
+        """
+        if isinstance(other, SupportSet):
+            other = list(other.items)
+        return list(self.items) == other
+
+    def __ne__(self, other):
+        """Define behavior of != when applied to this object
+        """
+        return not self == other
+
+    __hash__ = None
+
+    def append(self, item):
+        """Add a support, a no-op if it is already there
+        """
+        if item in self.items:
+            return
+        self.items[item] = None
+        if self.members is not None:
+            for member in item:
+                self.members.setdefault(id(member), []).append(item)
+
+    def remove(self, item):
+        """Remove a support
+
+        Raises:
+            ValueError: if item is not a support
+        """
+        if item not in self.items:
+            raise ValueError("{!r} not in SupportSet".format(item))
+        del self.items[item]
+        if self.members is not None:
+            for member in item:
+                pairs = self.members[id(member)]
+                pairs.remove(item)
+                if not pairs:
+                    del self.members[id(member)]
+
+    def discard(self, item):
+        """Remove a support if it is there
+        """
+        if self.members is None:
+            self.items.pop(item, None)
+        elif item in self.items:
+            self.remove(item)
+
+    def holding(self, member):
+        """Get the pairs holding a given object, in time proportional to their
+            number once the set is indexed
+
+        Args:
+            member (any): object to look for, compared by identity
+
+        Returns:
+            listof tuple: the pairs holding member
+        """
+        if self.members is None:
+            if len(self.items) <= self.scan_limit:
+                return [pair for pair in self.items if pair[0] is member or pair[1] is member]
+            self.members = {}
+            for pair in self.items:
+                for m in pair:
+                    self.members.setdefault(id(m), []).append(pair)
+        return list(self.members.get(id(member), ()))
+
+    def drop(self, member):
+        """Remove every pair holding a given object, see holding()
+
+        Args:
+            member (any): object to drop, compared by identity
+
+        Returns:
+            listof tuple: the pairs removed
+        """
+        dropped = self.holding(member)
+        for pair in dropped:
+            self.remove(pair)
+        return dropped
+
+    def holds(self, member):
+        """Check whether any pair holds a given object, compared by identity
+        """
+        if self.members is not None:
+            return id(member) in self.members
+        return any(pair[0] is member or pair[1] is member for pair in self.items)
+
+def lazy_list(slot):
+    """Property for a support attribute (a SupportSet) that is only allocated
+        when first used, as most facts never support anything
+
+    Args:
+        slot (str): name of the slot holding the SupportSet, None until allocated
+
+    Returns:
+        property
+    """
+    def get(self):
+        value = getattr(self, slot)
+        if value is None:
+            value = SupportSet()
+            setattr(self, slot, value)
+        return value
+
+    def set(self, value):
+        setattr(self, slot, value)
+
+    return property(get, set)
+
 class Fact(object):
     """Represents a fact in our knowledge base. Has a statement containing the
         content of the fact, e.g. (isa Sorceress Wizard) and fields tracking
@@ -10,11 +213,20 @@ class Fact(object):
         statement (Statement): statement of this fact, basically what the fact actually says
         asserted (bool): boolean flag indicating if fact was asserted instead of
             inferred from other rules/facts in the KB
-        supported_by (listof Fact|Rule): Facts/Rules that allow inference of
+        supported_by (SupportSet): (Fact, Rule) pairs that allow inference of
             the statement
-        supports_facts (listof Fact): Facts that this fact supports
-        supports_rules (listof Rule): Rules that this fact supports
+        supports_facts (SupportSet): Facts that this fact supports
+        supports_rules (SupportSet): Rules that this fact supports
     """
+    # weak references let columnar.ColumnarFactStore hold facts materialized
+    # for a query only as long as they are in use
+    __slots__ = ('statement', 'asserted', '_supported_by', '_supports_facts', '_supports_rules',
+                 '__weakref__')
+    name = "fact"
+    supported_by = lazy_list('_supported_by')
+    supports_facts = lazy_list('_supports_facts')
+    supports_rules = lazy_list('_supports_rules')
+
     def __init__(self, statement, supported_by=[]):
         """Constructor for Fact setting up useful flags and generating appropriate statement
 
@@ -25,13 +237,12 @@ class Fact(object):
                 the statement
         """
         super(Fact, self).__init__()
-        self.name = "fact"
         self.statement = statement if isinstance(statement, Statement) else Statement(statement)
         self.asserted = not supported_by
         #self.supported_by = supported_by
-        self.supported_by = []
-        self.supports_facts = []
-        self.supports_rules = []
+        self._supported_by = None
+        self._supports_facts = None
+        self._supports_rules = None
         for pair in supported_by:
            self.supported_by.append(pair)
 
@@ -68,6 +279,11 @@ class Fact(object):
         """
         return isinstance(other, Fact) and self.statement == other.statement
 
+    def __hash__(self):
+        """Define hash consistent with ==, so Facts can key dicts and sets
+        """
+        return hash(self.statement)
+
     def __ne__(self, other):
         """Define behavior of != when applied to this object
         """
@@ -85,11 +301,18 @@ class Rule(object):
         rhs (Statement): RHS statment of this rule
         asserted (bool): boolean flag indicating if rule was asserted instead of
             inferred from other rules/facts in the KB
-        supported_by (listof Fact|Rule): Facts/Rules that allow inference of
+        supported_by (SupportSet): (Fact, Rule) pairs that allow inference of
             the statement
-        supports_facts (listof Fact): Facts that this rule supports
-        supports_rules (listof Rule): Rules that this rule supports
+        supports_facts (SupportSet): Facts that this rule supports
+        supports_rules (SupportSet): Rules that this rule supports
     """
+    __slots__ = ('lhs', 'rhs', 'asserted', '_supported_by', '_supports_facts', '_supports_rules',
+                 '_hash')
+    name = "rule"
+    supported_by = lazy_list('_supported_by')
+    supports_facts = lazy_list('_supports_facts')
+    supports_rules = lazy_list('_supports_rules')
+
     def __init__(self, rule, supported_by=[]):
         """Constructor for Rule setting up useful flags and generating appropriate LHS & RHS
 
@@ -100,13 +323,13 @@ class Rule(object):
                 the statement
         """
         super(Rule, self).__init__()
-        self.name = "rule"
         self.lhs = [statement if isinstance(statement, Statement) else Statement(statement) for statement in rule[0]]
         self.rhs = rule[1] if isinstance(rule[1], Statement) else Statement(rule[1])
         self.asserted = not supported_by
-        self.supported_by = []
-        self.supports_facts = []
-        self.supports_rules = []
+        self._supported_by = None
+        self._supports_facts = None
+        self._supports_rules = None
+        self._hash = None
         for pair in supported_by:
             self.supported_by.append(pair)
 
@@ -147,6 +370,13 @@ class Rule(object):
         is_rule = isinstance(other, Rule)
         return is_rule and self.lhs == other.lhs and self.rhs == other.rhs
 
+    def __hash__(self):
+        """Define hash consistent with ==, so Rules can key dicts and sets
+        """
+        if self._hash is None:
+            self._hash = hash((tuple(self.lhs), self.rhs))
+        return self._hash
+
     def __ne__(self, other):
         """Define behavior of != when applied to this object
         """
@@ -158,10 +388,12 @@ class Statement(object):
         in Facts or on the LHS and RHS of Rules
 
     Attributes:
-        terms (listof Term): List of terms (Variable or Constant) in the
-            statement, e.g. 'Nosliw' or '?d'
+        terms (tupleof Term): Terms (Variable or Constant) in the statement,
+            e.g. 'Nosliw' or '?d'
         predicate (str): The predicate of the statement, e.g. isa, hero, needs
     """
+    __slots__ = ('predicate', 'terms', '_key', '_hash')
+
     def __init__(self, statement_list=[]):
         """Constructor for Statements with optional list of Statements that are
             converted to appropriate terms (and one predicate)
@@ -173,12 +405,14 @@ class Statement(object):
                 Term constructor
         """
         super(Statement, self).__init__()
-        self.terms = []
+        self.terms = ()
         self.predicate = ""
+        self._key = None
+        self._hash = None
 
         if statement_list:
-            self.predicate = statement_list[0]
-            self.terms = [t if isinstance(t, Term) else Term(t) for t in statement_list[1:]]
+            self.predicate = symbols.name(symbols.intern(statement_list[0]))
+            self.terms = tuple(t if isinstance(t, Term) else Term(t) for t in statement_list[1:])
 
     def __repr__(self):
         """Define internal string representation
@@ -190,17 +424,26 @@ class Statement(object):
         """
         return "(" + self.predicate + " " + ' '.join((str(t) for t in self.terms)) + ")"
 
+    @property
+    def key(self):
+        """Canonical hashable form of this statement: the predicate followed by
+            the element of each term, e.g. ('isa', 'cube', '?x')
+        """
+        if self._key is None:
+            self._key = (self.predicate,) + tuple(t.term.element for t in self.terms)
+        return self._key
+
     def __eq__(self, other):
         """Define behavior of == when applied to this object
         """
-        if self.predicate != other.predicate:
-            return False
-
-        for self_term, other_term in zip(self.terms, other.terms):
-            if self_term != other_term:
-                return False
+        return isinstance(other, Statement) and self.key == other.key
 
-        return True
+    def __hash__(self):
+        """Define hash consistent with ==, so Statements can key dicts and sets
+        """
+        if self._hash is None:
+            self._hash = hash(self.key)
+        return self._hash
 
     def __ne__(self, other):
         """Define behavior of != when applied to this object
@@ -212,19 +455,42 @@ class Term(object):
         sorta be thought of as a super class of Variable and Constant, though
         there is no inheritance implemented in the code.
 
+        Terms are immutable and interned: constructing a Term for a name that
+        already has one returns the existing instance.
+
     Attributes:
         term (Variable|Constant): The Variable or Constant that this term holds (represents)
+        id (int): id of the term's name in the symbol table
+        var (bool): whether the term holds a Variable, classified once when
+            the term is created so matching need not test it
     """
-    def __init__(self, term):
-        """Constructor for Term which converts term to appropriate form
+    __slots__ = ('term', 'id', 'var')
+    interned = {}
+
+    def __new__(cls, term):
+        """Get the interned Term for a name, creating it if needed
 
         Args:
             term (Variable|Constant|string): Either an instantiated Variable or
                 Constant, or a string to be passed to the appropriate constructor
         """
-        super(Term, self).__init__()
         is_var_or_const = isinstance(term, Variable) or isinstance(term, Constant)
-        self.term = term if is_var_or_const else (Variable(term) if is_var(term) else Constant(term))
+        element = term.element if is_var_or_const else term
+        self = cls.interned.get(element)
+        if self is None:
+            self = super(Term, cls).__new__(cls)
+            self.id = symbols.intern(element)
+            element = symbols.name(self.id)
+            self.var = is_var(element)
+            self.term = Variable(element) if self.var else Constant(element)
+            cls.interned[element] = self
+        return self
+
+    def __reduce__(self):
+        """Copy and pickle a Term by its name, so that the copy is the
+            interned Term, in this process or the one unpickling it
+        """
+        return (Term, (self.term.element,))
 
     def __repr__(self):
         """Define internal string representation
@@ -249,12 +515,19 @@ class Term(object):
         """
         return not self == other
 
+    def __hash__(self):
+        """Define hash consistent with ==, so Terms can key dicts and sets
+        """
+        return hash(self.term.element)
+
 class Variable(object):
     """Represents a variable used in statements
 
     Attributes:
         element (str): The name of the variable, e.g. '?x'
     """
+    __slots__ = ('element',)
+
     def __init__(self, element):
         """Constructor for Variable
 
@@ -293,6 +566,8 @@ class Constant(object):
     Attributes:
         element (str): The value of the constant, e.g. 'Nosliw'
     """
+    __slots__ = ('element',)
+
     def __init__(self, element):
         """Constructor for Constant
 
@@ -358,15 +633,17 @@ class Bindings(object):
     """Represents Binding(s) used while matching two statements
 
     Attributes:
-        bindings (listof Bindings): bindings involved in match
+        bindings (listof Bindings): bindings involved in match, built from
+            bindings_dict when accessed
         bindings_dict (dictof Bindings): bindings involved in match where key is
             bound variable and value is bound value,
             e.g. some_bindings.bindings_dict['?d'] => 'Nosliw'
     """
+    __slots__ = ('bindings_dict',)
+
     def __init__(self):
         """Constructor for Bindings creating initially empty instance
         """
-        self.bindings = []
         self.bindings_dict = {}
 
     def __repr__(self):
@@ -381,6 +658,13 @@ class Bindings(object):
             return "No bindings"
         return ", ".join((str(binding) for binding in self.bindings))
 
+    @property
+    def bindings(self):
+        """Binding objects for bindings_dict, in the order the variables were bound
+        """
+        return [Binding(Term(variable).term, Term(value).term)
+                for variable, value in self.bindings_dict.items()]
+
     def __getitem__(self,key):
         """Define behavior for indexing, e.g. random_bindings[key] returns
             random_bindings.bindings_dict[key] when the dictionary is not empty
@@ -398,7 +682,6 @@ class Bindings(object):
             value (Constant): the value to bind to the variable
         """
         self.bindings_dict[variable.element] = value.element
-        self.bindings.append(Binding(variable, value))
 
     def bound_to(self, variable):
         """Check if variable is bound. If so return value bound to it, else False.
@@ -409,10 +692,9 @@ class Bindings(object):
         Returns:
             Variable|Constant|False: returns bound term if variable is bound else False
         """
-        if variable.element in self.bindings_dict.keys():
-            value = self.bindings_dict[variable.element]
-            if value:
-                return Variable(value) if is_var(value) else Constant(value)
+        value = self.bindings_dict.get(variable.element)
+        if value:
+            return Term(value).term
 
         return False
 
@@ -429,10 +711,10 @@ class Bindings(object):
             bool: if variable bound returns whether or not bound value matches value_term,
                 else True
         """
-        bound = self.bound_to(variable_term.term)
+        bound = self.bindings_dict.get(variable_term.term.element)
         if bound:
-            return value_term.term == bound
-            
+            return value_term.term.element == bound
+
         self.add_binding(variable_term.term, value_term.term)
         return True
 
@@ -1,16 +1,34 @@
+import gc
+import json
+import os
+import pickle
+import tempfile
+import threading
 import unittest
-import read, copy
+from functools import partial
+import read, copy, query
 from logical_classes import *
-from student_code import KnowledgeBase
+from student_code import KnowledgeBase, InferenceEngine
+from index import FactStore
+from columnar import ColumnarFactStore
+from rete import ReteEngine
+from datalog import SemiNaiveEngine
+from parallel import ParallelEngine
+from cache import QueryCache
+from shared import SharedKnowledgeBase
+from compiler import RuleCompiler, _slow
+from metrics import Metrics
 
 class KBTest(unittest.TestCase):
+    engine = InferenceEngine
+    store = FactStore
 
     def setUp(self):
         # Assert starter facts
         file = 'statements_kb5.txt'
         self.data = read.read_tokenize(file)
         data = read.read_tokenize(file)
-        self.KB = KnowledgeBase([], [])
+        self.KB = KnowledgeBase([], [], self.engine(), store=self.store())
         for item in data:
             if isinstance(item, Fact) or isinstance(item, Rule):
                 self.KB.kb_assert(item)
@@ -243,6 +261,776 @@ class KBTest(unittest.TestCase):
         answer = self.KB.kb_ask(ask3)
         self.assertEqual(str(answer[0]), "?X : profHammond")
 
+class ReteKBTest(KBTest):
+    """runs the KBTest cases against the Rete engine"""
+    engine = ReteEngine
+
+    def test_tokens_retracted(self):
+        """retracting a fact discards the partial matches built from it"""
+        self.assertEqual(len(self.KB.rules), 8)
+        memories = self.KB.ie.memories
+        count = lambda: sum(len(tokens) for rule in memories
+                            for memory in memories[rule][1:] for tokens in memory.values())
+        before = count()
+        # (dresslike ...) and the (resembles ...) fact it supports both start
+        # partial matches
+        self.KB.kb_retract(read.parse_input("fact: (dresslike profHammond TonyStark)"))
+        self.assertEqual(count(), before - 3)
+        self.KB.kb_assert(read.parse_input("fact: (dresslike profHammond TonyStark)"))
+        self.assertEqual(count(), before)
+
+class SemiNaiveKBTest(KBTest):
+    """runs the KBTest cases against the semi-naive engine"""
+    engine = SemiNaiveEngine
+
+class ParallelKBTest(KBTest):
+    """runs the KBTest cases with every round on worker processes"""
+    engine = partial(ParallelEngine, workers=2, threshold=0)
+
+    def tearDown(self):
+        self.KB.ie.close()
+
+    def test_same_closure(self):
+        """the closure and its provenance match the serial engine's"""
+        def state(KB):
+            return sorted((str(f.statement), f.asserted, len(f.supported_by))
+                          for f in KB.facts)
+        serial = KnowledgeBase([], [], SemiNaiveEngine())
+        parallel = KnowledgeBase([], [], self.engine())
+        self.addCleanup(parallel.ie.close)
+        for KB in [serial, parallel]:
+            for i in range(30):
+                KB.kb_assert(read.parse_input("fact: (next n{} n{})".format(i, i + 1)))
+            KB.kb_assert_many([read.parse_input("rule: ((next ?x ?y)) -> (after ?x ?y)"),
+                               read.parse_input(
+                                   "rule: ((after ?x ?y) (next ?y ?z)) -> (after ?x ?z)")])
+            KB.kb_retract(read.parse_input("fact: (next n10 n11)"))
+        self.assertEqual(state(serial), state(parallel))
+        self.assertEqual(len(parallel.kb_ask(read.parse_input("fact: (after n0 ?x)"))), 10)
+
+class ColumnarKBTest(KBTest):
+    """runs the KBTest cases with ground facts stored column-wise"""
+    store = ColumnarFactStore
+
+    def test_load_materializes_lazily(self):
+        """bulk-loaded facts only become Fact objects once something uses them"""
+        store = ColumnarFactStore()
+        KB = KnowledgeBase([], [], store=store)
+        rows = [["inst", "box" + str(i), "box"] for i in range(100)]
+        rows += [["inst", "pyramid" + str(i), "pyramid"] for i in range(100)]
+        self.assertEqual(store.load(rows), 200)
+        relation = store.relations[("inst", 2)]
+        answer = KB.kb_ask(read.parse_input("fact: (inst ?X pyramid)"))
+        self.assertEqual(len(answer), 100)
+        self.assertEqual(str(answer[0]), "?X : pyramid0")
+        self.assertEqual(len(relation.materialized), 100)
+        # answers are only held while in use, facts with provenance for good
+        del answer
+        self.assertEqual(len(relation.materialized), 0)
+        KB.kb_assert(read.parse_input("rule: ((inst ?x box)) -> (flat ?x)"))
+        gc.collect()
+        self.assertEqual(len(relation.materialized), 100)
+        self.assertEqual(len(KB.kb_ask(read.parse_input("fact: (flat ?X)"))), 100)
+        KB.kb_retract(read.parse_input("fact: (inst box7 box)"))
+        self.assertEqual(len(KB.kb_ask(read.parse_input("fact: (flat ?X)"))), 99)
+        self.assertEqual(len(KB.facts), 298)
+        unknown = read.parse_input("fact: (color box1 red)")
+        self.assertFalse(unknown in store or store.get(unknown))
+        self.assertNotIn(("color", 2), store.relations)
+
+    def test_positional_access(self):
+        """kb.facts[i] indexes every fact, ground ones included"""
+        KB = KnowledgeBase([], [], store=ColumnarFactStore())
+        KB.kb_assert(read.parse_input("fact: (a b)"))
+        KB.kb_assert(read.parse_input("fact: (inst ?x box)"))
+        self.assertEqual(len(KB.facts), 2)
+        self.assertEqual(str(KB.facts[0].statement), "(a b)")
+        self.assertEqual(str(KB.facts[-1].statement), "(inst ?x box)")
+        self.assertEqual(list(KB.facts), [KB.facts[0], KB.facts[1]])
+
+class StoreTest(unittest.TestCase):
+
+    def test_hash_consistent_with_eq(self):
+        """equal facts and rules hash equal, so the KB can index them"""
+        f1 = read.parse_input("fact: (isa cube block)")
+        f2 = read.parse_input("fact: (isa cube block)")
+        r1 = read.parse_input("rule: ((inst ?x ?y) (isa ?y ?z)) -> (inst ?x ?z)")
+        r2 = read.parse_input("rule: ((inst ?x ?y) (isa ?y ?z)) -> (inst ?x ?z)")
+        self.assertEqual(f1, f2)
+        self.assertEqual(hash(f1), hash(f2))
+        self.assertEqual(hash(r1), hash(r2))
+        self.assertNotEqual(f1, read.parse_input("fact: (isa cube block extra)"))
+
+    def test_duplicate_assert(self):
+        """re-asserting keeps one stored fact and marks it asserted"""
+        KB = KnowledgeBase([], [])
+        KB.kb_assert(read.parse_input("rule: ((inst ?x cube)) -> (flat ?x)"))
+        KB.kb_assert(read.parse_input("fact: (inst cube1 cube)"))
+        KB.kb_assert(read.parse_input("fact: (flat cube1)"))
+        self.assertEqual(len(KB.facts), 2)
+        flat = KB._get_fact(read.parse_input("fact: (flat cube1)"))
+        self.assertTrue(flat.asserted)
+        self.assertEqual(len(flat.supported_by), 1)
+
+    def test_interned_terms(self):
+        """terms are shared between statements, facts carry no __dict__"""
+        f1 = read.parse_input("fact: (inst bigbox box)")
+        f2 = read.parse_input("fact: (color bigbox red)")
+        self.assertIs(f1.statement.terms[0], f2.statement.terms[0])
+        self.assertEqual(symbols.name(f1.statement.terms[0].id), "bigbox")
+        self.assertFalse(hasattr(f1, "__dict__"))
+        self.assertFalse(hasattr(f1.statement, "__dict__"))
+        self.assertEqual(f1.name, "fact")
+
+    def test_copy_and_pickle(self):
+        """facts and rules survive copy.deepcopy and pickle, with interned terms"""
+        fact = read.parse_input("fact: (inst bigbox box)")
+        rule = read.parse_input("rule: ((inst ?x ?y) (isa ?y ?z)) -> (inst ?x ?z)")
+        for clone in (copy.deepcopy, lambda item: pickle.loads(pickle.dumps(item))):
+            self.assertEqual(clone(fact), fact)
+            self.assertIs(clone(fact).statement.terms[0], fact.statement.terms[0])
+            copied = clone(rule)
+            self.assertEqual((copied.lhs, copied.rhs), (rule.lhs, rule.rhs))
+            KB = KnowledgeBase([], [])
+            KB.kb_assert(copied)
+            KB.kb_assert(clone(fact))
+            KB.kb_assert(read.parse_input("fact: (isa box container)"))
+            self.assertTrue(KB.kb_ask(read.parse_input("fact: (inst bigbox container)")))
+
+    def test_ask_index(self):
+        """kb_ask only visits facts filed under the query's constants, but
+        still finds stored facts that contain variables
+        """
+        KB = KnowledgeBase([], [])
+        for fact in ["(inst bigbox box)", "(inst pyramid1 pyramid)",
+                     "(inst littlebox box)", "(color bigbox red)"]:
+            KB.kb_assert(read.parse_input("fact: " + fact))
+        ask1 = read.parse_input("fact: (inst ?X box)")
+        self.assertEqual(len(KB.facts.candidates(ask1.statement)), 2)
+        answer = KB.kb_ask(ask1)
+        self.assertEqual([str(b) for b in answer], ["?X : bigbox", "?X : littlebox"])
+        KB.kb_assert(read.parse_input("fact: (inst ?y box)"))
+        self.assertEqual(len(KB.kb_ask(read.parse_input("fact: (inst sphere1 box)"))), 1)
+        KB.kb_retract(read.parse_input("fact: (inst bigbox box)"))
+        self.assertEqual(len(KB.kb_ask(ask1)), 2)
+
+    def test_ask_iter(self):
+        """kb_ask_iter yields the answers of kb_ask one at a time, up to a limit"""
+        KB = KnowledgeBase([], [], store=ColumnarFactStore())
+        KB.facts.load([["inst", "box" + str(i), "box"] for i in range(100)])
+        ask1 = read.parse_input("fact: (inst ?X box)")
+        answers = KB.kb_ask_iter(ask1)
+        binding, facts = next(answers)
+        self.assertEqual(str(binding), "?X : box0")
+        self.assertEqual(str(facts[0].statement), "(inst box0 box)")
+        self.assertEqual(len(KB.facts.relations[("inst", 2)].materialized), 1)
+        self.assertEqual([str(b) for b, _ in KB.kb_ask_iter(ask1, limit=3)],
+                         ["?X : box0", "?X : box1", "?X : box2"])
+        self.assertEqual(len(list(KB.kb_ask_iter(ask1))), len(KB.kb_ask(ask1)))
+        self.assertFalse(list(KB.kb_ask_iter(read.parse_input("fact: (inst ?X ball)"))))
+
+    def test_rule_triggers(self):
+        """a new fact is only paired with rules whose lhs[0] could match it"""
+        KB = KnowledgeBase([], [])
+        for rule in ["((inst ?x cube)) -> (flat ?x)",
+                     "((inst ?x ?y) (isa ?y ?z)) -> (inst ?x ?z)",
+                     "((isa ?x ?y) (isa ?y ?z)) -> (isa ?x ?z)",
+                     "((inst ?x sphere)) -> (round ?x)"]:
+            KB.kb_assert(read.parse_input("rule: " + rule))
+        triggers = KB.rules.triggers(read.parse_input("fact: (inst cube1 cube)"))
+        self.assertEqual([str(r.rhs) for r in triggers], ["(flat ?x)", "(inst ?x ?z)"])
+        KB.kb_assert(read.parse_input("fact: (isa cube block)"))
+        KB.kb_assert(read.parse_input("fact: (inst cube1 cube)"))
+        self.assertTrue(KB.kb_ask(read.parse_input("fact: (inst cube1 block)")))
+        self.assertTrue(KB.kb_ask(read.parse_input("fact: (flat cube1)")))
+        self.assertFalse(KB.kb_ask(read.parse_input("fact: (round cube1)")))
+
+class AgendaTest(unittest.TestCase):
+
+    def chain(self, KB, length):
+        KB.kb_assert(read.parse_input("rule: ((inst ?x ?y) (isa ?y ?z)) -> (inst ?x ?z)"))
+        for i in range(length):
+            KB.kb_assert(read.parse_input("fact: (isa c{} c{})".format(i, i + 1)))
+        KB.kb_assert(read.parse_input("fact: (inst x c0)"))
+
+    def test_deep_chain(self):
+        """inference chains longer than the Python stack do not recurse"""
+        for engine in [InferenceEngine, ReteEngine, SemiNaiveEngine]:
+            for order in ["depth", "breadth"]:
+                KB = KnowledgeBase([], [], engine(), order)
+                self.chain(KB, 3000)
+                self.assertTrue(KB.kb_ask(read.parse_input("fact: (inst x c3000)")))
+
+    def test_max_steps(self):
+        """max_steps leaves work queued for kb_run"""
+        KB = KnowledgeBase([], [], max_steps=10)
+        self.chain(KB, 50)
+        ask1 = read.parse_input("fact: (inst x c50)")
+        self.assertFalse(KB.kb_ask(ask1))
+        self.assertEqual(KB.kb_run(), 0)
+        self.assertTrue(KB.kb_ask(ask1))
+
+    def test_assert_many(self):
+        """a batch assert reaches the same closure as asserting one by one"""
+        data = read.read_tokenize('statements_kb2.txt')
+        for engine in [InferenceEngine, ReteEngine, SemiNaiveEngine]:
+            KB1 = KnowledgeBase([], [], engine())
+            for item in data:
+                KB1.kb_assert(item)
+            KB2 = KnowledgeBase([], [], engine())
+            KB2.kb_assert_many(read.read_tokenize('statements_kb2.txt'))
+            self.assertEqual(set(KB1.facts), set(KB2.facts))
+            self.assertEqual(set(KB1.rules), set(KB2.rules))
+            self.assertTrue(KB2.kb_ask(read.parse_input("fact: (safe HappyDale)")))
+
+class RetractTest(unittest.TestCase):
+
+    def test_deep_retract(self):
+        """retracting the root of a long chain does not recurse"""
+        for engine in [InferenceEngine, ReteEngine, SemiNaiveEngine]:
+            KB = KnowledgeBase([], [], engine())
+            AgendaTest.chain(self, KB, 3000)
+            KB.kb_retract(read.parse_input("fact: (inst x c0)"))
+            self.assertFalse(KB.kb_ask(read.parse_input("fact: (inst x ?y)")))
+            self.assertEqual(len(KB.facts), 3000)
+
+    def test_asserted_dependent_kept(self):
+        """a fact that was also asserted outlives its last support"""
+        KB = KnowledgeBase([], [])
+        KB.kb_assert(read.parse_input("rule: ((inst ?x ?y) (isa ?y ?z)) -> (inst ?x ?z)"))
+        KB.kb_assert(read.parse_input("fact: (isa cube block)"))
+        KB.kb_assert(read.parse_input("fact: (inst cube1 block)"))
+        KB.kb_assert(read.parse_input("fact: (inst cube1 cube)"))
+        KB.kb_retract(read.parse_input("fact: (inst cube1 cube)"))
+        block = KB._get_fact(read.parse_input("fact: (inst cube1 block)"))
+        self.assertTrue(block.asserted)
+        self.assertEqual(len(block.supported_by), 0)
+        isa = KB._get_fact(read.parse_input("fact: (isa cube block)"))
+        self.assertEqual(len(isa.supports_facts), 0)
+
+    def test_cyclic_support(self):
+        """facts only supported through a cycle are retracted, facts with
+        support from outside the cycle are kept"""
+        for engine in [InferenceEngine, ReteEngine, SemiNaiveEngine]:
+            KB = KnowledgeBase([], [], engine())
+            KB.kb_assert(read.parse_input("rule: ((resembles ?x ?y)) -> (resembles ?y ?x)"))
+            KB.kb_assert(read.parse_input("rule: ((twin ?x ?y)) -> (resembles ?x ?y)"))
+            KB.kb_assert(read.parse_input("fact: (resembles a b)"))
+            KB.kb_assert(read.parse_input("fact: (resembles c d)"))
+            KB.kb_assert(read.parse_input("fact: (twin d c)"))
+            KB.kb_retract(read.parse_input("fact: (resembles a b)"))
+            self.assertFalse(KB.kb_ask(read.parse_input("fact: (resembles a ?x)")))
+            self.assertFalse(KB.kb_ask(read.parse_input("fact: (resembles b ?x)")))
+            KB.kb_retract(read.parse_input("fact: (resembles c d)"))
+            self.assertTrue(KB.kb_ask(read.parse_input("fact: (resembles c d)")))
+            KB.kb_retract(read.parse_input("fact: (twin d c)"))
+            self.assertFalse(KB.kb_ask(read.parse_input("fact: (resembles ?x ?y)")))
+            self.assertEqual(len(KB.facts), 0)
+
+class ParseTest(unittest.TestCase):
+
+    def test_multiline(self):
+        """statements may span lines, in either rule layout"""
+        lines = ["# a comment", "fact: (isa cube", "   block)", "",
+                 "rule: ((inst ?x ?y)", "       (isa ?y ?z))", "  -> (inst ?x ?z)",
+                 "rule: ((size ?x big) -> (heavy ?x))"]
+        items = list(read.iter_tokenize(lines))
+        self.assertEqual(items[0], Fact(["isa", "cube", "block"]))
+        self.assertEqual(items[1], read.parse_input("rule: ((inst ?x ?y) (isa ?y ?z)) -> (inst ?x ?z)"))
+        self.assertEqual(items[2], Rule([[["size", "?x", "big"]], ["heavy", "?x"]]))
+
+    def test_errors(self):
+        """malformed statements raise ParseError with their line"""
+        for lines, line in [(["fact: (isa cube block)", "fact: (isa (cube block)"], 2),
+                            (["fact: (a b)", "", "rule: ((a ?x)) (b ?x)"], 3),
+                            (["fact: (a b)", "oops: (a b)"], 2),
+                            (["fact: (a b) c"], 1)]:
+            with self.assertRaises(read.ParseError) as caught:
+                list(read.iter_tokenize(lines))
+            self.assertEqual(caught.exception.line, line)
+        self.assertRaises(read.ParseError, read.parse_input, "facts (a b)")
+
+    def test_stream_into_kb(self):
+        """the generator feeds kb_assert_many without building a list"""
+        KB = KnowledgeBase([], [])
+        KB.kb_assert_many(read.iter_tokenize('statements_kb2.txt'))
+        self.assertTrue(KB.kb_ask(read.parse_input("fact: (safe HappyDale)")))
+
+class SnapshotTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        """a loaded KB has the same contents and retracts like the saved one"""
+        for engine in [InferenceEngine, ReteEngine, SemiNaiveEngine]:
+            KB1 = KnowledgeBase([], [], engine())
+            KB1.kb_assert_many(read.read_tokenize('statements_kb5.txt'))
+            with tempfile.TemporaryDirectory() as directory:
+                KB1.save(os.path.join(directory, "kb.snap"))
+                KB2 = KnowledgeBase.load(os.path.join(directory, "kb.snap"), engine())
+            self.assertEqual(list(KB1.facts), list(KB2.facts))
+            self.assertEqual(list(KB1.rules), list(KB2.rules))
+            self.assertEqual([f.asserted for f in KB1.facts], [f.asserted for f in KB2.facts])
+            for KB in [KB1, KB2]:
+                KB.kb_retract(read.parse_input("fact: (techgenius profHammond)"))
+                KB.kb_assert(read.parse_input("fact: (talkslike profHammond Thor)"))
+            self.assertEqual(set(KB1.facts), set(KB2.facts))
+            self.assertFalse(KB2.kb_ask(read.parse_input("fact: (smart ?X)")))
+
+    def test_queued(self):
+        """saving with work left on the agenda is refused"""
+        KB = KnowledgeBase([], [], max_steps=1)
+        KB.kb_assert_many(read.read_tokenize('statements_kb5.txt'))
+        with tempfile.TemporaryDirectory() as directory:
+            self.assertRaises(ValueError, KB.save, os.path.join(directory, "kb.snap"))
+
+class JournalTest(unittest.TestCase):
+
+    def run_ops(self, KB):
+        data = read.read_tokenize('statements_kb2.txt')
+        KB.kb_assert_many(data[:10])
+        for item in data[10:]:
+            KB.kb_assert(item)
+        KB.kb_retract(read.parse_input("fact: (hero Ai)"))
+        KB.kb_retract(read.parse_input("rule: ((inst ?x ?y) (isa ?y ?z)) -> (inst ?x ?z)"))
+
+    def assertSameKB(self, KB1, KB2):
+        self.assertEqual(set(KB1.facts), set(KB2.facts))
+        self.assertEqual(set(KB1.rules), set(KB2.rules))
+        self.assertEqual(set(f for f in KB1.facts if f.asserted),
+                         set(f for f in KB2.facts if f.asserted))
+
+    def test_replay(self):
+        """reopening a journaled KB replays its asserts and retracts"""
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "kb.journal")
+            KB1 = KnowledgeBase.open(path, engine=ReteEngine(), batch=4)
+            self.run_ops(KB1)
+            KB1.close()
+            KB2 = KnowledgeBase.open(path, engine=ReteEngine())
+            self.assertSameKB(KB1, KB2)
+            KB2.close()
+
+    def test_checkpoint(self):
+        """compacting into a snapshot or a shorter journal keeps the contents"""
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "kb.journal")
+            snap = os.path.join(directory, "kb.snap")
+            KB1 = KnowledgeBase.open(path)
+            self.run_ops(KB1)
+            KB1.journal.sync()
+            size = os.path.getsize(path)
+            KB1.checkpoint()
+            self.assertLess(os.path.getsize(path), size)
+            KB1.checkpoint(snap)
+            KB1.kb_retract(read.parse_input("fact: (possesses Ai Loot)"))
+            KB1.close()
+            KB2 = KnowledgeBase.open(path, snap)
+            self.assertSameKB(KB1, KB2)
+            KB2.close()
+
+    def test_checkpoint_backward(self):
+        """compacting keeps the rules kept apart for backward chaining"""
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "kb.journal")
+            KB1 = KnowledgeBase.open(path, backward=["ancestor"])
+            BackwardTest.family(None, KB1)
+            KB1.checkpoint()
+            KB1.close()
+            KB2 = KnowledgeBase.open(path, backward=["ancestor"])
+            self.assertEqual(len(KB2.backward_rules), len(KB1.backward_rules))
+            for ask in ("fact: (ancestor p1 ?X)", "fact: (founder ?X)"):
+                ask = read.parse_input(ask)
+                self.assertEqual([str(b[0]) for b in KB2.kb_ask(ask).list_of_bindings],
+                                 [str(b[0]) for b in KB1.kb_ask(ask).list_of_bindings])
+            KB2.close()
+
+    def test_torn_tail(self):
+        """a record cut short by a crash is dropped, the ones before it kept"""
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "kb.journal")
+            KB1 = KnowledgeBase.open(path, batch=1)
+            self.run_ops(KB1)
+            KB1.close()
+            KB2 = KnowledgeBase.open(path)
+            KB2.kb_assert(read.parse_input("fact: (dead Nosliw)"))
+            KB2.close()
+            with open(path, "r+b") as file:
+                file.truncate(os.path.getsize(path) - 3)
+            KB3 = KnowledgeBase.open(path)
+            self.assertSameKB(KB1, KB3)
+            KB3.kb_assert(read.parse_input("fact: (dead Nosliw)"))
+            KB3.close()
+            KB4 = KnowledgeBase.open(path)
+            self.assertSameKB(KB2, KB4)
+            KB4.close()
+
+class QueryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.KB = KnowledgeBase([], [])
+        for i in range(20):
+            self.KB.kb_assert(read.parse_input("fact: (inst box{} box)".format(i)))
+            self.KB.kb_assert(read.parse_input("fact: (color box{} {})".format(
+                i, "red" if i % 10 == 3 else "blue")))
+        self.KB.kb_assert(read.parse_input("fact: (on box3 box13)"))
+        self.KB.kb_assert(read.parse_input("fact: (on box4 box13)"))
+
+    def test_join(self):
+        """answers bind every variable and list the fact matched by each statement"""
+        answer = self.KB.kb_query([read.parse_input("fact: (inst ?x box)"),
+                                   read.parse_input("fact: (color ?x red)")])
+        self.assertEqual([str(b) for b in answer], ["?X : box3", "?X : box13"])
+        self.assertEqual([str(f.statement) for f in answer.list_of_bindings[0][1]],
+                         ["(inst box3 box)", "(color box3 red)"])
+        answer = self.KB.kb_query([read.parse_input("fact: (on ?x ?y)"),
+                                   read.parse_input("fact: (color ?x ?c)"),
+                                   read.parse_input("fact: (color ?y ?c)")])
+        self.assertEqual([str(b) for b in answer], ["?X : box3, ?Y : box13, ?C : red"])
+        self.assertFalse(self.KB.kb_query([read.parse_input("fact: (on ?x ?y)"),
+                                           read.parse_input("fact: (on ?y ?x)")]))
+
+    def test_plan(self):
+        """the planner starts from the most selective statement"""
+        statements = [read.parse_input("fact: (inst ?x box)").statement,
+                      read.parse_input("fact: (color ?x blue)").statement,
+                      read.parse_input("fact: (on ?x box13)").statement]
+        self.assertEqual(query.plan(statements, self.KB)[0], (2, 1.0))
+        self.assertEqual(len(list(self.KB.kb_query_iter(statements, limit=1))), 1)
+
+class BackwardTest(unittest.TestCase):
+
+    def family(self, KB, n=6):
+        for i in range(n - 1):
+            KB.kb_assert(read.parse_input("fact: (parent p{} p{})".format(i, i + 1)))
+        KB.kb_assert(read.parse_input("rule: ((parent ?x ?y)) -> (ancestor ?x ?y)"))
+        KB.kb_assert(read.parse_input(
+            "rule: ((ancestor ?x ?y) (parent ?y ?z)) -> (ancestor ?x ?z)"))
+        KB.kb_assert(read.parse_input("rule: ((ancestor ?x p5)) -> (founder ?x)"))
+
+    def test_recursive(self):
+        """left-recursive rules are proved on demand without storing their facts"""
+        KB = KnowledgeBase([], [], backward=["ancestor"])
+        self.family(KB)
+        self.assertFalse([f for f in KB.facts if f.statement.predicate == "ancestor"])
+        answer = KB.kb_ask(read.parse_input("fact: (ancestor p1 ?X)"))
+        self.assertEqual([str(b[0]) for b in answer.list_of_bindings],
+                         ["?X : p2", "?X : p3", "?X : p4", "?X : p5"])
+        self.assertTrue(KB.kb_ask(read.parse_input("fact: (ancestor p0 p5)")))
+        self.assertFalse(KB.kb_ask(read.parse_input("fact: (ancestor p5 p0)")))
+
+    def test_forward_rule_on_backward_predicate(self):
+        """forward rules using a backward predicate are answered the same as eagerly"""
+        KB1 = KnowledgeBase([], [])
+        KB2 = KnowledgeBase([], [], backward=["ancestor"])
+        for KB in [KB1, KB2]:
+            self.family(KB)
+            KB.kb_retract(read.parse_input("fact: (parent p2 p3)"))
+        ask = read.parse_input("fact: (founder ?X)")
+        self.assertEqual([str(b[0]) for b in KB1.kb_ask(ask).list_of_bindings],
+                         [str(b[0]) for b in KB2.kb_ask(ask).list_of_bindings])
+        self.assertEqual(len(KB2.kb_ask(ask)), 2)
+
+class CacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.KB = KnowledgeBase([], [], cache=QueryCache(max_entries=2))
+        for i in range(5):
+            self.KB.kb_assert(read.parse_input("fact: (inst box{} box)".format(i)))
+        self.KB.kb_assert(read.parse_input("fact: (color box1 red)"))
+        self.KB.kb_assert(read.parse_input(
+            "rule: ((inst ?x box) (color ?x red)) -> (fragile ?x)"))
+
+    def test_hits(self):
+        """queries differing only in variable names share an entry"""
+        self.assertEqual(len(self.KB.kb_ask(read.parse_input("fact: (inst ?x box)"))), 5)
+        answer = self.KB.kb_ask(read.parse_input("fact: (inst ?y box)"))
+        self.assertEqual(str(answer.list_of_bindings[0][0]), "?Y : box0")
+        self.assertEqual(len(list(self.KB.kb_ask_iter(
+            read.parse_input("fact: (inst ?z box)"), limit=2))), 2)
+        stats = self.KB.cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (2, 1))
+
+    def test_invalidation(self):
+        """adding or retracting a matching fact drops only the entries it matches"""
+        inst = read.parse_input("fact: (inst ?x box)")
+        fragile = read.parse_input("fact: (fragile ?x)")
+        self.KB.kb_ask(inst)
+        self.KB.kb_ask(fragile)
+        self.KB.kb_assert(read.parse_input("fact: (color box2 red)"))
+        self.assertEqual(len(self.KB.cache), 1)
+        self.assertEqual(len(self.KB.kb_ask(fragile)), 2)
+        self.KB.kb_retract(read.parse_input("fact: (inst box1 box)"))
+        self.assertEqual(len(self.KB.kb_ask(inst)), 4)
+        self.assertEqual(len(self.KB.kb_ask(fragile)), 1)
+        self.assertEqual(self.KB.cache.stats()["invalidations"], 3)
+
+    def test_eviction(self):
+        """the least recently used entry goes first once the cache is full"""
+        for ask in ["(inst ?x box)", "(color ?x red)", "(inst ?x box)", "(fragile ?x)"]:
+            self.KB.kb_ask(read.parse_input("fact: " + ask))
+        self.assertEqual(self.KB.cache.evictions, 1)
+        self.assertIsNone(self.KB.cache.get(read.parse_input("fact: (color ?x red)").statement))
+        KB = KnowledgeBase([], [], cache=QueryCache(max_bytes=0))
+        KB.kb_ask(read.parse_input("fact: (inst ?x box)"))
+        self.assertEqual(len(KB.cache), 0)
+
+    def test_restored(self):
+        """KBs loaded from a snapshot or journal take a cache too"""
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "kb.snap")
+            self.KB.save(path)
+            journal = os.path.join(directory, "kb.journal")
+            for KB in (KnowledgeBase.load(path, cache=QueryCache()),
+                       KnowledgeBase.open(journal, path, cache=QueryCache())):
+                ask = read.parse_input("fact: (fragile ?x)")
+                self.assertEqual(len(KB.kb_ask(ask)), 1)
+                self.assertEqual(len(KB.kb_ask(ask)), 1)
+                self.assertEqual(KB.cache.stats()["hits"], 1)
+                KB.close()
+
+class SharedTest(unittest.TestCase):
+
+    def setUp(self):
+        self.KB = SharedKnowledgeBase(KnowledgeBase([], []))
+        self.KB.kb_assert(read.parse_input("rule: ((inst ?x box)) -> (boxed ?x)"))
+
+    def test_generations(self):
+        """readers keep the generation they started from"""
+        before = self.KB.snapshot()
+        self.KB.kb_assert(read.parse_input("fact: (inst box1 box)"))
+        self.assertFalse(before.kb_ask(read.parse_input("fact: (boxed ?x)")))
+        self.assertEqual(len(self.KB.kb_ask(read.parse_input("fact: (boxed ?x)"))), 1)
+        self.KB.kb_retract(read.parse_input("fact: (inst box1 box)"))
+        self.assertFalse(self.KB.kb_ask(read.parse_input("fact: (boxed ?x)")))
+        self.assertEqual(self.KB.snapshot().number, before.number + 2)
+
+    def test_publish(self):
+        """a write only touches the buckets of the facts it changes"""
+        for i in range(1000):
+            self.KB.kb_assert(read.parse_input("fact: (inst box{} box)".format(i)))
+        self.KB.kb_assert(read.parse_input("fact: (on a b)"))
+        index = self.KB.snapshot().index
+        table = dict((key, (bucket, len(bucket.entries))) for key, bucket in index.table.items())
+        self.KB.kb_assert(read.parse_input("fact: (on c b)"))
+        self.assertIs(self.KB.snapshot().index, index)
+        changed = [key for key, bucket in index.table.items()
+                   if table.get(key) != (bucket, len(bucket.entries))]
+        self.assertEqual(sorted(changed, key=str), sorted(
+            [("on", 2), ("on", 2, 1, "c"), ("on", 2, 2, "b")], key=str))
+
+    def test_compaction(self):
+        """generations keep their facts once removals compact the buckets"""
+        for i in range(100):
+            self.KB.kb_assert(read.parse_input("fact: (inst box{} box)".format(i)))
+        before = self.KB.snapshot()
+        for i in range(80):
+            self.KB.kb_retract(read.parse_input("fact: (inst box{} box)".format(i)))
+        bucket = self.KB.snapshot().index.table[("boxed", 1)]
+        self.assertLess(len(bucket.entries), 100)
+        self.assertIsNotNone(bucket.previous)
+        self.assertEqual(len(before.kb_ask(read.parse_input("fact: (boxed ?x)"))), 100)
+        self.assertEqual(len(self.KB.kb_ask(read.parse_input("fact: (boxed ?x)"))), 20)
+        self.assertEqual(self.KB.snapshot().count(read.parse_input("fact: (boxed ?x)").statement),
+                         len(bucket.entries))
+        # once no generation reads them, compaction lets the old copies go
+        del before
+        gc.collect()
+        for i in range(20, 100):
+            self.KB.kb_assert(read.parse_input("fact: (boxed extra{})".format(i)))
+        for i in range(80, 100):
+            self.KB.kb_retract(read.parse_input("fact: (inst box{} box)".format(i)))
+        for i in range(20, 100):
+            self.KB.kb_retract(read.parse_input("fact: (boxed extra{})".format(i)))
+        bucket = self.KB.snapshot().index.table[("boxed", 1)]
+        self.assertIsNone(bucket.previous.previous)
+        self.assertFalse(self.KB.kb_ask(read.parse_input("fact: (boxed ?x)")))
+
+    def test_threads(self):
+        """concurrent readers only see states between write batches"""
+        errors = []
+
+        def write(k):
+            for i in range(50):
+                fact = read.parse_input("fact: (inst box{}_{} box)".format(k, i))
+                self.KB.kb_assert(fact)
+                if i % 3 == 0:
+                    self.KB.kb_retract(read.parse_input(
+                        "fact: (inst box{}_{} box)".format(k, i)))
+
+        def check():
+            for _ in range(200):
+                generation = self.KB.snapshot()
+                boxes = generation.kb_ask(read.parse_input("fact: (inst ?x box)"))
+                boxed = generation.kb_ask(read.parse_input("fact: (boxed ?x)"))
+                if len(boxes) != len(boxed):
+                    errors.append(generation.number)
+
+        threads = [threading.Thread(target=write, args=(k,)) for k in range(4)]
+        threads += [threading.Thread(target=check) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(self.KB.kb_ask(read.parse_input("fact: (boxed ?x)"))), 4 * 33)
+        self.assertEqual(len(self.KB.kb_query([read.parse_input("fact: (inst ?x box)"),
+                                               read.parse_input("fact: (boxed ?x)")])), 4 * 33)
+
+class CompilerTest(unittest.TestCase):
+
+    def test_same_as_generic(self):
+        """compiled rules match and instantiate as util.match and instantiate do"""
+        rules = ["rule: ((inst ?x ?y) (isa ?y ?z)) -> (inst ?x ?z)",
+                 "rule: ((on ?x ?x) (big ?y)) -> (odd ?x ?y)",
+                 "rule: ((on ?x table)) -> (flat ?x ?w)",
+                 "rule: ((on a b)) -> (stacked)"]
+        facts = ["fact: (inst box1 box)", "fact: (inst ?b box)", "fact: (on c c)",
+                 "fact: (on c d)", "fact: (on ?a ?a)", "fact: (on ?a c)",
+                 "fact: (on c table)", "fact: (on c ?t)", "fact: (on a b)",
+                 "fact: (on a b c)", "fact: (isa box container)"]
+        compiler = RuleCompiler()
+        for rule in [read.parse_input(r) for r in rules]:
+            for fact in [read.parse_input(f) for f in facts]:
+                expected = _slow(rule, fact.statement)
+                found = compiler.get(rule)(fact.statement)
+                if expected is None:
+                    self.assertIsNone(found)
+                else:
+                    self.assertEqual(found, expected)
+
+    def test_shapes_shared(self):
+        """curried rules differing only in constants reuse their shape's code"""
+        compiler = RuleCompiler()
+        for i in range(5):
+            rule = read.parse_input(
+                "rule: ((isa box{} ?z) (big ?z)) -> (bigbox box{})".format(i, i))
+            compiler.get(rule)
+        self.assertEqual((len(compiler.rules), len(compiler.shapes)), (5, 1))
+
+    def test_removed_rules_dropped(self):
+        """retracting the fact a curried rule came from drops its function"""
+        KB = KnowledgeBase([], [])
+        KB.kb_assert(read.parse_input("rule: ((inst ?x ?y) (isa ?y ?z)) -> (inst ?x ?z)"))
+        KB.kb_assert(read.parse_input("fact: (inst box1 box)"))
+        KB.kb_assert(read.parse_input("fact: (isa box container)"))
+        compiled = KB.ie.compiler.rules
+        self.assertEqual(len(compiled), 2)
+        KB.kb_retract(read.parse_input("fact: (inst box1 box)"))
+        self.assertEqual(len(KB.rules), 1)
+        self.assertEqual(list(compiled), list(KB.rules))
+
+class MetricsTest(unittest.TestCase):
+
+    def test_counters(self):
+        """inference is charged to the asserted rule curried rules come from"""
+        KB = KnowledgeBase([], [], metrics=Metrics())
+        KB.kb_assert(read.parse_input("rule: ((inst ?x ?y) (isa ?y ?z)) -> (inst ?x ?z)"))
+        KB.kb_assert(read.parse_input("rule: ((inst ?x box)) -> (flat ?x)"))
+        KB.kb_assert(read.parse_input("fact: (isa box container)"))
+        KB.kb_assert(read.parse_input("fact: (inst box1 box)"))
+        KB.kb_assert(read.parse_input("fact: (inst box2 box)"))
+        KB.kb_retract(read.parse_input("fact: (isa box container)"))
+        snapshot = KB.metrics.snapshot()
+        isa = snapshot["rules"]["((inst ?x ?y) (isa ?y ?z)) -> (inst ?x ?z)"]
+        self.assertEqual((isa["matches"], isa["bindings"], isa["facts"], isa["rules"]),
+                         (6, 6, 2, 4))
+        flat = snapshot["rules"]["((inst ?x box)) -> (flat ?x)"]
+        self.assertEqual((flat["matches"], flat["facts"]), (2, 2))
+        self.assertEqual(snapshot["fc_infer"]["facts"], 4)
+        self.assertEqual((snapshot["kb_retract"]["calls"], snapshot["kb_retract"]["removed"]),
+                         (1, 3))
+        self.assertEqual(json.loads(KB.metrics.to_json()), snapshot)
+        # only the curried rules left in the KB keep a root
+        self.assertEqual(sorted(map(id, KB.metrics.roots)),
+                         sorted(id(rule) for rule in KB.rules if not rule.asserted))
+
+    def test_other_engines(self):
+        """engines that do not report to Metrics reject them"""
+        for engine in (ReteEngine, SemiNaiveEngine):
+            with self.assertRaises(ValueError):
+                KnowledgeBase([], [], engine(), metrics=Metrics())
+
+    def test_restored(self):
+        """KBs loaded from a snapshot or journal take metrics too"""
+        KB = KnowledgeBase([], [])
+        KB.kb_assert(read.parse_input("rule: ((inst ?x box)) -> (flat ?x)"))
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "kb.snap")
+            KB.save(path)
+            journal = os.path.join(directory, "kb.journal")
+            for KB in (KnowledgeBase.load(path, metrics=Metrics()),
+                       KnowledgeBase.open(journal, path, metrics=Metrics())):
+                KB.kb_assert(read.parse_input("fact: (inst box1 box)"))
+                flat = KB.metrics.snapshot()["rules"]["((inst ?x box)) -> (flat ?x)"]
+                self.assertEqual((flat["matches"], flat["facts"]), (1, 1))
+                KB.close()
+
+class ExplainTest(unittest.TestCase):
+
+    def setUp(self):
+        self.KB = KnowledgeBase([], [])
+        for line in ("rule: ((inst ?x ?y) (isa ?y ?z)) -> (inst ?x ?z)",
+                     "fact: (inst cube1 cube)", "fact: (isa cube box)",
+                     "fact: (isa box container)", "fact: (isa container thing)",
+                     "fact: (isa cube thing)"):
+            self.KB.kb_assert(read.parse_input(line))
+
+    def test_shortest_first(self):
+        """each proof ends in its own pair and proves the rest in fewest steps"""
+        fact = read.parse_input("fact: (inst cube1 thing)")
+        proofs = self.KB.kb_explain(fact, max_proofs=5, shortest=True)
+        self.assertEqual([p.height for p in proofs], [2, 6])
+        self.assertEqual([str(f.statement) if isinstance(f, Fact) else "rule"
+                          for f in proofs[0].leaves()],
+                         ["(isa cube thing)", "(inst cube1 cube)", "rule"])
+        self.assertIn("(asserted)", str(proofs[1]))
+        self.assertEqual([p.height for p in self.KB.kb_explain(fact, 4, 5, True)], [2])
+        self.assertEqual([p.height for p in self.KB.kb_explain(fact, max_proofs=5)], [6, 2])
+        self.assertEqual([p.height for p in self.KB.kb_explain(fact, 4, 5)], [2])
+
+    def test_changes(self):
+        """proofs are rebuilt after the KB changes"""
+        fact = read.parse_input("fact: (inst cube1 thing)")
+        self.assertEqual(self.KB.kb_explain(fact, shortest=True)[0].height, 2)
+        self.KB.kb_retract(read.parse_input("fact: (isa cube thing)"))
+        self.assertEqual([p.height for p in self.KB.kb_explain(fact, max_proofs=5)], [6])
+        self.KB.kb_assert(fact)
+        self.assertEqual([p.height for p in self.KB.kb_explain(fact, max_proofs=5)], [0, 6])
+        self.assertEqual(self.KB.kb_explain(read.parse_input("fact: (inst cube2 thing)")), [])
+
+    def test_cycles(self):
+        """proofs never go round a cycle of support"""
+        KB = KnowledgeBase([], [])
+        KB.kb_assert(read.parse_input("rule: ((near ?x ?y)) -> (near ?y ?x)"))
+        KB.kb_assert(read.parse_input("fact: (near a b)"))
+        for shortest in (False, True):
+            proofs = KB.kb_explain(read.parse_input("fact: (near b a)"), None, 5, shortest)
+            self.assertEqual([p.height for p in proofs], [1])
+            proofs = KB.kb_explain(read.parse_input("fact: (near a b)"), None, 5, shortest)
+            self.assertEqual([p.height for p in proofs], [0])
+        # a fact supporting itself
+        for engine in (InferenceEngine, ReteEngine, SemiNaiveEngine):
+            KB = KnowledgeBase([], [], engine())
+            KB.kb_assert(read.parse_input("rule: ((p ?x)) -> (r ?x)"))
+            KB.kb_assert(read.parse_input("rule: ((r ?x)) -> (r ?x)"))
+            KB.kb_assert(read.parse_input("fact: (p a)"))
+            for shortest in (False, True):
+                proofs = KB.kb_explain(read.parse_input("fact: (r a)"), None, 5, shortest)
+                self.assertEqual([p.height for p in proofs], [1])
+
+    def test_remembered_through_node(self):
+        """a pair whose remembered proof goes through the node is proved again"""
+        KB = KnowledgeBase([], [])
+        for line in ("rule: ((p ?x)) -> (n ?x)", "rule: ((n ?x)) -> (m ?x)",
+                     "rule: ((m ?x)) -> (n ?x)", "rule: ((m ?x)) -> (x ?x)",
+                     "rule: ((s ?x)) -> (t ?x)", "rule: ((t ?x)) -> (m ?x)",
+                     "fact: (p a)", "fact: (s a)"):
+            KB.kb_assert(read.parse_input(line))
+        n = read.parse_input("fact: (n a)")
+        # (m a) is first proved from (n a), while explaining (x a)
+        self.assertEqual(KB.kb_explain(read.parse_input("fact: (x a)"))[0].height, 3)
+        self.assertEqual([p.height for p in KB.kb_explain(n, max_proofs=5)], [1, 3])
+        self.assertEqual([p.height for p in KB.kb_explain(n, None, 5, True)], [1, 3])
+
 def pprint_justification(answer):
     """Pretty prints (hence pprint) justifications for the answer.
     """
@@ -0,0 +1,154 @@
+"""Counters and timers for inference and retraction, see Metrics.
+
+Enable them with KnowledgeBase([], [], metrics=Metrics()). InferenceEngine
+then reports every fc_infer call to the KB's Metrics, which files it under the
+asserted rule it descends from: curried rules are charged to the rule they
+were curried from, so a slow assert can be traced to the rule responsible.
+kb_retract reports the time spent removing what a retraction leaves
+unsupported. With metrics None, the default, each call costs one attribute
+test.
+
+Only InferenceEngine reports to Metrics: the Rete, semi-naive and parallel
+engines match rules by other means than fc_infer, so a KB using one of them
+rejects metrics rather than report empty per-rule counters.
+
+The figures are exported by snapshot(), a dict of plain values, and to_json().
+"""
+import json
+import time
+from logical_classes import Fact
+
+class Metrics(object):
+    """Inference and retraction counters of a KnowledgeBase
+
+    Attributes:
+        rules (dictof dict): maps each asserted rule to its counters:
+            matches (fc_infer calls with it or its curried rules), bindings
+            (those that matched), facts and rules (derived, new to the KB),
+            seconds (spent in fc_infer)
+        roots (dictof Rule): maps each curried rule in the KB to the asserted
+            rule it descends from
+        retracts (int): kb_retract calls that left a fact or rule unsupported
+        removed (int): facts removed by them
+        retract_seconds (float): time spent removing
+    """
+    def __init__(self):
+        """Constructor for Metrics
+        """
+        super(Metrics, self).__init__()
+        self.reset()
+
+    def __repr__(self):
+        """Define internal string representation
+        """
+        return 'Metrics({!r})'.format(self.snapshot())
+
+    def reset(self):
+        """Zero every counter
+        """
+        self.rules = {}
+        self.roots = {}
+        self.retracts = 0
+        self.removed = 0
+        self.retract_seconds = 0.0
+
+    def infer(self, engine, fact, rule, kb):
+        """Run and time engine.fc_infer(fact, rule, kb)
+
+        Args:
+            engine (InferenceEngine): engine to run
+            fact (Fact): fact to pair with the rule
+            rule (Rule): rule to pair with the fact
+            kb (KnowledgeBase): KB inferred into
+        """
+        counters = self._counters(rule)
+        counters["matches"] += 1
+        started = time.perf_counter()
+        engine.fc_infer(fact, rule, kb)
+        counters["seconds"] += time.perf_counter() - started
+
+    def derived(self, rule, item, new):
+        """Count a fact or rule inferred by fc_infer from a rule
+
+        Args:
+            rule (Rule): rule matched
+            item (Fact|Rule): fact or curried rule inferred
+            new (bool): whether the item is new to the KB, rather than a new
+                support for one already there
+        """
+        counters = self._counters(rule)
+        counters["bindings"] += 1
+        if not new:
+            return
+        if isinstance(item, Fact):
+            counters["facts"] += 1
+        else:
+            counters["rules"] += 1
+            self.roots[item] = self.roots.get(rule, rule)
+
+    def rule_removed(self, rule):
+        """Forget the root of a curried rule removed from the KB. The rules
+            curried from it map to the asserted rule directly, so they keep
+            theirs.
+
+        Args:
+            rule (Rule): rule removed
+        """
+        self.roots.pop(rule, None)
+
+    def retract(self, kb, node):
+        """Run and time kb._retract_unfounded(node)
+
+        Args:
+            kb (KnowledgeBase): KB retracted from
+            node (Fact|Rule): node no longer asserted
+        """
+        before = len(kb.facts)
+        started = time.perf_counter()
+        kb._retract_unfounded(node)
+        self.retract_seconds += time.perf_counter() - started
+        self.retracts += 1
+        self.removed += before - len(kb.facts)
+
+    def snapshot(self):
+        """Get the counters as plain values
+
+        Returns:
+            dict: fc_infer totals, the counters of each asserted rule, keyed by
+                the rule written as in the statement files, most time first,
+                and the kb_retract totals
+        """
+        rules = sorted(self.rules.items(), key=lambda item: -item[1]["seconds"])
+        totals = dict((name, sum(c[name] for _, c in rules))
+                      for name in ("matches", "bindings", "facts", "rules", "seconds"))
+        return {"fc_infer": totals,
+                "rules": dict((_label(rule), dict(c)) for rule, c in rules),
+                "kb_retract": {"calls": self.retracts, "removed": self.removed,
+                               "seconds": self.retract_seconds}}
+
+    def to_json(self, **kwargs):
+        """Get the snapshot as JSON
+
+        Args:
+            kwargs: passed on to json.dumps, e.g. indent
+
+        Returns:
+            str
+        """
+        return json.dumps(self.snapshot(), **kwargs)
+
+    def _counters(self, rule):
+        """Get the counters of the asserted rule a rule descends from
+        """
+        root = self.roots.get(rule, rule)
+        counters = self.rules.get(root)
+        if counters is None:
+            counters = self.rules[root] = {"matches": 0, "bindings": 0, "facts": 0,
+                                           "rules": 0, "seconds": 0.0}
+        return counters
+
+def _label(rule):
+    """Write a rule as in the statement files, e.g.
+        ((inst ?x ?y) (isa ?y ?z)) -> (inst ?x ?z)
+    """
+    return "({}) -> {}".format(" ".join(str(s) for s in rule.lhs), rule.rhs)
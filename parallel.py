@@ -0,0 +1,226 @@
+"""Semi-naive evaluation with the joins of each round spread over processes.
+
+Select it with KnowledgeBase([], [], ParallelEngine(workers=8)), typically for
+bulk loads through kb_assert_many. It is a datalog.SemiNaiveEngine whose large
+rounds are run by a pool of worker processes, each holding a replica of the
+KB's facts and rules. Each round, the master sends every worker the facts
+stored and removed since the last round, and a share of the work: a hash
+partition of the delta, and of the rules added since the last round. Workers
+join their share against their replica and return the complete matches as
+fact numbers and bindings. The master then derives them through
+SemiNaiveEngine._derive, in the order the serial engine would, and the facts
+derived make up the next round's delta.
+
+A round only reads the facts stored when it starts, since those derived
+during it stay queued until the next, so splitting its joins does not change
+what they find. The closure and its provenance are those of SemiNaiveEngine.
+Rounds with a delta smaller than the threshold run serially.
+"""
+import multiprocessing
+from logical_classes import *
+from datalog import SemiNaiveEngine
+from index import FactStore
+from util import match
+
+class ParallelEngine(SemiNaiveEngine):
+    """SemiNaiveEngine running large rounds on worker processes
+
+    Attributes:
+        workers (int): number of worker processes
+        threshold (int): smallest delta run on the workers
+        pool (listof (Process, Connection)|None): the workers, started by the
+            first parallel round
+        shipped (listof Fact|None): facts sent to the workers, by number,
+            None once removed
+        numbers (dictof int): maps id(fact) to its number for shipped facts
+        unshipped (dictof Fact): facts stored since the last parallel round,
+            by id
+        removed (listof int): numbers of shipped facts removed since
+        sent (int): number of rules sent to the workers
+    """
+    def __init__(self, workers=None, threshold=1000):
+        """Constructor for ParallelEngine
+
+        Args:
+            workers (int|None): number of worker processes, one per CPU if None
+            threshold (int): smallest delta run on the workers
+        """
+        super(ParallelEngine, self).__init__()
+        self.workers = workers or multiprocessing.cpu_count()
+        self.threshold = threshold
+        self.pool = None
+        self.shipped = []
+        self.numbers = {}
+        self.unshipped = {}
+        self.removed = []
+        self.sent = 0
+
+    def fact_added(self, fact, kb):
+        """Collect a fact just added to the KB into the next delta and the
+            next update of the replicas
+        """
+        super(ParallelEngine, self).fact_added(fact, kb)
+        if self.pool is not None:
+            self.unshipped[id(fact)] = fact
+
+    def fact_removed(self, fact, kb):
+        """Drop a fact removed from the KB from the next update of the replicas
+        """
+        if self.pool is None:
+            return
+        if self.unshipped.pop(id(fact), None) is None and id(fact) in self.numbers:
+            number = self.numbers.pop(id(fact))
+            self.shipped[number] = None
+            self.removed.append(number)
+
+    def flush(self, kb):
+        """Run one semi-naive iteration, on the workers if the delta is large
+
+        Args:
+            kb (KnowledgeBase) - A KnowledgeBase
+        """
+        delta = [f for f in self.delta if kb._get_fact(f) is f]
+        if len(delta) < self.threshold:
+            super(ParallelEngine, self).flush(kb)
+            return
+        new_rules = self.new_rules
+        self.delta = []
+        self.new_rules = []
+        if self.pool is None:
+            self._start(kb)
+        added = []
+        for fact in self.unshipped.values():
+            self.numbers[id(fact)] = len(self.shipped)
+            added.append((len(self.shipped), fact.statement.key))
+            self.shipped.append(fact)
+        self.unshipped = {}
+        removed = self.removed
+        self.removed = []
+        rules = [(rule.lhs, rule.rhs) for rule in self.rules[self.sent:] + new_rules]
+        rules = [([s.key for s in lhs], rhs.key) for lhs, rhs in rules]
+        self.sent = len(self.rules) + len(new_rules)
+        numbers = [self.numbers[id(fact)] for fact in delta]
+        first = len(self.rules)
+        for k, (_, conn) in enumerate(self.pool):
+            conn.send((added, removed, rules, len(rules) - len(new_rules), numbers,
+                       range(k, len(delta), self.workers),
+                       range(first + k, first + len(new_rules), self.workers)))
+        matches = []
+        for _, conn in self.pool:
+            matches.extend(conn.recv())
+        # the serial engine's order: delta facts first, then new rules
+        matches.sort(key=lambda m: (m[0], m[1]))
+        for rule in new_rules:
+            self._register(rule)
+        for _, _, r, facts, bindings in matches:
+            self._derive(self.rules[r], [self.shipped[n] for n in facts], bindings, kb)
+
+    def close(self):
+        """Stop the worker processes, if started
+        """
+        if self.pool is None:
+            return
+        for process, conn in self.pool:
+            conn.send(None)
+            conn.close()
+            process.join()
+        self.pool = None
+
+    def _start(self, kb):
+        """Start the workers, and queue every stored fact for shipping, as
+            the replicas start empty
+        """
+        self.pool = []
+        for _ in range(self.workers):
+            conn, child = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=_work, args=(child,), daemon=True)
+            process.start()
+            child.close()
+            self.pool.append((process, conn))
+        self.unshipped = dict((id(fact), fact) for fact in kb.facts)
+
+class _Replica(SemiNaiveEngine):
+    """A worker's copy of the master's facts and rules, collecting complete
+        matches instead of deriving them
+
+    Attributes:
+        facts (FactStore): replicated facts
+        by_number (dictof Fact): replicated facts by their master's number
+        numbers (dictof int): maps id(fact) to the master's number of a
+            replicated fact
+        rule_numbers (dictof int): maps id(rule) to its position in self.rules
+        pending (dict): always empty, as for a KB between rounds
+        found (listof tuple): (order, sequence, rule number, fact numbers,
+            bindings) of each complete match this round
+        order (int): order of the task being joined
+    """
+    def __init__(self):
+        """Constructor for _Replica
+        """
+        super(_Replica, self).__init__()
+        self.facts = FactStore()
+        self.by_number = {}
+        self.numbers = {}
+        self.pending = {}
+        self.rule_numbers = {}
+        self.found = []
+        self.order = 0
+
+    def _register(self, rule):
+        """Index a rule, numbered as the master numbers it
+        """
+        self.rule_numbers[id(rule)] = len(self.rules)
+        super(_Replica, self)._register(rule)
+
+    def round(self, added, removed, rules, old, delta, facts_share, rules_share):
+        """Update the replica, join this worker's share of a round, and
+            return its matches, see ParallelEngine.flush
+        """
+        for number in removed:
+            fact = self.by_number.pop(number)
+            self.facts.remove(fact)
+            del self.numbers[id(fact)]
+        for number, key in added:
+            fact = Fact(list(key))
+            self.facts.add(fact)
+            self.by_number[number] = fact
+            self.numbers[id(fact)] = number
+        rules = [Rule([[list(s) for s in lhs], list(rhs)]) for lhs, rhs in rules]
+        for rule in rules[:old]:
+            self._register(rule)
+        self.found = []
+        delta = [self.by_number[n] for n in delta]
+        fresh = set(delta)
+        for k in facts_share:
+            self.order = k
+            fact = delta[k]
+            key = fact.statement.key
+            for rule, i in self.positions.get((key[0], len(key) - 1), ()):
+                found = match(rule.lhs[i], fact.statement)
+                if found:
+                    self._join(rule, i, 0, {i: fact}, found.bindings_dict, fresh, self)
+        for rule in rules[old:]:
+            self._register(rule)
+        for r in rules_share:
+            self.order = len(delta) + r
+            self._join(self.rules[r], None, 0, {}, {}, set(), self)
+        return self.found
+
+    def _derive(self, rule, facts, bindings, kb):
+        """Record a complete match for the master to derive
+        """
+        self.found.append((self.order, len(self.found), self.rule_numbers[id(rule)],
+                           [self.numbers[id(f)] for f in facts], bindings))
+
+def _work(conn):
+    """Serve rounds for a ParallelEngine until told to stop
+
+    Args:
+        conn (Connection): pipe to the master
+    """
+    replica = _Replica()
+    while True:
+        message = conn.recv()
+        if message is None:
+            return
+        conn.send(replica.round(*message))
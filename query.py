@@ -0,0 +1,165 @@
+"""Conjunctive queries over a KB, see KnowledgeBase.kb_query.
+
+A query is a list of statements sharing variables, e.g.
+    (inst ?x box) (color ?x red)
+and its answers are the bindings that match every statement to a fact. The
+planner orders the statements greedily, taking next the one with the fewest
+estimated matches given the variables bound so far. Estimates come from the
+fact store's statistics: the facts filed under the statement's predicate and
+constants, divided by the number of distinct values of each argument a bound
+variable joins on.
+
+Each statement is then joined on its variables already bound. A hash join
+matches the statement once and files its matches in a table keyed on those
+variables. Where fewer partial answers are expected than the statement
+matches, each one's instance of the statement is looked up in the index
+instead. Both are linear in the matches and answers, and the joins are
+pipelined, so kb_query_iter stops early once it has enough answers.
+"""
+from logical_classes import *
+from rete import substitute
+
+def variables(statement):
+    """Get the variables of a statement, in order of appearance
+
+    Args:
+        statement (Statement): statement to scan
+
+    Returns:
+        listof str: variable names, each once
+    """
+    found = []
+    for t in statement.terms:
+        if t.var and t.term.element not in found:
+            found.append(t.term.element)
+    return found
+
+def estimate(statement, bound, kb):
+    """Estimate the matches of a statement once some variables are bound
+
+    Args:
+        statement (Statement): statement to estimate
+        bound (setof str): variables bound by the statements joined before
+        kb (KnowledgeBase): KB whose facts are queried
+
+    Returns:
+        float: expected matches per partial answer
+    """
+    if kb.backward and kb.prover.proves(statement):
+        # not stored, so not counted: join such statements last
+        return float("inf")
+    rows = float(kb.facts.count(statement))
+    for pos, t in enumerate(statement.terms):
+        if t.var and t.term.element in bound:
+            rows /= max(1, kb.facts.values(statement.predicate, len(statement.terms), pos + 1))
+    return rows
+
+def plan(statements, kb):
+    """Order the statements of a query for joining, most selective first
+
+    Args:
+        statements (listof Statement): the query
+        kb (KnowledgeBase): KB whose facts are queried
+
+    Returns:
+        listof (int, float): the position of each statement in the query, in
+            join order, with the partial answers expected before joining it
+    """
+    remaining = list(range(len(statements)))
+    bound = set()
+    answers = 1.0
+    order = []
+    while remaining:
+        costs = dict((i, estimate(statements[i], bound, kb)) for i in remaining)
+        best = min(remaining, key=lambda i: (costs[i], i))
+        order.append((best, answers))
+        answers *= costs[best]
+        remaining.remove(best)
+        bound.update(variables(statements[best]))
+    return order
+
+def execute(statements, kb, limit=None):
+    """Answer a conjunctive query
+
+    Args:
+        statements (listof Statement): the query
+        kb (KnowledgeBase): KB whose facts are queried
+        limit (int|None): maximum number of answers
+
+    Returns:
+        iterator of (Bindings, listof Fact): the bindings of each answer, for
+            the query's variables in order of appearance, and the fact each
+            statement matched, in query order
+    """
+    if not statements:
+        return
+    order = plan(statements, kb)
+    names = []
+    for statement in statements:
+        names.extend(v for v in variables(statement) if v not in names)
+    first = statements[order[0][0]]
+    rows = ((binding.bindings_dict, (matched[0],))
+            for binding, matched in kb.kb_ask_iter(Fact(first)))
+    bound = set(variables(first))
+    for i, expected in order[1:]:
+        statement = statements[i]
+        joins = [v for v in variables(statement) if v in bound]
+        if joins and expected < estimate(statement, set(), kb):
+            rows = _lookup_join(rows, statement, kb)
+        else:
+            rows = _hash_join(rows, statement, joins, kb)
+        bound.update(variables(statement))
+    # where each statement of the query was joined
+    joined = [0] * len(statements)
+    for k, (i, _) in enumerate(order):
+        joined[i] = k
+    found = 0
+    for values, facts in rows:
+        bindings = Bindings()
+        bindings.bindings_dict = dict((name, values[name]) for name in names)
+        yield bindings, [facts[k] for k in joined]
+        found += 1
+        if found == limit:
+            return
+
+def _hash_join(rows, statement, joins, kb):
+    """Join partial answers with the matches of a statement through a hash
+        table of the matches, keyed on the join variables
+
+    Args:
+        rows (iterator of (dict, tuple)): partial answers, as variable
+            bindings and the facts matched so far in join order
+        statement (Statement): statement to join
+        joins (listof str): variables of the statement bound in the rows
+
+    Returns:
+        iterator of (dict, tuple): the extended answers
+    """
+    table = None
+    for values, facts in rows:
+        if table is None:
+            # built on the first partial answer, so an empty join never scans
+            table = {}
+            for binding, matched in kb.kb_ask_iter(Fact(statement)):
+                found = binding.bindings_dict
+                key = tuple(found[v] for v in joins)
+                table.setdefault(key, []).append((found, matched[0]))
+        for found, fact in table.get(tuple(values[v] for v in joins), ()):
+            merged = values.copy()
+            merged.update(found)
+            yield merged, facts + (fact,)
+
+def _lookup_join(rows, statement, kb):
+    """Join partial answers with a statement by looking up each answer's
+        instance of the statement in the index
+
+    Args: as for _hash_join
+
+    Returns:
+        iterator of (dict, tuple): the extended answers
+    """
+    for values, facts in rows:
+        for binding, matched in kb.kb_ask_iter(Fact(substitute(statement, values))):
+            merged = values.copy()
+            merged.update(binding.bindings_dict)
+            yield merged, facts + (matched[0],)
@@ -1,5 +1,31 @@
 from logical_classes import *
 
+import re
+
+# the tokens of a statement: parentheses, the rule arrow, and terms
+TOKEN = re.compile(r"\(|\)|->|[^\s()]+")
+# stands for the rule arrow in parsed groups
+ARROW = object()
+SPECIAL = frozenset(["(", ")", "->"])
+
+class ParseError(ValueError):
+    """Raised for malformed input, with the line it was found on
+
+    Attributes:
+        line (int|None): line number, from 1, or None if not read from a file
+    """
+    def __init__(self, message, line=None):
+        """Constructor for ParseError
+
+        Args:
+            message (str): what is wrong
+            line (int|None): line number the problem was found on
+        """
+        if line is not None:
+            message = "line {}: {}".format(line, message)
+        super(ParseError, self).__init__(message)
+        self.line = line
+
 # read_tokenize takes the name of a file, reads it in and tokenizes the
 # statements and rules in that file.
 def read_tokenize(file):
@@ -16,24 +42,119 @@ def read_tokenize(file):
     Returns:
         A list of Facts and Rules.
     """
-    file = open(file, "r")
-    elements = []
-    current = ""
-    for line in file:
-        if line[0:5] in ("fact:", "rule:"):
-            elements.append(current)
-            current = line.rstrip()
-        else:
-            current = current + " " + line.rstrip().strip()
-    elements.append(current)
-    output = []
-    for e in elements:
-        parsed = parse_input(e)
-        if isinstance(parsed, Fact) or isinstance(parsed, Rule):
-            output.append(parsed)
-    file.close()
-    return output
+    return list(iter_tokenize(file))
 
+def iter_tokenize(file):
+    """Reads a file one line at a time, yielding each fact and rule as soon as
+        it is complete, so only one statement is held in memory. Statements
+        may continue over several lines; blank lines and lines starting with
+        `#` are skipped. Feed it to KnowledgeBase.kb_assert_many to load a
+        file of any size.
+
+    Args:
+        file (str|iterable of str): name of the file, or its lines
+
+    Yields:
+        Fact|Rule
+
+    Raises:
+        ParseError: for a malformed statement, with its line number
+    """
+    lines = open(file, "r") if isinstance(file, str) else file
+    try:
+        header = None
+        chunks = []
+        for number, line in enumerate(lines, 1):
+            line = line.strip()
+            if not line or line[0] == "#":
+                continue
+            if line[0:5] in ("fact:", "rule:"):
+                if header is not None:
+                    yield parse_tokens(header, chunks)
+                header = line[0:4]
+                chunks = []
+                line = line[5:]
+            elif header is None:
+                raise ParseError("expected fact: or rule:, got {!r}".format(line[0:5]), number)
+            chunks.append((number, TOKEN.findall(line)))
+        if header is not None:
+            yield parse_tokens(header, chunks)
+    finally:
+        if lines is not file:
+            lines.close()
+
+def parse_tokens(header, chunks):
+    """Build a Fact or Rule from the tokens of one statement in a single pass.
+        The arrow of a rule may be outside the LHS, as in
+        ((a ?x) (b ?x)) -> (c ?x), or inside one outer group, as in
+        ((a ?x) (b ?x) -> (c ?x)).
+
+    Args:
+        header (str): 'fact' or 'rule'
+        chunks (listof (int|None, listof str)): line numbers and the tokens
+            on each line
+
+    Returns:
+        Fact|Rule
+
+    Raises:
+        ParseError: if the tokens do not make up a fact or rule
+    """
+    line = chunks[0][0] if chunks else None
+    if header == "fact" and len(chunks) == 1:
+        tokens = chunks[0][1]
+        # the usual one line fact, e.g. ( isa cube block )
+        if (len(tokens) > 2 and tokens[0] == "(" and tokens[-1] == ")"
+                and not SPECIAL.intersection(tokens[1:-1])):
+            return Fact(tokens[1:-1])
+    top = []
+    stack = []
+    for line, tokens in chunks:
+        for token in tokens:
+            group = stack[-1] if stack else top
+            if token == "(":
+                group.append([])
+                stack.append(group[-1])
+            elif token == ")":
+                if not stack:
+                    raise ParseError("unbalanced ')'", line)
+                stack.pop()
+            elif token == "->":
+                if header != "rule" or len(stack) > 1 or ARROW in group:
+                    raise ParseError("unexpected '->'", line)
+                group.append(ARROW)
+            elif stack:
+                group.append(token)
+            else:
+                raise ParseError("{!r} outside parentheses".format(token), line)
+    if stack:
+        raise ParseError("unbalanced '('", line)
+    if header == "fact":
+        if len(top) != 1 or not is_statement(top[0]):
+            raise ParseError("a fact is one statement, e.g. (isa cube block)", line)
+        return Fact(top[0])
+    if ARROW not in top and len(top) == 1:
+        top = top[0]
+    if ARROW not in top:
+        raise ParseError("a rule needs '->'", line)
+    lhs, rhs = top[:top.index(ARROW)], top[top.index(ARROW) + 1:]
+    if len(lhs) == 1 and not is_statement(lhs[0]):
+        lhs = lhs[0]
+    if (not lhs or not all(is_statement(s) for s in lhs)
+            or len(rhs) != 1 or not is_statement(rhs[0])):
+        raise ParseError("a rule is (statements) -> statement", line)
+    return Rule([lhs, rhs[0]])
+
+def is_statement(group):
+    """Check whether a parsed group is a statement: a predicate and terms
+
+    Args:
+        group (list): parenthesized group from parse_tokens
+
+    Returns:
+        bool
+    """
+    return isinstance(group, list) and bool(group) and all(isinstance(e, str) for e in group)
 
 def parse_input(e):
     """Parses input, assigning labels and splitting rules into LHS & RHS
@@ -42,7 +163,11 @@ def parse_input(e):
         e (string): Input string to parse
 
     Returns:
-        (number, string | listof string): label, then parsed input
+        Fact|Rule|str|None: the fact or rule, the text of a comment, or None
+            for blank input
+
+    Raises:
+        ParseError: if the input is not a comment, fact or rule
     """
     if len(e) == 0:
         #return (BLANK, None)
@@ -50,19 +175,10 @@ def parse_input(e):
     elif e[0] == '#':
         #return (COMMENT, e)
         return e[1:]
-    elif e[0:5] == "fact:":
-        e = e[5:].replace(")", "").replace("(", "").rstrip().strip().split()
-        #return (FACT, e)
-        return Fact(e)
-    elif e[0:5] == "rule:":
-        e = e[5:].split("->")
-        rhs = e[1].replace(")", "").replace("(", "").rstrip().strip().split()
-        lhs = e[0].rstrip(") ").strip("( ").replace("(", "").split(")")
-        lhs = map(lambda x: x.rstrip().strip().split(), lhs)
-        #return (RULE, [lhs, rhs])
-        return Rule([lhs, rhs])
+    elif e[0:5] in ("fact:", "rule:"):
+        return parse_tokens(e[0:4], [(None, TOKEN.findall(e[5:]))])
     else:
-        print("PARSE ERROR: input header", e[0:5], "not recognized.")
+        raise ParseError("input header {!r} not recognized".format(e[0:5]))
 
 def get_new_fact_or_rule():
     """Creates a new fact or rule. (instead of args, we use command line input
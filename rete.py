@@ -0,0 +1,283 @@
+"""Rete-style forward chaining, an alternative to student_code.InferenceEngine.
+
+Select it with KnowledgeBase([], [], ReteEngine()). Instead of currying a new
+Rule for every partial match, each rule is compiled into a chain of joins:
+    - alpha nodes test a single LHS statement against a fact; rules with the
+      same statement (up to variable names) share one node and one test
+    - beta memories hold the partial matches of a rule's first k statements
+      as Tokens, hashed on the variables the next statement joins on
+Tokens take the place curried rules had in the supported_by/supports_rules
+provenance, so kb_retract works the same with either engine.
+"""
+from logical_classes import *
+from util import match
+
+def substitute(statement, bindings):
+    """Generate Statement from given statement with bound variables replaced
+
+    Args:
+        statement (Statement): statement to generate new statement from
+        bindings (dictof str): maps variable names to bound values
+
+    Returns:
+        Statement
+    """
+    terms = [bindings.get(t.term.element, t) for t in statement.terms]
+    return Statement([statement.predicate] + terms)
+
+def canonical(statement):
+    """Rename the variables of a statement to ?0, ?1, ... in order of appearance,
+        so statements differing only in variable names share an alpha node
+
+    Args:
+        statement (Statement): statement to canonicalize
+
+    Returns:
+        (tuple, dictof str): canonical key, and map from canonical to original
+            variable names
+    """
+    names = {}
+    key = [statement.predicate]
+    for element in statement.key[1:]:
+        if element[0] == "?":
+            element = names.setdefault(element, "?" + str(len(names)))
+        key.append(element)
+    return tuple(key), dict((v, k) for k, v in names.items())
+
+class Token(object):
+    """Represents a partial match of a rule: the facts matching the first k
+        statements of its LHS and the resulting variable bindings. Plays the
+        part of the curried rule InferenceEngine would have created.
+
+    Attributes:
+        name (str): 'token', the name of this class
+        rule (Rule): rule being matched
+        facts (tupleof Fact): facts matching rule.lhs[:len(facts)]
+        bindings (dictof str): variable bindings of the match
+        asserted (bool): always False, tokens are only ever inferred
+        supported_by (SupportSet): the (last fact, parent token or rule) pair
+            this token was built from
+        supports_facts (SupportSet): Facts that this token supports
+        supports_rules (SupportSet): Tokens that extend this token
+    """
+    __slots__ = ('rule', 'facts', 'bindings', '_supported_by', '_supports_facts', '_supports_rules')
+    name = "token"
+    asserted = False
+    supported_by = lazy_list('_supported_by')
+    supports_facts = lazy_list('_supports_facts')
+    supports_rules = lazy_list('_supports_rules')
+
+    def __init__(self, rule, facts, bindings, supported_by):
+        """Constructor for Token
+
+        Args:
+            rule (Rule): rule being matched
+            facts (tupleof Fact): facts matching the first len(facts) LHS statements
+            bindings (dictof str): variable bindings of the match
+            supported_by (listof pair): (fact, parent token or rule) pairs
+        """
+        self.rule = rule
+        self.facts = facts
+        self.bindings = bindings
+        self._supported_by = SupportSet(supported_by)
+        self._supports_facts = None
+        self._supports_rules = None
+
+    def __repr__(self):
+        """Define internal string representation
+        """
+        return 'Token({!r}, {!r})'.format(self.lhs, self.rhs)
+
+    @property
+    def lhs(self):
+        """LHS statements still to be matched, with bindings substituted
+        """
+        return [substitute(s, self.bindings) for s in self.rule.lhs[len(self.facts):]]
+
+    @property
+    def rhs(self):
+        """RHS statement with bindings substituted
+        """
+        return substitute(self.rule.rhs, self.bindings)
+
+class AlphaNode(object):
+    """Tests facts against one canonical LHS statement shared by several rules
+
+    Attributes:
+        pattern (Statement): canonical statement, variables named ?0, ?1, ...
+        successors (listof tuple): (rule, k, names) for each rule whose lhs[k]
+            is this pattern, names mapping canonical to rule variable names
+    """
+    __slots__ = ('pattern', 'successors')
+
+    def __init__(self, key):
+        """Constructor for AlphaNode
+
+        Args:
+            key (tuple): canonical statement key, see canonical()
+        """
+        self.pattern = Statement(list(key))
+        self.successors = []
+
+class ReteEngine(object):
+    """Forward chaining through a network of shared alpha nodes and per-rule
+        beta memories
+
+    Attributes:
+        alpha (dictof dict): maps (predicate, arity) to the alpha nodes for it,
+            keyed by canonical statement key
+        joins (dictof list): maps each rule to, for each k, the sorted names of
+            the variables of lhs[k] already bound by lhs[:k]
+        memories (dictof list): maps each rule to, for each 0 < k < len(lhs), a
+            beta memory: dict from the values of joins[rule][k] to the tokens
+            matching lhs[:k], keyed by their facts
+    """
+    def __init__(self):
+        """Constructor for ReteEngine creating an empty network
+        """
+        self.alpha = {}
+        self.joins = {}
+        self.memories = {}
+
+    def rule_added(self, rule, kb):
+        """Compile a rule just added to the KB into the network and match it
+            against the facts already there
+
+        Args:
+            rule (Rule) - A rule new to the KnowledgeBase
+            kb (KnowledgeBase) - A KnowledgeBase
+        """
+        self._compile(rule)
+        self._extend(rule, rule, 0, {}, kb)
+
+    def restored(self, tokens, kb):
+        """Rebuild the network for a KB loaded from a snapshot: compile its
+            rules and put its tokens back in their beta memories
+
+        Args:
+            tokens (listof Token) - the tokens of the snapshot
+            kb (KnowledgeBase) - A KnowledgeBase
+        """
+        for rule in kb.rules:
+            self._compile(rule)
+        for token in tokens:
+            k = len(token.facts)
+            join = tuple(token.bindings[v] for v in self.joins[token.rule][k])
+            self.memories[token.rule][k].setdefault(join, {})[token.facts] = token
+
+    def _compile(self, rule):
+        """Add a rule's alpha node successors, joins and empty beta memories
+        """
+        bound = set()
+        joins = []
+        for k, statement in enumerate(rule.lhs):
+            key, names = canonical(statement)
+            nodes = self.alpha.setdefault((key[0], len(key) - 1), {})
+            if key not in nodes:
+                nodes[key] = AlphaNode(key)
+            nodes[key].successors.append((rule, k, names))
+            variables = set(e for e in statement.key[1:] if e[0] == "?")
+            joins.append(tuple(sorted(variables & bound)))
+            bound |= variables
+        self.joins[rule] = joins
+        self.memories[rule] = [None] + [{} for _ in rule.lhs[1:]]
+
+    def fact_added(self, fact, kb):
+        """Run a fact just added to the KB through the network
+
+        Args:
+            fact (Fact) - A fact new to the KnowledgeBase
+            kb (KnowledgeBase) - A KnowledgeBase
+        """
+        key = fact.statement.key
+        for node in list(self.alpha.get((key[0], len(key) - 1), {}).values()):
+            found = match(node.pattern, fact.statement)
+            if not found:
+                continue
+            for rule, k, names in list(node.successors):
+                bindings = dict((names.get(v, v), value)
+                                for v, value in found.bindings_dict.items())
+                if k == 0:
+                    self._emit(rule, rule, fact, 0, bindings, kb)
+                    continue
+                join = tuple(bindings[v] for v in self.joins[rule][k])
+                for token in list(self.memories[rule][k].get(join, {}).values()):
+                    merged = dict(token.bindings)
+                    merged.update(bindings)
+                    self._emit(rule, token, fact, k, merged, kb)
+
+    def fact_removed(self, fact, kb):
+        """Hook called after a fact is removed from the KB. Tokens holding the
+            fact are discarded by kb_retract's cascade, so nothing to do here.
+        """
+        pass
+
+    def rule_removed(self, rule, kb):
+        """Hook called after a rule is removed from the KB. Only inferred rules
+            are ever removed, and this engine infers none, so nothing to do.
+        """
+        pass
+
+    def discard(self, token, kb):
+        """Remove a token that lost its support from its beta memory
+
+        Args:
+            token (Token) - token being retracted
+            kb (KnowledgeBase) - A KnowledgeBase
+        """
+        k = len(token.facts)
+        memory = self.memories[token.rule][k]
+        join = tuple(token.bindings[v] for v in self.joins[token.rule][k])
+        tokens = memory.get(join)
+        if tokens and tokens.get(token.facts) is token:
+            del tokens[token.facts]
+            if not tokens:
+                del memory[join]
+
+    def flush(self, kb):
+        """Hook called by kb_run when the agenda is empty. The network infers
+            as each fact is run, so there is nothing left to do.
+        """
+        pass
+
+    def _extend(self, rule, parent, k, bindings, kb):
+        """Left activation: join a partial match of lhs[:k] (or the rule itself
+            when k is 0) with the facts in the KB matching lhs[k]
+        """
+        pattern = substitute(rule.lhs[k], bindings)
+        for fact in list(kb.facts.candidates(pattern)):
+            if fact in kb.pending:
+                # joins from the right once it is run
+                continue
+            found = match(pattern, fact.statement)
+            if found:
+                merged = dict(bindings)
+                merged.update(found.bindings_dict)
+                self._emit(rule, parent, fact, k, merged, kb)
+
+    def _emit(self, rule, parent, fact, k, bindings, kb):
+        """Record that fact matches lhs[k] given parent, a match of lhs[:k]:
+            either infer the RHS or store a new token and keep joining
+        """
+        if k == len(rule.lhs) - 1:
+            new_fact = Fact(substitute(rule.rhs, bindings), [(fact, parent)])
+            kb_fact = kb._get_fact(new_fact)
+            if kb_fact is None:
+                fact.supports_facts.append(new_fact)
+                parent.supports_facts.append(new_fact)
+                kb.kb_add(new_fact)
+            elif (fact, parent) not in kb_fact.supported_by:
+                kb_fact.supported_by.append((fact, parent))
+                fact.supports_facts.append(kb_fact)
+                parent.supports_facts.append(kb_fact)
+            return
+        facts = (parent.facts if k else ()) + (fact,)
+        join = tuple(bindings[v] for v in self.joins[rule][k + 1])
+        tokens = self.memories[rule][k + 1].setdefault(join, {})
+        if facts in tokens:
+            return
+        token = Token(rule, facts, bindings, [(fact, parent)])
+        tokens[facts] = token
+        fact.supports_rules.append(token)
+        parent.supports_rules.append(token)
+        self._extend(rule, token, k + 1, bindings, kb)
@@ -0,0 +1,441 @@
+"""A KnowledgeBase shared between threads, see SharedKnowledgeBase.
+
+Readers never lock. Each write batch ends by publishing a new Generation, an
+immutable index of the facts stored at that point, and readers answer from
+whichever generation is current when they start. A long retraction cascade
+only holds up other writers; queries keep being answered from the last
+generation until the next one replaces it.
+
+Generations share their buckets. Each stored fact has one entry, stamped with
+the numbers of the generations that added and removed it, and filed in
+append-only buckets as FactStore files facts; a generation only reads the
+entries its number falls between. Publishing appends the entries of the facts
+stored and stamps those of the facts removed, so it takes time proportional to
+the batch, whatever the size of the KB. A bucket whose removed entries come to
+outnumber the others is copied without them for the generations to come, and
+the old copy kept for the generations still reading it. Fact objects are
+shared with the KB, whose writers only change their provenance, never their
+statements.
+
+Writes are group-committed. A writer queues its request, then takes the
+write lock and applies every request queued by then, its own included. Runs
+of asserts go through kb_assert_many, so writers arriving together share one
+round of inference and one generation.
+"""
+import threading
+import weakref
+from collections import deque
+from logical_classes import *
+from index import fact_keys
+from util import factq, match
+import query
+
+# number a fact still stored is removed at
+_NEVER = float("inf")
+
+class Bucket(object):
+    """Entries filed under one key, from some generation on
+
+    Attributes:
+        entries (listof list): [fact, number added, number removed] entries,
+            in the order they were stored; only ever appended to
+        since (int): number of the first generation reading these entries
+        previous (Bucket|None): entries generations before since read, None
+            once no generation that old is left
+    """
+    def __init__(self, entries, since, previous):
+        """Constructor for Bucket
+
+        Args: as the attributes
+        """
+        super(Bucket, self).__init__()
+        self.entries = entries
+        self.since = since
+        self.previous = previous
+
+class Index(object):
+    """Buckets of a KB's facts, shared by all its generations, with the
+        bookkeeping of the writer that publishes them
+
+    Attributes:
+        table (dictof Bucket): maps (predicate, arity) and (predicate, arity,
+            position, constant) to the latest bucket of that key
+        entries (dictof list): maps id(fact) to the entry of each stored fact
+        live (dictof int): maps keys to the number of stored facts under them
+        dead (dictof int): maps keys to the number of removed entries in their
+            latest bucket
+        generations (WeakSet): generations published and still in use
+    """
+    def __init__(self):
+        """Constructor for Index
+        """
+        super(Index, self).__init__()
+        self.table = {}
+        self.entries = {}
+        self.live = {}
+        self.dead = {}
+        self.generations = weakref.WeakSet()
+
+    def compact(self, key, number):
+        """Copy the bucket of a key without its removed entries, for
+            generation number on, dropping the copies no generation in use
+            reads anymore
+
+        Args:
+            key (tuple): key of the bucket
+            number (int): number of the generation just published
+        """
+        old = self.table[key]
+        bucket = self.table[key] = Bucket(
+            [entry for entry in old.entries if entry[2] == _NEVER], number, old)
+        self.dead[key] = 0
+        oldest = min(generation.number for generation in list(self.generations))
+        while bucket.previous is not None:
+            if bucket.since <= oldest:
+                bucket.previous = None
+                break
+            bucket = bucket.previous
+
+class Generation(object):
+    """Index of the facts a KB stored at some point, which never changes as
+        seen from it. It answers kb_ask, kb_ask_iter and kb_query like the KB
+        did then, and has the facts, count and values used by query.execute.
+
+    Attributes:
+        number (int): publication number, from 0
+        index (Index): buckets shared with every other generation of the KB
+        nonground (dictof int): maps (predicate, arity) to the number of
+            stored facts with that head containing variables
+        distinct (dictof int): maps (predicate, arity, position) to the number
+            of distinct constants at that position
+    """
+    def __init__(self, number, index, nonground, distinct):
+        """Constructor for Generation
+
+        Args: as the attributes
+        """
+        super(Generation, self).__init__()
+        self.number = number
+        self.index = index
+        self.nonground = nonground
+        self.distinct = distinct
+        self.backward = ()
+
+    def __repr__(self):
+        """Define internal string representation
+        """
+        return 'Generation({!r})'.format(self.number)
+
+    @property
+    def facts(self):
+        """The generation itself, as query.execute looks facts up in kb.facts.
+            Not an attribute, so that a generation is freed as soon as it is
+            dropped rather than by the cyclic garbage collector.
+        """
+        return self
+
+    @classmethod
+    def build(cls, facts, number=0):
+        """Index facts into a new generation
+
+        Args:
+            facts (iterable of Fact): facts to index
+            number (int): publication number
+
+        Returns:
+            Generation
+        """
+        return cls(number, Index(), {}, {}).publish(list(facts), (), number)
+
+    def publish(self, added, removed, number):
+        """Get the next generation. Only the entries of the facts changed are
+            touched, so this takes time proportional to the change, not to
+            the KB. Must be called on the latest generation, by one writer.
+
+        Args:
+            added (listof Fact): facts stored since this generation, in order
+            removed (listof Fact): facts removed since this generation
+            number (int): publication number
+
+        Returns:
+            Generation
+        """
+        index = self.index
+        nonground = self.nonground
+        distinct = self.distinct
+        if added or removed:
+            # per head and position, not per fact: small enough to copy
+            nonground = dict(nonground)
+            distinct = dict(distinct)
+        touched = set()
+        for fact in removed:
+            entry = index.entries.pop(id(fact), None)
+            if entry is None:
+                continue
+            entry[2] = number
+            head, keys, ground = fact_keys(fact)
+            for key in keys:
+                index.dead[key] = index.dead.get(key, 0) + 1
+                index.live[key] -= 1
+                if not index.live[key]:
+                    del index.live[key]
+                    if len(key) > 2:
+                        _step(distinct, key[:3], -1)
+                touched.add(key)
+            if not ground:
+                _step(nonground, head, -1)
+        for fact in added:
+            entry = [fact, number, _NEVER]
+            index.entries[id(fact)] = entry
+            head, keys, ground = fact_keys(fact)
+            for key in keys:
+                bucket = index.table.get(key)
+                if bucket is None:
+                    bucket = index.table[key] = Bucket([], number, None)
+                bucket.entries.append(entry)
+                live = index.live.get(key, 0)
+                index.live[key] = live + 1
+                if not live and len(key) > 2:
+                    _step(distinct, key[:3], 1)
+            if not ground:
+                _step(nonground, head, 1)
+        generation = Generation(number, index, nonground, distinct)
+        index.generations.add(generation)
+        for key in touched:
+            dead = index.dead[key]
+            if dead > 32 and dead > index.live.get(key, 0):
+                index.compact(key, number)
+        return generation
+
+    def bucket(self, key):
+        """Get the entries filed under a key that this generation may see
+
+        Args:
+            key (tuple): (predicate, arity) or (predicate, arity, position,
+                constant)
+
+        Returns:
+            listof list: [fact, number added, number removed] entries, some
+                of them added after or removed before this generation
+        """
+        bucket = self.index.table.get(key)
+        while bucket is not None and bucket.since > self.number:
+            bucket = bucket.previous
+        return () if bucket is None else bucket.entries
+
+    def _smallest(self, statement):
+        """INTERNAL USE ONLY
+        The entries of the smallest bucket covering a statement
+        """
+        key = statement.key
+        head = (key[0], len(key) - 1)
+        best = self.bucket(head)
+        if head in self.nonground:
+            return best
+        for pos in range(1, len(key)):
+            if key[pos][0] != "?":
+                bucket = self.bucket(head + (pos, key[pos]))
+                if len(bucket) < len(best):
+                    best = bucket
+                    if not best:
+                        break
+        return best
+
+    def candidates(self, statement):
+        """Get the facts that could match a statement, as FactStore.candidates
+
+        Args:
+            statement (Statement): statement to look up, may contain variables
+
+        Returns:
+            iterable of Fact: the facts of the smallest bucket covering the
+                statement that this generation holds, in the order they were
+                stored
+        """
+        number = self.number
+        return (entry[0] for entry in self._smallest(statement)
+                if entry[1] <= number < entry[2])
+
+    def count(self, statement):
+        """Estimate how many facts match a statement, as FactStore.count,
+            counting entries other generations hold too
+        """
+        return len(self._smallest(statement))
+
+    def values(self, predicate, arity, pos):
+        """Count the distinct constants at an argument position, as
+            FactStore.values
+        """
+        return self.distinct.get((predicate, arity, pos), 0)
+
+    def kb_ask(self, fact):
+        """Ask for the facts matching a fact, as KnowledgeBase.kb_ask
+        """
+        bindings_lst = ListOfBindings()
+        bindings_lst.list_of_bindings.extend(self.kb_ask_iter(fact))
+        return bindings_lst if bindings_lst.list_of_bindings else []
+
+    def kb_ask_iter(self, fact, limit=None):
+        """Ask for the facts matching a fact, as KnowledgeBase.kb_ask_iter
+        """
+        if not factq(fact):
+            print("Invalid ask:", fact.statement)
+            return
+        if limit is not None and limit <= 0:
+            return
+        found = 0
+        for kb_fact in self.candidates(fact.statement):
+            binding = match(fact.statement, kb_fact.statement)
+            if binding:
+                yield binding, [kb_fact]
+                found += 1
+                if found == limit:
+                    return
+
+    def kb_query(self, statements):
+        """Answer a conjunctive query, as KnowledgeBase.kb_query
+        """
+        bindings_lst = ListOfBindings()
+        bindings_lst.list_of_bindings.extend(self.kb_query_iter(statements))
+        return bindings_lst if bindings_lst.list_of_bindings else []
+
+    def kb_query_iter(self, statements, limit=None):
+        """Answer a conjunctive query lazily, as KnowledgeBase.kb_query_iter
+        """
+        statements = [s.statement if factq(s) else s for s in statements]
+        return query.execute(statements, self, limit)
+
+def _step(counts, key, step):
+    """Add step to a count, dropping it at zero
+    """
+    counts[key] = counts.get(key, 0) + step
+    if not counts[key]:
+        del counts[key]
+
+class SharedKnowledgeBase(object):
+    """Thread-safe front for a KnowledgeBase: lock-free reads from published
+        generations, and exclusive, batched writes
+
+    Attributes:
+        kb (KnowledgeBase): the KB, only touched under lock
+        lock (threading.Lock): held while applying writes, and while
+            answering queries on backward predicates, which read the KB itself
+        queued (deque): (method name, Fact|Rule) writes not yet applied
+        generation (Generation): facts as of the last write batch
+        added, removed (dictof Fact): facts stored or removed by the batch
+            being applied, by id
+    """
+    def __init__(self, kb):
+        """Constructor for SharedKnowledgeBase, which takes the KB over: it
+            must not be used directly anymore
+
+        Args:
+            kb (KnowledgeBase): KB to share
+        """
+        super(SharedKnowledgeBase, self).__init__()
+        self.kb = kb
+        self.lock = threading.Lock()
+        self.queued = deque()
+        self.added = {}
+        self.removed = {}
+        self.generation = Generation.build(kb.facts)
+        kb.watchers.append(self)
+
+    def __repr__(self):
+        """Define internal string representation
+        """
+        return 'SharedKnowledgeBase({!r})'.format(self.kb)
+
+    def snapshot(self):
+        """Get the current generation, to answer several queries from the
+            same facts
+
+        Returns:
+            Generation
+        """
+        return self.generation
+
+    def kb_assert(self, fact_rule):
+        """Assert a fact or rule, returning once it and the writes queued with
+            it are applied and visible to readers
+
+        Args:
+            fact_rule (Fact|Rule): fact or rule to assert
+        """
+        self._write("kb_assert", fact_rule)
+
+    def kb_retract(self, fact_rule):
+        """Retract a fact or rule, returning once it and the writes queued
+            with it are applied and visible to readers
+
+        Args:
+            fact_rule (Fact|Rule): fact or rule to retract
+        """
+        self._write("kb_retract", fact_rule)
+
+    def kb_ask(self, fact):
+        """Ask for the facts matching a fact, see KnowledgeBase.kb_ask
+        """
+        if self.kb.backward:
+            with self.lock:
+                if self.kb.prover.proves(fact.statement):
+                    return self.kb.kb_ask(fact)
+        return self.generation.kb_ask(fact)
+
+    def kb_ask_iter(self, fact, limit=None):
+        """Ask for the facts matching a fact lazily, see
+            KnowledgeBase.kb_ask_iter
+        """
+        if self.kb.backward:
+            with self.lock:
+                if self.kb.prover.proves(fact.statement):
+                    return iter(list(self.kb.kb_ask_iter(fact, limit)))
+        return self.generation.kb_ask_iter(fact, limit)
+
+    def kb_query(self, statements):
+        """Answer a conjunctive query, see KnowledgeBase.kb_query
+        """
+        if self.kb.backward:
+            with self.lock:
+                return self.kb.kb_query(statements)
+        return self.generation.kb_query(statements)
+
+    def changed(self, fact):
+        """Record a fact stored in or removed from the KB, for the next
+            generation
+
+        Args:
+            fact (Fact): fact stored or removed
+        """
+        if id(fact) in self.added:
+            # stored and removed within the batch: readers never saw it
+            del self.added[id(fact)]
+        elif self.kb.facts.get(fact) is fact:
+            self.added[id(fact)] = fact
+        else:
+            self.removed[id(fact)] = fact
+
+    def _write(self, method, fact_rule):
+        """Queue a write, then apply the queued writes unless another writer
+            applied them while this one waited for the lock
+        """
+        self.queued.append((method, fact_rule))
+        with self.lock:
+            if not self.queued:
+                return
+            try:
+                while self.queued:
+                    method, fact_rule = self.queued.popleft()
+                    if method == "kb_assert":
+                        batch = [fact_rule]
+                        while self.queued and self.queued[0][0] == "kb_assert":
+                            batch.append(self.queued.popleft()[1])
+                        self.kb.kb_assert_many(batch)
+                    else:
+                        self.kb.kb_retract(fact_rule)
+            finally:
+                self.generation = self.generation.publish(
+                    list(self.added.values()), list(self.removed.values()),
+                    self.generation.number + 1)
+                self.added.clear()
+                self.removed.clear()
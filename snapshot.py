@@ -0,0 +1,251 @@
+"""Binary snapshots of a saturated KnowledgeBase, see KnowledgeBase.save/load.
+
+A snapshot holds the KB's facts, rules and engine nodes (rete.Token) with their
+asserted flags and supported_by provenance, so a loaded KB answers kb_ask and
+kb_retract exactly like the one that was saved, without re-running inference.
+
+The file is a header followed by flat sections of native 32-bit ints (and
+the UTF-8 names of the interned symbols), each 4-byte aligned:
+
+    symbol offsets      nsymbols + 1 offsets into the names blob
+    names               UTF-8 symbol names, back to back
+    statements          [predicate, arity, term, ...] per distinct statement,
+                        as symbol ids
+    facts               statement offset per fact
+    rules               offset into rule data per rule
+    rule data           [n, lhs offset, ..., lhs offset, rhs offset] per rule
+    tokens              offset into token data per token
+    token data          [rule, n, fact, ..., fact, m, var, value, ...] per
+                        token, facts and rules as node numbers
+    flags               per fact and rule, one byte each: 1 if asserted, plus
+                        2 for rules kept for backward chaining
+    pairs               [dependent, fact, rule or token] per supported_by pair
+
+Nodes are numbered facts first, then rules, then tokens. Loading maps the file
+and reads the sections in place through memoryviews, so nothing is parsed.
+"""
+import gc
+import mmap
+import struct
+import sys
+from array import array
+from logical_classes import *
+from rete import Token
+
+MAGIC = b"KBSNAP01"
+# magic, byte order, then the length of each section in ints (or bytes)
+HEADER = struct.Struct("<8sB3x11I")
+SECTIONS = ("symbols", "names", "statements", "facts", "rules", "rule_data",
+            "tokens", "token_data", "flags", "pairs")
+
+def save(kb, path):
+    """Write a snapshot of a KB
+
+    Args:
+        kb (KnowledgeBase): KB to save, with nothing left on its agenda
+        path (str): file to write
+
+    Raises:
+        ValueError: if the KB still has queued facts or rules
+    """
+    if kb.pending:
+        raise ValueError("{} items are still queued, run kb_run before saving".format(
+            len(kb.pending)))
+    symbols_used = {}
+    names = bytearray()
+    offsets = array('i', [0])
+
+    def symbol(name):
+        id = symbols_used.get(name)
+        if id is None:
+            id = symbols_used[name] = len(offsets) - 1
+            names.extend(name.encode("utf-8"))
+            offsets.append(len(names))
+        return id
+
+    statements = array('i')
+    statement_offsets = {}
+
+    def statement(s):
+        offset = statement_offsets.get(s.key)
+        if offset is None:
+            offset = statement_offsets[s.key] = len(statements)
+            statements.append(symbol(s.predicate))
+            statements.append(len(s.terms))
+            statements.extend(symbol(e) for e in s.key[1:])
+        return offset
+
+    facts = list(kb.facts)
+    rules = list(kb.rules) + list(kb.backward_rules)
+    numbers = {}
+    for node in facts + rules:
+        numbers[id(node)] = len(numbers)
+    # engine nodes are only reachable through provenance
+    tokens = []
+    for node in facts + rules:
+        for dependent in node.supports_rules:
+            if isinstance(dependent, Token) and id(dependent) not in numbers:
+                numbers[id(dependent)] = len(numbers)
+                tokens.append(dependent)
+        for pair in node.supported_by:
+            for member in pair:
+                if isinstance(member, Token) and id(member) not in numbers:
+                    numbers[id(member)] = len(numbers)
+                    tokens.append(member)
+    for token in tokens:
+        # prefixes of a token are tokens too
+        for member in (m for pair in token.supported_by for m in pair):
+            if isinstance(member, Token) and id(member) not in numbers:
+                numbers[id(member)] = len(numbers)
+                tokens.append(member)
+
+    fact_section = array('i', (statement(f.statement) for f in facts))
+    rule_section = array('i')
+    rule_data = array('i')
+    for rule in rules:
+        rule_section.append(len(rule_data))
+        rule_data.append(len(rule.lhs))
+        rule_data.extend(statement(s) for s in rule.lhs)
+        rule_data.append(statement(rule.rhs))
+    token_section = array('i')
+    token_data = array('i')
+    for token in tokens:
+        token_section.append(len(token_data))
+        token_data.append(numbers[id(token.rule)])
+        token_data.append(len(token.facts))
+        token_data.extend(numbers[id(f)] for f in token.facts)
+        token_data.append(len(token.bindings))
+        for variable, value in token.bindings.items():
+            token_data.append(symbol(variable))
+            token_data.append(symbol(value))
+    flags = bytearray(int(node.asserted) for node in facts + rules)
+    for i in range(len(facts) + len(kb.rules), len(facts) + len(rules)):
+        flags[i] |= 2
+    pairs = array('i')
+    for node in facts + rules + tokens:
+        number = numbers[id(node)]
+        for fact, rule in node.supported_by:
+            pairs.extend((number, numbers[id(fact)], numbers[id(rule)]))
+
+    sections = [offsets, names, statements, fact_section, rule_section, rule_data,
+                token_section, token_data, flags, pairs]
+    lengths = [len(section) for section in sections]
+    with open(path, "wb") as file:
+        file.write(HEADER.pack(MAGIC, sys.byteorder == "big", len(facts) + len(rules)
+                               + len(tokens), *lengths))
+        for section in sections:
+            data = section.tobytes() if isinstance(section, array) else bytes(section)
+            file.write(data + b"\0" * (-len(data) % 4))
+
+def load(path, kb):
+    """Fill an empty KB from a snapshot
+
+    Args:
+        path (str): file written by save()
+        kb (KnowledgeBase): empty KB to fill, with the engine to restore
+
+    Returns:
+        KnowledgeBase: kb
+
+    Raises:
+        ValueError: if the file is not a snapshot
+    """
+    with open(path, "rb") as file:
+        data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        view = memoryview(data)
+        fields = HEADER.unpack_from(view)
+        if fields[0] != MAGIC:
+            raise ValueError("{} is not a KB snapshot".format(path))
+        if fields[1] != (sys.byteorder == "big"):
+            raise ValueError("{} was saved with the other byte order".format(path))
+        sections = {}
+        position = HEADER.size
+        for name, length in zip(SECTIONS, fields[3:]):
+            size = length if name in ("names", "flags") else 4 * length
+            sections[name] = view[position:position + size]
+            if name not in ("names", "flags"):
+                sections[name] = sections[name].cast('i')
+            position += size + (-size % 4)
+        # as in kb_assert_many, the load only allocates
+        collecting = gc.isenabled()
+        gc.disable()
+        try:
+            _restore(kb, sections)
+        finally:
+            if collecting:
+                gc.enable()
+            for section in sections.values():
+                section.release()
+            view.release()
+    finally:
+        data.close()
+    return kb
+
+def _restore(kb, sections):
+    """Rebuild the nodes and provenance of a snapshot into kb
+
+    Args:
+        kb (KnowledgeBase): empty KB to fill
+        sections (dictof memoryview): the sections of the snapshot, by name
+    """
+    offsets, blob = sections["symbols"], sections["names"]
+    names = [str(blob[offsets[i]:offsets[i + 1]], "utf-8") for i in range(len(offsets) - 1)]
+    terms = [None] * len(names)
+    statements = sections["statements"]
+    cache = {}
+
+    def term(i):
+        t = terms[i]
+        if t is None:
+            t = terms[i] = Term(names[i])
+        return t
+
+    def statement(offset):
+        s = cache.get(offset)
+        if s is None:
+            arity = statements[offset + 1]
+            s = cache[offset] = Statement([names[statements[offset]]] +
+                                          [term(i) for i in statements[offset + 2:offset + 2 + arity]])
+        return s
+
+    flags = sections["flags"]
+    nodes = []
+    for offset in sections["facts"]:
+        fact = Fact(statement(offset))
+        fact.asserted = bool(flags[len(nodes)])
+        nodes.append(fact)
+        kb.facts.add(fact)
+    rule_data = sections["rule_data"]
+    for offset in sections["rules"]:
+        n = rule_data[offset]
+        lhs = [statement(o) for o in rule_data[offset + 1:offset + 1 + n]]
+        rule = Rule([lhs, statement(rule_data[offset + 1 + n])])
+        rule.asserted = bool(flags[len(nodes)] & 1)
+        if flags[len(nodes)] & 2:
+            kb.backward.add(rule.rhs.predicate)
+            kb.backward_rules.add(rule)
+        else:
+            kb.rules.add(rule)
+        nodes.append(rule)
+    token_data = sections["token_data"]
+    tokens = []
+    for offset in sections["tokens"]:
+        rule = nodes[token_data[offset]]
+        n = token_data[offset + 1]
+        facts = tuple(nodes[i] for i in token_data[offset + 2:offset + 2 + n])
+        at = offset + 2 + n
+        bindings = dict((names[token_data[at + 1 + 2 * i]], names[token_data[at + 2 + 2 * i]])
+                        for i in range(token_data[at]))
+        token = Token(rule, facts, bindings, [])
+        nodes.append(token)
+        tokens.append(token)
+    pairs = sections["pairs"]
+    for i in range(0, len(pairs), 3):
+        dependent, fact, rule = nodes[pairs[i]], nodes[pairs[i + 1]], nodes[pairs[i + 2]]
+        dependent.supported_by.append((fact, rule))
+        supports = fact.supports_facts if isinstance(dependent, Fact) else fact.supports_rules
+        supports.append(dependent)
+        supports = rule.supports_facts if isinstance(dependent, Fact) else rule.supports_rules
+        supports.append(dependent)
+    kb.ie.restored(tokens, kb)
@@ -1,17 +1,60 @@
-import read, copy
+import read, copy, gc, os
+import query, snapshot
+from journal import Journal
+from collections import deque
 from util import *
 from logical_classes import *
+from index import FactStore, RuleStore, OrderedStore
+from backward import Prover
+from compiler import RuleCompiler
+from explain import Explainer
 
 verbose = 0
 
 class KnowledgeBase(object):
-    def __init__(self, facts=[], rules=[]):
-        self.facts = facts
-        self.rules = rules
-        self.ie = InferenceEngine()
+    def __init__(self, facts=[], rules=[], engine=None, order="depth", max_steps=None,
+                 store=None, backward=(), cache=None, metrics=None):
+        # any FactStore, e.g. columnar.ColumnarFactStore
+        self.facts = store if store is not None else FactStore()
+        for fact in facts:
+            self.facts.add(fact)
+        self.rules = RuleStore(rules)
+        # any object with the fact_added/rule_added/fact_removed/rule_removed/
+        # discard/flush/restored interface of InferenceEngine, e.g.
+        # rete.ReteEngine
+        self.ie = engine if engine is not None else InferenceEngine()
+        # facts and rules added but not yet run through the engine: "depth"
+        # processes the newest first, "breadth" the oldest; max_steps caps
+        # the items processed per kb_assert, leaving the rest queued
+        self.agenda = deque()
+        self.pending = {}
+        self.order = order
+        self.max_steps = max_steps
+        self.running = False
+        # journal.Journal recording kb_assert/kb_retract calls, and the
+        # snapshot it continues from, see open()
+        self.journal = None
+        self.snapshot_path = None
+        # predicates derived on demand by kb_ask rather than by the engine:
+        # asserted rules with one on the RHS are kept apart, see backward.py
+        self.backward = set(backward)
+        self.backward_rules = OrderedStore()
+        self.prover = Prover(self)
+        # cache.QueryCache of kb_ask answers, None to always search
+        self.cache = cache
+        # objects told of every fact stored or removed through changed(fact),
+        # e.g. shared.SharedKnowledgeBase
+        self.watchers = []
+        # metrics.Metrics counting inference and retraction, None to skip;
+        # only InferenceEngine reports its inference, see metrics.py
+        if metrics is not None and not isinstance(self.ie, InferenceEngine):
+            raise ValueError("metrics need an InferenceEngine, not {!r}".format(self.ie))
+        self.metrics = metrics
+        # proofs built by kb_explain, kept until the KB next changes
+        self.explainer = Explainer(self)
 
     def __repr__(self):
-        return 'KnowledgeBase({!r}, {!r})'.format(self.facts, self.rules)
+        return 'KnowledgeBase({!r}, {!r})'.format(list(self.facts), list(self.rules))
 
     def __str__(self):
         string = "Knowledge Base: \n"
@@ -19,6 +62,97 @@ class KnowledgeBase(object):
         string += "\n".join((str(rule) for rule in self.rules))
         return string
 
+    def save(self, path):
+        """Write a binary snapshot of the KB: its facts and rules, their
+            asserted flags and provenance, and the inference engine's nodes
+
+        Args:
+            path (str): file to write
+
+        Raises:
+            ValueError: if facts or rules are still queued, see kb_run
+        """
+        snapshot.save(self, path)
+
+    @classmethod
+    def load(cls, path, engine=None, order="depth", max_steps=None, store=None,
+             backward=(), cache=None, metrics=None):
+        """Create a KB from a snapshot written by save(), without running any
+            inference. The engine must be of the kind the KB was saved with.
+
+        Args:
+            path (str): snapshot file
+            engine, order, max_steps, store, backward, cache, metrics: as for
+                the constructor
+
+        Returns:
+            KnowledgeBase
+        """
+        kb = cls([], [], engine, order, max_steps, store, backward, cache, metrics)
+        return snapshot.load(path, kb)
+
+    @classmethod
+    def open(cls, journal_path, snapshot_path=None, engine=None, order="depth",
+             max_steps=None, store=None, backward=(), batch=256, interval=None,
+             cache=None, metrics=None):
+        """Create a KB that journals every kb_assert and kb_retract: load the
+            snapshot if it exists, replay the journal on top of it, and keep
+            appending to the journal
+
+        Args:
+            journal_path (str): journal file, created if missing
+            snapshot_path (str|None): snapshot the journal continues from
+            engine, order, max_steps, store, backward: as for the constructor
+            batch, interval: how often the journal is synced, see journal.Journal
+            cache, metrics: as for the constructor
+
+        Returns:
+            KnowledgeBase
+        """
+        if snapshot_path is not None and os.path.exists(snapshot_path):
+            kb = cls.load(snapshot_path, engine, order, max_steps, store, backward, cache,
+                          metrics)
+        else:
+            kb = cls([], [], engine, order, max_steps, store, backward, cache, metrics)
+        journal = Journal(journal_path, batch, interval)
+        journal.replay(kb)
+        kb.journal = journal
+        kb.snapshot_path = snapshot_path
+        return kb
+
+    def checkpoint(self, snapshot_path=None):
+        """Compact the journal: save a snapshot and empty the journal, or
+            for a journal kept without snapshots, rewrite it to assert only
+            the facts and rules that are asserted now. Should the snapshot be
+            saved but the journal not emptied, replaying the journal again on
+            top of it leaves the KB unchanged.
+
+        Args:
+            snapshot_path (str|None): snapshot file to write, by default the
+                one the KB was opened with
+
+        Raises:
+            ValueError: if facts or rules are still queued, see kb_run
+        """
+        if snapshot_path is None:
+            snapshot_path = self.snapshot_path
+        if snapshot_path is None:
+            self.journal.compact([item for store in (self.facts, self.rules,
+                                                     self.backward_rules)
+                                  for item in store if item.asserted])
+            return
+        self.save(snapshot_path + ".tmp")
+        os.replace(snapshot_path + ".tmp", snapshot_path)
+        self.journal.reset()
+        self.snapshot_path = snapshot_path
+
+    def close(self):
+        """Sync and close the journal, if any
+        """
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+
     def _get_fact(self, fact):
         """INTERNAL USE ONLY
         Get the fact in the KB that is the same as the fact argument
@@ -29,9 +163,7 @@ class KnowledgeBase(object):
         Returns:
             Fact: matching fact
         """
-        for kbfact in self.facts:
-            if fact == kbfact:
-                return kbfact
+        return self.facts.get(fact)
 
     def _get_rule(self, rule):
         """INTERNAL USE ONLY
@@ -43,9 +175,7 @@ class KnowledgeBase(object):
         Returns:
             Rule: matching rule
         """
-        for kbrule in self.rules:
-            if rule == kbrule:
-                return kbrule
+        return self.rules.get(rule)
 
     def kb_add(self, fact_rule):
         """Add a fact or rule to the KB
@@ -55,32 +185,89 @@ class KnowledgeBase(object):
             None
         """
         # print("Adding {!r}", 1, verbose, [fact_rule])
+        self.explainer.invalidate()
         if isinstance(fact_rule, Fact):
-            if fact_rule not in self.facts:
-                self.facts.append(fact_rule)
-                for rule in self.rules:
-                    self.ie.fc_infer(fact_rule, rule, self)
+            kb_fact = self._get_fact(fact_rule)
+            if kb_fact is None:
+                self.facts.add(fact_rule)
+                self._changed(fact_rule)
+                self._schedule(fact_rule)
             else:
                 if fact_rule.supported_by:
-                    ind = self.facts.index(fact_rule)
                     for f in fact_rule.supported_by:
-                        self.facts[ind].supported_by.append(f)
+                        kb_fact.supported_by.append(f)
                 else:
-                    ind = self.facts.index(fact_rule)
-                    self.facts[ind].asserted = True
+                    kb_fact.asserted = True
         elif isinstance(fact_rule, Rule):
-            if fact_rule not in self.rules:
-                self.rules.append(fact_rule)
-                for fact in self.facts:
-                    self.ie.fc_infer(fact, fact_rule, self)
+            self.prover.invalidate()
+            if fact_rule.rhs.predicate in self.backward and not fact_rule.supported_by:
+                # proved on demand by kb_ask, never run through the engine
+                self.backward_rules.add(fact_rule)
+                return
+            kb_rule = self._get_rule(fact_rule)
+            if kb_rule is None:
+                self.rules.add(fact_rule)
+                self._schedule(fact_rule)
             else:
                 if fact_rule.supported_by:
-                    ind = self.rules.index(fact_rule)
                     for f in fact_rule.supported_by:
-                        self.rules[ind].supported_by.append(f)
+                        kb_rule.supported_by.append(f)
+                else:
+                    kb_rule.asserted = True
+
+    def _schedule(self, fact_rule):
+        """INTERNAL USE ONLY
+        Queue a fact or rule just stored in the KB for inference. Only the
+        outermost kb_add runs the agenda, so inference never recurses.
+
+        Args:
+            fact_rule (Fact|Rule): the fact or rule to queue
+        """
+        self.pending[fact_rule] = fact_rule
+        self.agenda.append(fact_rule)
+        if not self.running:
+            self.kb_run(self.max_steps)
+
+    def kb_run(self, max_steps=None):
+        """Run queued facts and rules through the inference engine until the
+            agenda is empty or max_steps items have been processed. While an
+            item is queued, engines skip it when pairing others, so each
+            fact-rule pair is tried exactly once, when the later one is run.
+            Whenever the agenda empties the engine is flushed, which lets
+            engines that batch their work (datalog.SemiNaiveEngine) infer.
+
+        Args:
+            max_steps (int|None): maximum number of items to process
+
+        Returns:
+            int: number of items still queued
+        """
+        self.running = True
+        self.explainer.invalidate()
+        try:
+            steps = 0
+            while max_steps is None or steps < max_steps:
+                if not self.agenda:
+                    self.ie.flush(self)
+                    if not self.agenda:
+                        break
+                    continue
+                if self.order == "depth":
+                    item = self.agenda.pop()
+                else:
+                    item = self.agenda.popleft()
+                if self.pending.get(item) is not item:
+                    # retracted while queued
+                    continue
+                del self.pending[item]
+                steps += 1
+                if isinstance(item, Fact):
+                    self.ie.fact_added(item, self)
                 else:
-                    ind = self.rules.index(fact_rule)
-                    self.rules[ind].asserted = True
+                    self.ie.rule_added(item, self)
+        finally:
+            self.running = False
+        return len(self.pending)
 
     def kb_assert(self, fact_rule):
         """Assert a fact or rule into the KB
@@ -89,8 +276,40 @@ class KnowledgeBase(object):
             fact_rule (Fact or Rule): Fact or Rule we're asserting
         """
         # print("Asserting {!r}", 0, verbose, [fact_rule])
+        if self.journal is not None:
+            self.journal.log_assert(fact_rule)
         self.kb_add(fact_rule)
 
+    def kb_assert_many(self, items):
+        """Assert many facts and rules, storing them all before running any
+            inference. Queued items are skipped when pairing, so each new item
+            is only joined with what was stored before it was run: new facts
+            with the old rules, new rules with all facts.
+
+        Args:
+            items (iterable of Fact|Rule): Facts and Rules we're asserting
+        """
+        # a bulk load only allocates, so pause the cyclic garbage collector
+        # rather than have it rescan the growing KB over and over
+        collecting = gc.isenabled()
+        gc.disable()
+        running = self.running
+        self.running = True
+        try:
+            for item in items:
+                if self.journal is not None:
+                    self.journal.log_assert(item)
+                self.kb_add(item)
+            if self.journal is not None:
+                self.journal.sync()
+            self.running = running
+            if not running:
+                self.kb_run(self.max_steps)
+        finally:
+            self.running = running
+            if collecting:
+                gc.enable()
+
     def kb_ask(self, fact):
         """Ask if a fact is in the KB
 
@@ -101,20 +320,156 @@ class KnowledgeBase(object):
             listof Bindings|False - list of Bindings if result found, False otherwise
         """
         # print("Asking {!r}".format(fact))
-        if factq(fact):
-            f = Fact(fact.statement)
-            bindings_lst = ListOfBindings()
-            # ask matched facts
-            for fact in self.facts:
-                binding = match(f.statement, fact.statement)
-                if binding:
-                    bindings_lst.add_bindings(binding, [fact])
+        bindings_lst = ListOfBindings()
+        # kb_ask_iter yields the (bindings, facts) pairs ListOfBindings holds
+        bindings_lst.list_of_bindings.extend(self.kb_ask_iter(fact))
+        return bindings_lst if bindings_lst.list_of_bindings else []
+
+    def kb_ask_iter(self, fact, limit=None):
+        """Ask for the facts in the KB matching a fact, yielding each answer as
+            it is found, so a caller that needs one answer or the first few
+            stops the search early. The KB must not change while answers are
+            still being read. With a cache, answers come from it when it holds
+            the query, and a search run to the end fills it.
 
-            return bindings_lst if bindings_lst.list_of_bindings else []
+        Args:
+            fact (Fact) - Statement to be asked
+            limit (int|None) - maximum number of answers
 
-        else:
+        Returns:
+            iterator of (Bindings, listof Fact) - the bindings of each answer
+                and the fact it matched, as held by ListOfBindings
+        """
+        if not factq(fact):
             print("Invalid ask:", fact.statement)
+            return
+        if limit is not None and limit <= 0:
+            return
+        cached = None
+        if self.backward and self.prover.proves(fact.statement):
+            # derived on demand from the rules, see backward.Prover
+            facts = self._proved(fact.statement)
+        else:
+            if self.cache is not None:
+                answers = self.cache.get(fact.statement)
+                if answers is not None:
+                    for answer in (answers if limit is None else answers[:limit]):
+                        yield answer
+                    return
+                cached = []
+            # ask matched facts, only visiting those filed under the query's
+            # predicate, arity and constants
+            facts = self.facts.candidates(fact.statement)
+        found = 0
+        for kb_fact in facts:
+            binding = match(fact.statement, kb_fact.statement)
+            if binding:
+                if cached is not None:
+                    cached.append((binding, [kb_fact]))
+                yield binding, [kb_fact]
+                found += 1
+                if found == limit:
+                    return
+        if cached is not None:
+            # only a search run to the end has every answer
+            self.cache.put(fact.statement, cached)
+
+    def kb_query(self, statements):
+        """Ask for the bindings that satisfy every statement of a conjunctive
+            query, e.g. [(inst ?x box), (color ?x red)], joined in the order
+            planned by query.plan
+
+        Args:
+            statements (listof Fact|Statement) - the query, sharing variables
+
+        Returns:
+            ListOfBindings|[] - bindings of each answer, with the facts the
+                statements matched, [] if there are none
+        """
+        bindings_lst = ListOfBindings()
+        for binding, facts in self.kb_query_iter(statements):
+            bindings_lst.add_bindings(binding, facts)
+        return bindings_lst if bindings_lst.list_of_bindings else []
+
+    def kb_query_iter(self, statements, limit=None):
+        """Ask for the answers of a conjunctive query one at a time, see
+            kb_query and kb_ask_iter
+
+        Args:
+            statements (listof Fact|Statement) - the query, sharing variables
+            limit (int|None) - maximum number of answers
+
+        Returns:
+            iterator of (Bindings, listof Fact) - the bindings of each answer
+                and the fact each statement matched
+        """
+        statements = [s.statement if factq(s) else s for s in statements]
+        return query.execute(statements, self, limit)
+
+    def kb_explain(self, fact_rule, max_depth=None, max_proofs=1, shortest=False):
+        """Explain why a fact or rule is in the KB: get proofs of it, trees of
+            the (fact, rule) pairs it was inferred from, down to asserted
+            facts and rules. Each proof ends in a different pair, or in the
+            assertion, and proves the pair's members by their first
+            derivation or, if shortest, in the fewest steps. Subproofs are
+            shared and kept until the KB next changes, see explain.py.
+
+        Args:
+            fact_rule (Fact|Rule) - fact or rule to explain, without variables
+            max_depth (int|None) - greatest number of steps from the deepest
+                asserted fact or rule of a proof
+            max_proofs (int) - maximum number of proofs
+            shortest (bool) - fewest steps, and the proofs in that order;
+                else the order the last steps were inferred in, with the
+                assertion first. Slower the first time, as it reads all the
+                provenance of the fact or rule
+
+        Returns:
+            listof explain.Proof - empty if it is not stored, as for facts
+                only proved on demand by backward chaining
+        """
+        if factq(fact_rule):
+            node = self._get_fact(fact_rule)
+        elif isinstance(fact_rule, Rule):
+            node = self._get_rule(fact_rule)
+        else:
+            print("Invalid explain:", fact_rule)
             return []
+        if node is None:
+            return []
+        return self.explainer.explain(node, max_depth, max_proofs, shortest)
+
+    def _proved(self, statement):
+        """INTERNAL USE ONLY
+        Prove a statement by backward chaining
+
+        Args:
+            statement (Statement): query
+
+        Returns:
+            iterator of Fact: the stored fact of each answer, or a new,
+                unasserted one if it is not stored
+        """
+        for answer in self.prover.solve(statement):
+            proved = Fact(answer)
+            found = self._get_fact(proved)
+            if found is None:
+                proved.asserted = False
+                yield proved
+            else:
+                yield found
+
+    def _changed(self, fact):
+        """INTERNAL USE ONLY
+        Tell the cache and the watchers that a fact was stored or removed
+
+        Args:
+            fact (Fact): fact stored in or removed from self.facts
+        """
+        if self.cache is not None:
+            self.cache.changed(fact)
+        for watcher in self.watchers:
+            watcher.changed(fact)
 
     def kb_retract(self, fact_or_rule):
         """Retract a fact from the KB
@@ -129,81 +484,233 @@ class KnowledgeBase(object):
         ####################################################
         # Student code goes here
 
-        # for f in self.facts:
-        #     if f.statement == fact_or_rule
         if factq(fact_or_rule):
-            if fact_or_rule in self.facts:
-                new_fact_or_rule = self.facts[self.facts.index(fact_or_rule)]
-            else:
-                return
+            node = self._get_fact(fact_or_rule)
         elif isinstance(fact_or_rule, Rule):
-            if fact_or_rule in self.rules:
-                new_fact_or_rule = self.rules[self.rules.index(fact_or_rule)]
-            else:
+            node = self._get_rule(fact_or_rule)
+        else:
+            # partial match owned by the inference engine, e.g. rete.Token
+            node = fact_or_rule
+        if node is None:
+            return
+        self.explainer.invalidate()
+        if self.journal is not None and isinstance(node, (Fact, Rule)):
+            self.journal.log_retract(node)
+
+        if factq(node):
+            if not node.asserted and node.supported_by:
                 return
-
-        if factq(new_fact_or_rule):
-            if new_fact_or_rule.asserted == True:
-                # print("this fact was asserted")
-                # print(len(fact_or_rule.supported_by))
-                # print(len(fact_or_rule.supports_facts))
-                # print(len(fact_or_rule.supports_rules))
-
-                if len(new_fact_or_rule.supported_by) == 0:
-                    for supportedFact in new_fact_or_rule.supports_facts:
-                        # print(supportedFact)
-                        for pair in supportedFact.supported_by:
-                            if pair[0] == new_fact_or_rule:
-                                supportedFact.supported_by.remove(pair)
-                                self.kb_retract(supportedFact)
-                    for supportedRule in new_fact_or_rule.supports_rules:
-                        for pair in supportedRule.supported_by:
-                            if pair[0] == new_fact_or_rule:
-                                supportedRule.supported_by.remove(pair)
-                                self.kb_retract(supportedRule)
-                    self.facts.remove(new_fact_or_rule)
-                else:
-                    new_fact_or_rule.asserted = False
-            else:
-                # print("this fact was not asserted")
-                if len(new_fact_or_rule.supported_by) == 0:
-                    # print("boo suckers")
-                    for supportedFact2 in new_fact_or_rule.supports_facts:
-                        for pair in supportedFact2.supported_by:
-                            if pair[0] == new_fact_or_rule:
-                                supportedFact2.supported_by.remove(pair)
-                                self.kb_retract(supportedFact2)
-                    for supportedRule2 in new_fact_or_rule.supports_rules:
-                        for pair in supportedRule2.supported_by:
-                            if pair[0] == new_fact_or_rule:
-                                supportedRule2.supported_by.remove(pair)
-                                self.kb_retract(supportedRule2)
-                    self.facts.remove(new_fact_or_rule)
+            node.asserted = False
+        elif node.asserted or node.supported_by:
+            return
+        if self.metrics is None:
+            self._retract_unfounded(node)
         else:
-            if new_fact_or_rule.asserted == True:
-                pass
+            self.metrics.retract(self, node)
+
+    def _founded(self, node):
+        """INTERNAL USE ONLY
+        Check whether a node is asserted or has a support pair of asserted
+        facts and rules, so that it survives any retraction of something else
+
+        Args:
+            node (Fact|Rule|other): fact, rule or engine node (e.g. rete.Token)
+
+        Returns:
+            bool
+        """
+        if node.asserted:
+            return True
+        for fact, rule in node.supported_by:
+            if fact.asserted and rule.asserted:
+                return True
+        return False
+
+    def _retract_unfounded(self, node):
+        """INTERNAL USE ONLY
+        Remove a node that is no longer asserted, unless it can still be
+        inferred, along with every fact, rule or engine node that can only be
+        inferred through it. Support may be cyclic, e.g. through a symmetric
+        rule, so having some support is not enough: a node survives only if
+        it is supported from asserted nodes. In the style of DRed
+        (delete and rederive):
+            - over-delete: collect the node and everything inferred from it,
+              stopping at nodes founded on asserted pairs
+            - rederive: mark the collected nodes that have a support pair
+              outside the collection, then, through per-pair counts of
+              unmarked members, the nodes those support in turn
+            - remove the unmarked ones and the supports involving them
+        The work is proportional to the part of the support graph inferred
+        from the node, never the whole KB.
+
+        Args:
+            node (Fact|Rule|other): fact, rule or engine node (e.g. rete.Token)
+                that just lost its assertion
+        """
+        if self._founded(node):
+            return
+        affected = {id(node): node}
+        stack = [node]
+        while stack:
+            supporter = stack.pop()
+            # the support slots, so nodes supporting nothing allocate nothing
+            for dependents in (supporter._supports_facts, supporter._supports_rules):
+                for dependent in dependents or ():
+                    if id(dependent) not in affected and not self._founded(dependent):
+                        affected[id(dependent)] = dependent
+                        stack.append(dependent)
+
+        waiting = {}
+        for dependent in affected.values():
+            for pair in dependent.supported_by:
+                missing = (id(pair[0]) in affected) + (id(pair[1]) in affected)
+                if not missing:
+                    stack.append(dependent)
+                    break
+                waiting[id(dependent), id(pair[0]), id(pair[1])] = missing
+        founded = set(id(dependent) for dependent in stack)
+        while stack:
+            supporter = stack.pop()
+            for dependents in (supporter._supports_facts, supporter._supports_rules):
+                for dependent in dependents or ():
+                    if id(dependent) not in affected or id(dependent) in founded:
+                        continue
+                    for pair in dependent.supported_by.holding(supporter):
+                        key = (id(dependent), id(pair[0]), id(pair[1]))
+                        waiting[key] -= 1
+                        if not waiting[key]:
+                            founded.add(id(dependent))
+                            stack.append(dependent)
+                            break
+
+        dead = [d for d in affected.values() if id(d) not in founded]
+        for d in dead:
+            if factq(d):
+                self.facts.remove(d)
+                self._changed(d)
+                self.pending.pop(d, None)
+                self.ie.fact_removed(d, self)
+            elif isinstance(d, Rule):
+                self.rules.remove(d)
+                self.pending.pop(d, None)
+                self.ie.rule_removed(d, self)
+                if self.metrics is not None:
+                    self.metrics.rule_removed(d)
             else:
-                # print(new_fact_or_rule)
-                if len(new_fact_or_rule.supported_by) == 0:
-                    # print("boo suckers")
-                    # print(new_fact_or_rule)
-                    for supportedFact3 in new_fact_or_rule.supports_facts:
-                        # print(supportedFact3)
-                        for pair in supportedFact3.supported_by:
-                            if pair[1] == new_fact_or_rule:
-                                supportedFact3.supported_by.remove(pair)
-                                self.kb_retract(supportedFact3)
-                    for supportedRule3 in new_fact_or_rule.supports_rules:
-                        for pair in supportedRule3.supported_by:
-                            if pair[1] == new_fact_or_rule:
-                                supportedRule3.supported_by.remove(pair)
-                                self.kb_retract(supportedRule3)
-                    self.rules.remove(new_fact_or_rule)
-                # print("this rule was not asserted")
+                self.ie.discard(d, self)
+        dead_ids = set(id(d) for d in dead)
+        for d in dead:
+            # unlink from the surviving nodes it supports or is supported by
+            for pair in d.supported_by:
+                for member in pair:
+                    if id(member) not in dead_ids:
+                        if factq(d):
+                            member.supports_facts.discard(d)
+                        else:
+                            member.supports_rules.discard(d)
+            for dependents in (d._supports_facts, d._supports_rules):
+                for dependent in dependents or ():
+                    if id(dependent) not in dead_ids:
+                        self._drop_support(dependent, d)
+
+    def _drop_support(self, dependent, node):
+        """INTERNAL USE ONLY
+        Remove the supports of dependent that involve node, and the links to
+        dependent from the other members of those pairs when no remaining
+        pair involves them.
+
+        Args:
+            dependent (Fact|Rule|other): node supported by node
+            node (Fact|Rule|other): node being removed
 
+        Returns:
+            bool: whether dependent was left without support by this call
+        """
+        support = dependent.supported_by
+        dropped = support.drop(node)
+        if not dropped:
+            return False
+        for pair in dropped:
+            for member in pair:
+                if member is not node and not (support and support.holds(member)):
+                    if factq(dependent):
+                        member.supports_facts.discard(dependent)
+                    else:
+                        member.supports_rules.discard(dependent)
+        return not support
 
 
 class InferenceEngine(object):
+    def __init__(self):
+        # rules compiled into matching functions, cached per rule and shape
+        self.compiler = RuleCompiler()
+
+    def fact_added(self, fact, kb):
+        """Infer from a fact just added to the KB
+
+        Args:
+            fact (Fact) - A fact new to the KnowledgeBase
+            kb (KnowledgeBase) - A KnowledgeBase
+        """
+        # only rules whose lhs[0] could match; queued rules will pair with
+        # this fact when they are run
+        for rule in kb.rules.triggers(fact):
+            if rule not in kb.pending:
+                if kb.metrics is None:
+                    self.fc_infer(fact, rule, kb)
+                else:
+                    kb.metrics.infer(self, fact, rule, kb)
+
+    def rule_added(self, rule, kb):
+        """Infer from a rule just added to the KB
+
+        Args:
+            rule (Rule) - A rule new to the KnowledgeBase
+            kb (KnowledgeBase) - A KnowledgeBase
+        """
+        # only facts that could match lhs[0]; queued facts will pair with
+        # this rule when they are run
+        for fact in list(kb.facts.candidates(rule.lhs[0])):
+            if fact not in kb.pending:
+                if kb.metrics is None:
+                    self.fc_infer(fact, rule, kb)
+                else:
+                    kb.metrics.infer(self, fact, rule, kb)
+
+    def fact_removed(self, fact, kb):
+        """Hook called after a fact is removed from the KB. Curried rules are
+            removed by kb_retract itself, so there is nothing to do here.
+        """
+        pass
+
+    def rule_removed(self, rule, kb):
+        """Hook called after a rule is removed from the KB: forget the function
+            compiled for it, which would otherwise keep it alive
+
+        Args:
+            rule (Rule) - A rule removed from the KnowledgeBase
+            kb (KnowledgeBase) - A KnowledgeBase
+        """
+        self.compiler.discard(rule)
+
+    def discard(self, node, kb):
+        """Hook called by kb_retract to remove a node that is neither a Fact
+            nor a Rule of the KB. This engine never creates any.
+        """
+        pass
+
+    def flush(self, kb):
+        """Hook called by kb_run when the agenda is empty. This engine infers
+            as each item is run, so there is nothing left to do.
+        """
+        pass
+
+    def restored(self, nodes, kb):
+        """Hook called after a KB is loaded from a snapshot. Curried rules are
+            stored as rules of the KB, so there is nothing to rebuild.
+        """
+        pass
+
     def fc_infer(self, fact, rule, kb):
         """Forward-chaining to infer new facts and rules
 
@@ -220,75 +727,36 @@ class InferenceEngine(object):
         ####################################################
         # Student code goes here
 
-        if rule.lhs != []:
-            leftHandSide = rule.lhs[0]
-
-        new_bindings = match(fact.statement,leftHandSide)
-        rule_rhs = rule.rhs
-
-        # print("lhs0: " + str(leftHandSide))
-        # print("rhs: " + str(rule_rhs))
-        # print("bindings: " + str(new_bindings))
-
-        # If a rule has already been created with the constants
-        if new_bindings == []:
-            if len(rule.lhs) == 1:
-                new_fact = Fact(rule_rhs,[(fact,rule)])
-                if new_fact not in kb.facts:
-                    fact.supports_facts.append(new_fact)
-                    rule.supports_facts.append(new_fact)
-                    # print(new_fact.statement)
-                    # print("adding fact in []")
-                    kb.kb_add(new_fact)
-                else:
-                    new_fact = kb.facts[kb.facts.index(new_fact)]
-                    new_fact.supported_by.append((fact,rule))
-                    fact.supports_rules.append(new_fact)
-                    rule.supports_rules.append(new_fact)
+        # match rule.lhs[0] and instantiate the rest of the rule through the
+        # function compiled for it, see compiler.py
+        step = self.compiler.get(rule)(fact.statement)
+        if step is None:
+            return
+        lhs, rhs = step
+
+        if not lhs:
+            new_fact = Fact(rhs,[(fact,rule)])
+            kb_fact = kb._get_fact(new_fact)
+            if kb_fact is None:
+                fact.supports_facts.append(new_fact)
+                rule.supports_facts.append(new_fact)
+                kb.kb_add(new_fact)
             else:
-                new_rule = Rule([rule.lhs[1:],rule_rhs],[(fact,rule)])
-                if new_rule not in kb.rules:
-                    fact.supports_rules.append(new_rule)
-                    rule.supports_rules.append(new_rule)
-                    # print("adding rule in []")
-                    kb.kb_add(new_rule)
-                else:
-                    new_rule = kb.rules[kb.rules.index(new_rule)]
-                    new_rule.supported_by.append((fact,rule))
-                    fact.supports_rules.append(new_rule)
-                    rule.supports_rules.append(new_rule)
-
-        # Rule has variables instead
-        elif new_bindings !=  False:
-            if len(rule.lhs) == 1:
-                new_statement = instantiate(rule_rhs,new_bindings)
-                new_fact = Fact(new_statement,[(fact,rule)])
-                if new_fact not in kb.facts:
-                    fact.supports_facts.append(new_fact)
-                    rule.supports_facts.append(new_fact)
-                    # print(new_fact.statement)
-                    # print("adding fact in not false")
-                    kb.kb_add(new_fact)
-                else:
-                    new_fact = kb.facts[kb.facts.index(new_fact)]
-                    new_fact.supported_by.append((fact,rule))
-                    fact.supports_rules.append(new_fact)
-                    rule.supports_rules.append(new_fact)
+                kb_fact.supported_by.append((fact,rule))
+                fact.supports_facts.append(kb_fact)
+                rule.supports_facts.append(kb_fact)
+            if kb.metrics is not None:
+                kb.metrics.derived(rule, new_fact, kb_fact is None)
+        else:
+            new_rule = Rule([lhs,rhs],[(fact,rule)])
+            kb_rule = kb._get_rule(new_rule)
+            if kb_rule is None:
+                fact.supports_rules.append(new_rule)
+                rule.supports_rules.append(new_rule)
+                kb.kb_add(new_rule)
             else:
-                newRulesArray = []
-                for oldRule in rule.lhs[1:]:
-                    # print(instantiate(oldRule,new_bindings))
-                    newRulesArray.append(instantiate(oldRule,new_bindings))
-                new_rule = Rule([newRulesArray,instantiate(rule_rhs,new_bindings)],[(fact,rule)])
-                if new_rule not in kb.rules:
-                    fact.supports_rules.append(new_rule)
-                    rule.supports_rules.append(new_rule)
-                    # print("adding rule in not false")
-                    kb.kb_add(new_rule)
-                else:
-                    new_rule = kb.rules[kb.rules.index(new_rule)]
-                    new_rule.supported_by.append((fact,rule))
-                    fact.supports_rules.append(new_rule)
-                    rule.supports_rules.append(new_rule)
-        # else:
-        #     print("nothing cooking")
+                kb_rule.supported_by.append((fact,rule))
+                fact.supports_rules.append(kb_rule)
+                rule.supports_rules.append(kb_rule)
+            if kb.metrics is not None:
+                kb.metrics.derived(rule, new_rule, kb_rule is None)
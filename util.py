@@ -30,14 +30,34 @@ def match(state1, state2, bindings=None):
     Returns:
         Bindings|False: either associated bindings or no match found
     """
-    if len(state1.terms) != len(state2.terms) or state1.predicate != state2.predicate:
+    terms1 = state1.terms
+    terms2 = state2.terms
+    if len(terms1) != len(terms2) or state1.predicate != state2.predicate:
         return False
     if not bindings:
         bindings = lc.Bindings()
-    return match_recursive(state1.terms, state2.terms, bindings)
+    # one pass over both term tuples; Terms are interned, so equal constants
+    # are the same object, and know whether they hold a variable
+    bound = bindings.bindings_dict
+    for t1, t2 in zip(terms1, terms2):
+        if t1.var:
+            var, value = t1.term.element, t2.term.element
+        elif t2.var:
+            var, value = t2.term.element, t1.term.element
+        elif t1 is not t2:
+            return False
+        else:
+            continue
+        old = bound.get(var)
+        if old is None:
+            bound[var] = value
+        elif old != value:
+            return False
+    return bindings
 
 def match_recursive(terms1, terms2, bindings):  # recursive...
-    """Recursive helper for match
+    """Recursive helper for match, kept for reference: match now loops over
+        the terms itself
 
     Args:
         terms1 (listof Term): terms to match with terms2
@@ -67,9 +87,11 @@ def instantiate(statement, bindings):
         statement (Statement): statement to generate new statement from
         bindings (Bindings): bindings to substitute into statement
     """
+    bound = bindings.bindings_dict
+
     def handle_term(term):
-        if is_var(term):
-            bound_value = bindings.bound_to(term.term)
+        if term.var:
+            bound_value = bound.get(term.term.element)
             return lc.Term(bound_value) if bound_value else term
         else:
             return term